@@ -0,0 +1,259 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Control plane and assertion benchmarks on synthetic applications.
+
+Builds chain, fan-out tree and random DAG topologies of several sizes, served by in-process stub proxies
+(pygremlin.testing), and times scenario arming (rule expansion), setup_failures, push_rules and
+clear_rules_from_all_proxies on them. Then times every AssertionChecker check on synthetic proxy log
+corpora of several sizes (pygremlin.CorpusGenerator), read from local files.
+
+Results are written as JSON lines, one per benchmark, after a line of metadata; --compare prints the
+speedup of each benchmark over an earlier results file.
+
+usage: bench_gremlin.py [--sizes 10,100,1000] [--corpus 1000,10000,100000] [--repeat 3]
+                        [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from pygremlin import ApplicationGraph, AssertionChecker, CorpusGenerator, FailureGenerator, FileLogStore
+from pygremlin.testing import ProxyPool
+
+
+def chain(n, seed=0):
+    """s0 -> s1 -> ... -> s(n-1)"""
+    return dict(("s%d" % i, ["s%d" % (i + 1)]) for i in range(n - 1))
+
+
+def fanout(n, degree=3, seed=0):
+    """Tree where every service calls up to *degree* others"""
+    deps = {}
+    for i in range(1, n):
+        deps.setdefault("s%d" % ((i - 1) // degree), []).append("s%d" % i)
+    return deps
+
+
+def random_dag(n, degree=2, seed=0):
+    """Random DAG: every service calls about *degree* services further down the order"""
+    rnd = random.Random(seed)
+    deps = {}
+    for i in range(n - 1):
+        dests = set(rnd.randrange(i + 1, n) for k in range(rnd.randint(1, 2 * degree - 1)))
+        deps["s%d" % i] = ["s%d" % d for d in sorted(dests)]
+    return deps
+
+
+TOPOLOGIES = [("chain", chain), ("fanout", fanout), ("dag", random_dag)]
+
+
+def topology(dependencies, n, proxies):
+    """Topology JSON for ApplicationGraph, with callers spread over the given stub proxy instances"""
+    services = []
+    for i in range(n):
+        name = "s%d" % i
+        entry = {"name": name}
+        if dependencies.get(name):
+            entry["service_proxies"] = [proxies[i % len(proxies)]]
+        services.append(entry)
+    return {"services": services, "dependencies": dependencies}
+
+
+def gremlins(dependencies, count, seed=0):
+    """Abort and delay scenarios on *count* callers, on all their dependencies"""
+    rnd = random.Random(seed)
+    callers = sorted(dependencies)
+    scenarios = []
+    for source in rnd.sample(callers, min(count, len(callers))):
+        scenarios.append({"scenario": "abort_requests", "source": source, "errorcode": 503,
+                          "headerpattern": "bench-*"})
+        scenarios.append({"scenario": "delay_requests", "source": source, "delaytime": "100ms",
+                          "headerpattern": "bench-*"})
+    return {"gremlins": scenarios}
+
+
+def timed(func, repeat, setup=None):
+    """Seconds taken by each of *repeat* calls to func, after calling setup (untimed) each time"""
+    runs = []
+    for i in range(repeat):
+        state = setup() if setup is not None else None
+        start = time.time()
+        func(state)
+        runs.append(time.time() - start)
+    return runs
+
+
+def bench_control_plane(sizes, repeat, max_proxies, emit):
+    pool = ProxyPool().start()
+    proxies = [pool.add("stub").instance for i in range(max_proxies)]
+    try:
+        for kind, generate in TOPOLOGIES:
+            for n in sizes:
+                deps = generate(n)
+                start = time.time()
+                app = ApplicationGraph(topology(deps, n, proxies))
+                emit("control", "build_graph", {"topology": kind, "services": n}, [time.time() - start])
+                scenario = gremlins(deps, max(1, n // 10))
+                params = {"topology": kind, "services": n, "gremlins": len(scenario["gremlins"])}
+
+                def fresh(state=None):
+                    fg = FailureGenerator(app)
+                    fg.clear_rules_from_all_proxies()
+                    return fg
+
+                def armed(state=None):
+                    fg = fresh()
+                    for gremlin in scenario["gremlins"]:
+                        fg.setup_failure(**gremlin)
+                    return fg
+
+                def arm(fg):
+                    for gremlin in scenario["gremlins"]:
+                        fg.setup_failure(**gremlin)
+
+                emit("control", "arm_scenarios", params, timed(arm, repeat, fresh))
+                emit("control", "compile_rules", params, timed(lambda fg: fg.compile_rules(), repeat, armed))
+                emit("control", "setup_failures", params,
+                     timed(lambda fg: fg.setup_failures(scenario), repeat, fresh))
+                for parallel, batch in ((False, False), (True, False), (True, True)):
+                    emit("control", "push_rules", dict(params, parallel=parallel, batch=batch),
+                         timed(lambda fg: fg.push_rules(parallel=parallel, batch=batch), repeat, armed))
+
+                def pushed(state=None):
+                    fg = armed()
+                    fg.push_rules(parallel=True, batch=True)
+                    return fg
+                emit("control", "clear_rules_from_all_proxies", params,
+                     timed(lambda fg: fg.clear_rules_from_all_proxies(), repeat, pushed))
+    finally:
+        pool.stop()
+
+
+BENCH_APP = {"services": [{"name": "gateway", "service_proxies": ["gateway:9876"]},
+                          {"name": "A", "service_proxies": ["A:9876"]}, {"name": "B"}, {"name": "C"}],
+             "dependencies": {"gateway": ["A"], "A": ["B", "C"]}}
+
+BENCH_GREMLINS = {"gremlins": [
+    {"scenario": "delay_requests", "source": "A", "dest": "B", "delaytime": "150ms", "delayprobability": 0.2,
+     "headerpattern": "bench-*"},
+    {"scenario": "abort_requests", "source": "A", "dest": "C", "errorcode": 503, "abortprobability": 0.5,
+     "headerpattern": "cb-*"}]}
+
+
+def synthetic_logs(size, seed=0):
+    """
+    Generator of about *size* proxy log entries of a gateway -> A -> (B, C) application, with slow
+    responses of A -> B, 503s, retries and a circuit breaker on A -> C
+    """
+    # Every request entering the application makes about 6 log entries
+    return CorpusGenerator(ApplicationGraph(BENCH_APP), BENCH_GREMLINS, test_id="bench", requests=max(1, size // 6),
+                           rate=200, retries=2, retry_wait="100ms",
+                           circuit_breaker={"closed_attempts": 3, "reset_time": "1s"}, seed=seed)
+
+
+CHECKS = [
+    dict(name="no_proxy_errors"),
+    dict(name="bounded_response_time", source="A", dest="B", max_latency="100ms"),
+    dict(name="http_success_status"),
+    dict(name="http_status", source="A", dest="B", status=200, req_id="req-0"),
+    dict(name="at_most_requests", source="A", dest="B", num_requests=3),
+    dict(name="bounded_retries", source="A", dest="B", retries=2),
+    dict(name="bounded_retries", source="A", dest="B", retries=2, wait_time="100ms"),
+    dict(name="circuit_breaker", source="A", dest="C", closed_attempts=3, reset_time="1s", headerprefix="cb-"),
+]
+
+
+def bench_checks(corpus_sizes, repeat, workdir, emit):
+    for size in corpus_sizes:
+        path = os.path.join(workdir, "logs-%d.jsonl" % size)
+        start = time.time()
+        synthetic_logs(size).write(path)
+        emit("logs", "write_corpus", {"entries": size}, [time.time() - start])
+        start = time.time()
+        store = FileLogStore(path)
+        store.count({"term": {"testid": "bench"}})
+        emit("logs", "index_corpus", {"entries": size}, [time.time() - start])
+        checker = AssertionChecker(None, "bench", backend=store)
+        for check in CHECKS:
+            params = dict(check, entries=size)
+            emit("checks", check["name"], params,
+                 timed(lambda state: checker.check_assertion(all=True, **check), repeat))
+        emit("checks", "bulkhead", {"entries": size},
+             timed(lambda state: checker.check_bulkhead("A", ["B", "C"], "C", 10, all=True), repeat))
+        emit("checks", "check_assertions_fused", {"entries": size},
+             timed(lambda state: checker.check_assertions({"checks": CHECKS}, all=True, fused=True), repeat))
+        store.close()
+
+
+def metadata():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"meta": {"commit": commit, "python": platform.python_version(), "platform": platform.platform(),
+                     "date": datetime.datetime.utcnow().isoformat() + "Z"}}
+
+
+def _key(result):
+    return json.dumps([result["suite"], result["name"], result["params"]], sort_keys=True)
+
+
+def compare(baseline_path, results):
+    with open(baseline_path) as f:
+        baseline = dict((_key(r), r) for r in map(json.loads, f) if "meta" not in r)
+    for result in results:
+        old = baseline.get(_key(result))
+        if old is None:
+            continue
+        print "%-30s %-60s %9.4fs -> %9.4fs  %5.2fx" % (
+            result["name"], json.dumps(result["params"], sort_keys=True)[:60], old["seconds"], result["seconds"],
+            old["seconds"] / result["seconds"] if result["seconds"] else float("inf"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="pygremlin control plane and assertion benchmarks")
+    parser.add_argument("--sizes", default="10,100,1000", help="numbers of services of the synthetic topologies")
+    parser.add_argument("--corpus", default="1000,10000,100000", help="numbers of log entries of the synthetic corpora")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--proxies", type=int, default=50, help="stub proxies shared by the services")
+    parser.add_argument("--output", help="file to write the results to, standard output if not given")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--skip", default="", help="comma separated suites to skip: control, checks")
+    args = parser.parse_args(argv)
+
+    results = []
+    out = open(args.output, "w") if args.output else sys.stdout
+    out.write(json.dumps(metadata()) + "\n")
+
+    def emit(suite, name, params, runs):
+        result = {"suite": suite, "name": name, "params": params, "seconds": min(runs), "runs": runs}
+        results.append(result)
+        out.write(json.dumps(result, sort_keys=True) + "\n")
+        out.flush()
+
+    skip = args.skip.split(",")
+    workdir = tempfile.mkdtemp(prefix="pygremlin-bench-")
+    try:
+        if "control" not in skip:
+            bench_control_plane([int(n) for n in args.sizes.split(",")], args.repeat, args.proxies, emit)
+        if "checks" not in skip:
+            bench_checks([int(n) for n in args.corpus.split(",")], args.repeat, workdir, emit)
+    finally:
+        shutil.rmtree(workdir)
+        if args.output:
+            out.close()
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Microbenchmarks for pygremlin.timeutil against the parsing it replaced:
+the regex-per-call _parse_duration formerly in assertionchecker.py, and isodate.parse_datetime.
+
+usage: bench_timeutil.py [repeat]
+"""
+import sys
+import re
+import timeit
+import datetime
+from collections import defaultdict
+
+import isodate
+
+from pygremlin.timeutil import duration_ns, parse_duration, parse_timestamp, timestamp_ns
+
+
+def legacy_parse_duration(s):
+    r = re.compile(r"(([0-9]*(\.[0-9]*)?)(\D+))", re.UNICODE)
+    start=0
+    m = r.search(s, start)
+    vals = defaultdict(lambda: 0)
+    while m is not None:
+        unit = m.group(4)
+        value = float(m.group(2))
+        if unit == "h":
+            vals["hours"] = value
+        elif unit == 'm':
+            vals["minutes"] = value
+        elif unit == 's':
+            vals["seconds"] = value
+        elif unit == "ms":
+            vals["milliseconds"] = value
+        elif unit == "us":
+            vals["microseconds"] = value
+        start = m.end(1)
+        m = r.search(s, start)
+    return datetime.timedelta(**vals)
+
+
+_epoch = datetime.datetime(1970, 1, 1, tzinfo=isodate.UTC)
+
+def legacy_timestamp_ns(ts):
+    delta = isodate.parse_datetime(ts) - _epoch
+    return ((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds) * 1000
+
+
+DURATIONS = ["10ms", "1s", "1s500ms", "3h", "250us", "12.5ms"]
+TIMESTAMPS = ["2016-03-07T17:29:01.123456Z", "2016-03-07T17:29:01Z",
+              "2016-03-07T17:29:01.5-05:00", "2016-03-07T17:29:01.123456+01:00"]
+
+CASES = [
+    ("duration (legacy _parse_duration)", legacy_parse_duration, DURATIONS),
+    ("duration (timeutil.parse_duration)", parse_duration, DURATIONS),
+    ("duration (timeutil.duration_ns)", duration_ns, DURATIONS),
+    ("timestamp (isodate.parse_datetime)", isodate.parse_datetime, TIMESTAMPS),
+    ("timestamp (timeutil.parse_timestamp)", parse_timestamp, TIMESTAMPS),
+    ("timestamp ns (isodate)", legacy_timestamp_ns, TIMESTAMPS),
+    ("timestamp ns (timeutil.timestamp_ns)", timestamp_ns, TIMESTAMPS),
+]
+
+
+def check():
+    for s in DURATIONS:
+        assert parse_duration(s) == legacy_parse_duration(s), s
+    for ts in TIMESTAMPS:
+        assert parse_timestamp(ts) == isodate.parse_datetime(ts), ts
+        assert timestamp_ns(ts) // 1000 == legacy_timestamp_ns(ts) // 1000, ts
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    check()
+    baseline = {}
+    for name, func, inputs in CASES:
+        seconds = min(timeit.repeat(lambda: [func(x) for x in inputs], number=number, repeat=3))
+        per_call = seconds / (number * len(inputs)) * 1e9
+        kind = name.split(" (")[0]
+        baseline.setdefault(kind, per_call)
+        print "%-40s %9.0f ns/call  %5.1fx" % (name, per_call, baseline[kind] / per_call)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,3 +3,8 @@
 from .failuregenerator import *
 from .assertionchecker import *
 from .applicationgraph import *
+from .asyncfailuregenerator import *
+from .logstore import *
+from .streamingassertionchecker import *
+from .loadgenerator import *
+from .corpusgenerator import *
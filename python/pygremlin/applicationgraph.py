@@ -1,7 +1,143 @@
 # coding=utf-8
 from collections import defaultdict
+from array import array
 import networkx as nx
 
+
+class _GraphIndex(object):
+    """
+    Frozen adjacency index over an application graph. Services are interned to
+    integer ids (their position in names); forward and reverse adjacency are
+    stored in compressed arrays (offsets into a flat array of target ids), with
+    per-service tuples of names prebuilt for lookups.
+    """
+
+    def __init__(self, graph):
+        self.names = tuple(graph.nodes())
+        self.ids = dict((name, i) for i, name in enumerate(self.names))
+        self.fwd_offsets, self.fwd_targets = self._compress(graph.successors)
+        self.rev_offsets, self.rev_targets = self._compress(graph.predecessors)
+        self.dependencies = self._expand(self.fwd_offsets, self.fwd_targets)
+        self.dependents = self._expand(self.rev_offsets, self.rev_targets)
+        self._downstream = None
+        self._upstream = None
+        self._closures = {}
+
+    def _compress(self, neighbors):
+        offsets = array('i', [0])
+        targets = array('i')
+        for name in self.names:
+            targets.extend(self.ids[n] for n in neighbors(name))
+            offsets.append(len(targets))
+        return offsets, targets
+
+    def _expand(self, offsets, targets):
+        return tuple(tuple(self.names[t] for t in targets[offsets[i]:offsets[i + 1]])
+                     for i in range(len(self.names)))
+
+    def _components(self):
+        """
+        Strongly connected components (iterative Tarjan), in reverse topological order:
+        every component comes after all components it has edges to.
+        Returns (component id of each service, list of member ids per component)
+        """
+        n = len(self.names)
+        offsets, targets = self.fwd_offsets, self.fwd_targets
+        order = [-1] * n
+        low = [0] * n
+        comp = [-1] * n
+        members = []
+        stack = []
+        counter = 0
+        for root in range(n):
+            if order[root] != -1:
+                continue
+            work = [(root, offsets[root])]
+            order[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            while work:
+                v, pos = work[-1]
+                if pos < offsets[v + 1]:
+                    work[-1] = (v, pos + 1)
+                    w = targets[pos]
+                    if order[w] == -1:
+                        order[w] = low[w] = counter
+                        counter += 1
+                        stack.append(w)
+                        work.append((w, offsets[w]))
+                    elif comp[w] == -1:
+                        low[v] = min(low[v], order[w])
+                    continue
+                work.pop()
+                if work:
+                    u = work[-1][0]
+                    low[u] = min(low[u], low[v])
+                if low[v] == order[v]:
+                    c = len(members)
+                    members.append([])
+                    while True:
+                        w = stack.pop()
+                        comp[w] = c
+                        members[c].append(w)
+                        if w == v:
+                            break
+        return comp, members
+
+    def _reachability(self):
+        """
+        Transitive closure as one bitset (int) per service, computed on the component
+        condensation: all services in a component share their reachable set.
+        """
+        comp, members = self._components()
+        mbits = [sum(1 << v for v in m) for m in members]
+        down = [0] * len(members)
+        for c, m in enumerate(members):
+            bits = mbits[c] if len(m) > 1 else 0
+            for v in m:
+                for w in self.fwd_targets[self.fwd_offsets[v]:self.fwd_offsets[v + 1]]:
+                    d = comp[w]
+                    if d != c:
+                        bits |= mbits[d] | down[d]
+            down[c] = bits
+        up = [0] * len(members)
+        for c in reversed(range(len(members))):
+            m = members[c]
+            bits = mbits[c] if len(m) > 1 else 0
+            for v in m:
+                for w in self.rev_targets[self.rev_offsets[v]:self.rev_offsets[v + 1]]:
+                    d = comp[w]
+                    if d != c:
+                        bits |= mbits[d] | up[d]
+            up[c] = bits
+        self._downstream = [down[comp[v]] & ~(1 << v) for v in range(len(self.names))]
+        self._upstream = [up[comp[v]] & ~(1 << v) for v in range(len(self.names))]
+
+    def downstream_bits(self, i):
+        if self._downstream is None:
+            self._reachability()
+        return self._downstream[i]
+
+    def upstream_bits(self, i):
+        if self._upstream is None:
+            self._reachability()
+        return self._upstream[i]
+
+    def decode(self, bits, memoize=True):
+        """frozenset of the service names set in bits"""
+        names = self._closures.get(bits)
+        if names is None:
+            ids = []
+            b = bits
+            while b:
+                lowest = b & -b
+                ids.append(lowest.bit_length() - 1)
+                b ^= lowest
+            names = frozenset(self.names[i] for i in ids)
+            if memoize:
+                self._closures[bits] = names
+        return names
+
 class ApplicationGraph(object):
     """Represent the topology of an application to be tested by Gremlin"""
 
@@ -27,6 +163,7 @@ class ApplicationGraph(object):
         assert model is None or isinstance(model, dict)
 
         self._graph = nx.DiGraph()
+        self._index = None
         self.debug = debug
 
         if model:
@@ -43,24 +180,61 @@ class ApplicationGraph(object):
         if service_proxies is None:
             service_proxies = []
         self._graph.node[name]['instances'] = service_proxies
+        self._index = None
 
     def add_dependency(self, fromS, toS):
         self._graph.add_path([fromS, toS])
+        self._index = None
+
+    def _get_index(self):
+        """Adjacency index, rebuilt on first use after the graph changes"""
+        if self._index is None:
+            self._index = _GraphIndex(self._graph)
+        return self._index
 
     def get_dependents(self, service):
-        dservices = []
-        for e in self._graph.in_edges(service):
-            dservices.append(e[0])
-        return dservices
+        """Services that call service, as a new list"""
+        index = self._get_index()
+        return list(index.dependents[index.ids[service]])
 
     def get_dependencies(self, service):
-        dservices = []
-        for e in self._graph.out_edges(service):
-            dservices.append(e[0])
-        return dservices
+        """Services called by service, as a new list"""
+        index = self._get_index()
+        return list(index.dependencies[index.ids[service]])
 
     def get_services(self):
-        return self._graph.nodes()
+        return list(self._get_index().names)
+
+    def upstream_closure(self, service):
+        """
+        All services that transitively call service (e.g. up to the gateway), as a frozenset
+        not including service itself
+        """
+        index = self._get_index()
+        return index.decode(index.upstream_bits(index.ids[service]))
+
+    def downstream_closure(self, service):
+        """
+        All services transitively called by service, as a frozenset
+        not including service itself
+        """
+        index = self._get_index()
+        return index.decode(index.downstream_bits(index.ids[service]))
+
+    def blast_radius(self, services):
+        """
+        Services affected when all of the given services fail: the failed services themselves
+        and everything upstream of them, as a frozenset
+        """
+        index = self._get_index()
+        bits = 0
+        for service in services:
+            i = index.ids[service]
+            bits |= (1 << i) | index.upstream_bits(i)
+        return index.decode(bits, memoize=False)
+
+    def has_service(self, service):
+        return service in self._get_index().ids
 
     def get_service_instances(self, service):
         if 'instances' in self._graph.node[service]:
@@ -2,12 +2,12 @@
 # -*- coding: utf-8 -*-
 import json
 
-from elasticsearch import Elasticsearch
 import datetime
-import pprint
 import warnings
-import isodate
 import sys
+import copy
+import threading
+from multiprocessing.pool import ThreadPool
 
 import re
 from collections import defaultdict, namedtuple
@@ -15,75 +15,224 @@ import datetime
 import time
 from __builtin__ import dict
 
+from .hitindex import HitIndex
+from .instrumentation import SpanSink, add_sink, remove_sink, span
+from .logframe import LogFrame
+from .logstore import ElasticsearchStore, _filtered, _match
+from .timeutil import duration_ns, parse_duration, timedelta_ns, timestamp_ns
+
 GremlinTestResult = namedtuple('GremlinTestResult', ['success','errormsg'])
-AssertionResult = namedtuple('AssertionResult', ['name','info','success','errormsg'])
 
-max_query_results = 2**31-1
 
-def _parse_duration(s):
-    r = re.compile(r"(([0-9]*(\.[0-9]*)?)(\D+))", re.UNICODE)
-    start=0
-    m = r.search(s, start)
-    vals = defaultdict(lambda: 0)
-    while m is not None:
-        unit = m.group(4)
-        try:
-            value = float(m.group(2))
-        except ValueError:
-            print(s, unit, m.group(2))
-            return datetime.timedelta()
-        if unit == "h":
-            vals["hours"] = value
-        elif unit == 'm':
-            vals["minutes"] = value
-        elif unit == 's':
-            vals["seconds"] = value
-        elif unit == "ms":
-            vals["milliseconds"] = value
-        elif unit == "us" or unit == "µs":
-            vals["microseconds"] = value
-        else:
-            raise("Unknown time unit")
-        start = m.end(1)
-        m = r.search(s, start)
-    return datetime.timedelta(**vals)
+class AssertionResult(namedtuple('AssertionResult', ['name','info','success','errormsg'])):
+    """
+    Outcome of a check. AssertionChecker.check_assertion sets its cost attribute to the CheckCost
+    of the check when the checker profiles; it is None otherwise, and it is not part of the tuple
+    """
+    cost = None
+
+
+#Where the time of a check went, in ns: reading logs from the store (for elasticsearch, the round
+#trips minus decoding their responses), decoding responses, and evaluating the check on the logs
+CheckCost = namedtuple('CheckCost', ['total_ns', 'query_ns', 'parse_ns', 'eval_ns', 'queries', 'hits', 'bytes'])
+
+#Checks that only look at the logs of a single source -> dest edge
+_edge_checks = frozenset(['bounded_response_time', 'http_status', 'at_most_requests',
+                          'bounded_retries', 'circuit_breaker'])
 
 def _since(timestamp):
     return time.time()-timestamp
 
-def _check_value_recursively(key, val, haystack):
+def _last_of_runs(seq, key):
     """
-    Check if there is key _key_ with value _val_ in the given dictionary.
-    ..warning:
-        This is geared at JSON dictionaries, so some corner cases are ignored,
-        we assume all iterables are either arrays or dicts
+    Out of the iterable *seq*, yield only the last element of each run of
+    consecutive elements with the same *key*
     """
-    if isinstance(haystack, list):
-        return any([_check_value_recursively(key, val, l) for l in haystack])
-    elif isinstance(haystack, dict):
-        if not key in haystack:
-            return any([_check_value_recursively(key, val, d) for k, d in haystack.items()
-                        if isinstance(d, list) or isinstance(d, dict)])
-        else:
-            return haystack[key] == val
-    else:
-        return False
+    prev = None
+    for x in seq:
+        if prev is not None and key(prev) != key(x):
+            yield prev
+        prev = x
+    if prev is not None:
+        yield prev
+
+
+def _cb_event(log):
+    """The fields of a log entry the circuit breaker state machine looks at, as a tuple"""
+    request = log["msg"] == "Request"
+    actions = log.get("actions") or []
+    return (timestamp_ns(log["ts"]), request, log.get("status"), len(actions) > 0, "abort" in actions)
 
 
-def _get_by(key, val, l):
+class _CircuitBreaker(object):
     """
-    Out of list *l* return all elements that have *key=val*
-    This comes in handy when you are working with aggregated/bucketed queries
+    Expected circuit breaker state of a source service, driven by its Request/Response
+    log events in timestamp order. Trips open after more than closed_attempts failures,
+    goes half-open after reset_time, and closes again after more than halfopen_attempts successes
     """
-    return [x for x in l if _check_value_recursively(key, val, x)]
 
+    def __init__(self, closed_attempts, reset_time, halfopen_attempts=1, debug=False):
+        self.closed_attempts = closed_attempts
+        self.reset_time = duration_ns(reset_time)
+        self.halfopen_attempts = halfopen_attempts
+        self.debug = debug
+        self.mode = "closed"
+        self.failures = 0
+        self.successes = 0
+        self.open_ts = None
+
+    def feed(self, event):
+        """
+        Advance the state machine by one event (see _cb_event). Returns the time in ns since
+        the circuit opened if the event is a request issued while it should have been open, else None
+        """
+        ts, request, status, faulted, aborted = event
+        if self.mode == "open":
+            req_spacing = ts - self.open_ts
+            # Restore to half-open
+            if req_spacing >= self.reset_time:
+                if self.debug:
+                    print "%d: open -> half-open" % (self.failures + 1)
+                self.mode = "half-open"
+                self.open_ts = None
+                self.failures = 0
+            elif request:
+                # this is an assertion fail, no requests in open state
+                if self.debug:
+                    print "%d: open -> failure" % (self.failures + 1)
+                return req_spacing
+        if self.mode == "half-open":
+            if (not request and status != 200) or (request and aborted):
+                if self.debug:
+                    print "half-open -> open"
+                self.mode = "open"
+                self.open_ts = ts
+                self.successes = 0
+            elif not request and status == 200:
+                self.successes += 1
+                if self.debug:
+                    print "half-open -> half-open (%d)" % self.successes
+                # If over threshold, return to closed state
+                if self.successes > self.halfopen_attempts:
+                    if self.debug:
+                        print "half-open -> closed"
+                    self.mode = "closed"
+                    self.failures = 0
+        elif self.mode == "closed":
+            if (not request and status != 200) or (request and faulted):
+                self.failures += 1
+                if self.debug:
+                    print "%d: closed->closed" % self.failures
+                # Trip CB, go to open state
+                if self.failures > self.closed_attempts:
+                    if self.debug:
+                        print "%d: closed->open" % self.failures
+                    self.mode = "open"
+                    self.open_ts = ts
+                    self.successes = 0
+        return None
+
+
+class _Violations(object):
+    """
+    Collects the violations found by a check. The first violation is reported;
+    with all set, evaluation carries on to count the rest
+    """
+
+    def __init__(self, all=False, debug=False):
+        self.all = all
+        self.debug = debug
+        self.count = 0
+        self.errormsg = ""
+
+    def add(self, errormsg):
+        """Record a violation, returns True if evaluation should stop"""
+        self.count += 1
+        if self.count == 1:
+            self.errormsg = errormsg
+        if self.debug:
+            print errormsg
+        return not self.all
+
+    def result(self, hits):
+        """GremlinTestResult for a check that looked at *hits* log entries"""
+        if hits == 0:
+            return GremlinTestResult(False, "No log entries found")
+        if self.count > 1:
+            return GremlinTestResult(False, "{} ({} violations)".format(self.errormsg, self.count))
+        return GremlinTestResult(self.count == 0, self.errormsg)
 
-def _get_by_id(ID, l):
+
+class _CostMeter(SpanSink):
     """
-    A convenience wrapper over _get_by
-    that fetches things based on the "reqID" field
+    Adds up the log store spans ending on a thread into the cost of the check running on it.
+    Registered as a span sink for as long as any check is being measured
     """
-    return _get_by("reqID", ID, l)
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._measuring = 0
+
+    def on_end(self, span):
+        counts = getattr(self._local, "counts", None)
+        if counts is None:
+            return
+        if span.name == "es.parse":
+            counts["parse_ns"] += span.duration_ns
+            counts["bytes"] += span.attributes.get("bytes", 0)
+            return
+        if span.name.startswith("es.") or span.name in ("sqlite.count", "sqlite.group_count"):
+            counts["query_ns"] += span.duration_ns
+        elif span.name in ("file.scan", "sqlite.scan"):
+            counts["query_ns"] += span.attributes["busy_ns"]
+        else:
+            return
+        counts["queries"] += 1
+        counts["hits"] += span.attributes.get("hits", 0)
+
+    def start(self):
+        with self._lock:
+            if self._measuring == 0:
+                add_sink(self)
+            self._measuring += 1
+        self._local.counts = defaultdict(int)
+        self._local.start = time.time()
+
+    def stop(self):
+        """CheckCost of what ran on this thread since start"""
+        total = int((time.time() - self._local.start) * 1e9)
+        counts, self._local.counts = self._local.counts, None
+        with self._lock:
+            self._measuring -= 1
+            if self._measuring == 0:
+                remove_sink(self)
+        # Decoding happens within the elasticsearch round trips
+        query = counts["query_ns"] - counts["parse_ns"]
+        return CheckCost(total, query, counts["parse_ns"], max(0, total - query - counts["parse_ns"]),
+                         counts["queries"], counts["hits"], counts["bytes"])
+
+
+_cost_meter = _CostMeter()
+
+
+def cost_report(results, top=None):
+    """
+    Table of the checks in *results* (AssertionResults with a cost) from the most expensive down,
+    with where their time went and how many log entries they fetched
+    @param top: number of checks to list, all by default
+    """
+    costed = sorted([r for r in results if r.cost is not None], key=lambda r: -r.cost.total_ns)
+    total = sum(r.cost.total_ns for r in costed) or 1
+    lines = ["%-24s %9s %6s %9s %9s %9s %7s %9s %11s  %s" % (
+        "check", "total", "share", "query", "parse", "eval", "queries", "hits", "bytes", "info")]
+    for r in costed[:top]:
+        c = r.cost
+        lines.append("%-24s %8.3fs %5.1f%% %8.3fs %8.3fs %8.3fs %7d %9d %11d  %s" % (
+            r.name[:24], c.total_ns / 1e9, 100.0 * c.total_ns / total, c.query_ns / 1e9, c.parse_ns / 1e9,
+            c.eval_ns / 1e9, c.queries, c.hits, c.bytes, r.info))
+    lines.append("%d checks in %.3fs" % (len(costed), sum(r.cost.total_ns for r in costed) / 1e9))
+    return "\n".join(lines)
 
 
 class AssertionChecker(object):
@@ -92,14 +241,38 @@ class AssertionChecker(object):
     The asssertion checker
     """
 
-    def __init__(self, host, test_id, debug=False):
+    def __init__(self, host, test_id, debug=False, page_size=1000, scroll="1m",
+                 aggregate=True, duration_field=None, max_offenders=5, backend=None, profile=False):
         """
-        param host: the elasticsearch host
+        param host: the elasticsearch host. Ignored when a backend is given
         test_id: id of the test to which we are reqstricting the queires
+        page_size: number of log entries fetched per round trip to elasticsearch
+        scroll: how long elasticsearch keeps a scroll context alive between two pages
+        aggregate: let check_assertion evaluate checks with aggregation-only queries where possible (see plans)
+        duration_field: numeric field holding the response duration in milliseconds, if the logs have one.
+                        Needed to evaluate bounded_response_time in elasticsearch
+        max_offenders: number of worst offending log entries or request ids fetched by aggregated checks
+        backend: LogStore to read the logs from, e.g. a FileLogStore over local proxy log files.
+                 Defaults to an ElasticsearchStore on host
+        profile: measure the cost of each check, see AssertionResult.cost and cost_report. Off by default:
+                 while any check is measured, every span is recorded, on all threads
+        Call close() once done to stop the threads of check_assertions(parallel=True)
         """
-        self._es = Elasticsearch(host)
+        self._store = backend if backend is not None else ElasticsearchStore(host, page_size=page_size, scroll=scroll)
         self._id = test_id
         self.debug=debug
+        self.page_size = page_size
+        self.scroll = scroll
+        self.aggregate = aggregate
+        self.duration_field = duration_field
+        self.max_offenders = max_offenders
+        self.profile = profile
+        # Prefetched edge log slices, (source, dest) -> hits sorted by ts. Only set on the
+        # private copies check_assertions(fused=True) evaluates with
+        self._slices = None
+        self._pool = None
+        self._pool_size = None
+        self._pool_lock = threading.Lock()
         self.functiondict = {
             'no_proxy_errors' : self.check_no_proxy_errors,
             'bounded_response_time' : self.check_bounded_response_time,
@@ -110,130 +283,113 @@ class AssertionChecker(object):
             'circuit_breaker' : self.check_circuit_breaker,
             'at_most_requests': self.check_at_most_requests
         }
+        # Query planner: checks that can be compiled to an aggregation-only query.
+        # A plan returns None when the given arguments need the full log stream
+        self.plans = {
+            'no_proxy_errors' : self._plan_no_proxy_errors,
+            'bounded_response_time' : self._plan_bounded_response_time,
+            'http_success_status' : self._plan_http_success_status,
+            'http_status' : self._plan_http_status,
+            'bounded_retries' : self._plan_bounded_retries,
+            'at_most_requests': self._plan_at_most_requests
+        }
+
+    def _edge_filter(self, source, dest, *clauses):
+        """Filter on log entries of this test between source and dest, plus any extra clauses"""
+        must = [{"term": {"source": source}},
+                {"term": {"dest": dest}},
+                {"term": {"testid": self._id}}]
+        must.extend(clauses)
+        return {"bool": {"must": must}}
 
-    def _check_non_zero_results(self, data):
+    def _edge_hits(self, source, dest, clauses, sort=False):
         """
-        Checks wheter the output we got from elasticsearch is empty or not
+        Log entries of this test between source and dest that match all of *clauses*, sorted on ts
+        if asked to. Served from the prefetched slice for the edge, if there is one
         """
-        return data["hits"]["total"] != 0 and len(data["hits"]["hits"]) != 0
+        if self._slices is not None and (source, dest) in self._slices:
+            index = self._slices[(source, dest)]
+            # Narrow down to the hits of the first clause that can be served from the hash index
+            for i, clause in enumerate(clauses):
+                kind, spec = clause.items()[0]
+                if kind in ("term", "terms") and index.indexed("_source." + spec.keys()[0]):
+                    field, value = spec.items()[0]
+                    rows = index.rows_in("_source." + field, value if kind == "terms" else [value])
+                    rest = clauses[:i] + clauses[i + 1:]
+                    return (index.hits[row] for row in rows
+                            if all(_match(c, index.hits[row]['_source']) for c in rest))
+            return (hit for hit in index if all(_match(c, hit['_source']) for c in clauses))
+        return self._store.scan(self._edge_filter(source, dest, *clauses), sort="ts" if sort else None)
+
+    def _fetch_slices(self, edges):
+        """
+        Fetch all log entries of this test for each (source, dest) edge, sorted by ts, in as few
+        round trips as the backend allows. Each slice is a HitIndex on msg and reqID
+        """
+        slices = {}
+        for edge, hits in zip(edges, self._store.fetch_slices([self._edge_filter(*edge) for edge in edges])):
+            slices[edge] = HitIndex(hits, keys=("_source.msg", "_source.reqID"))
+            if self.debug:
+                print 'Fetched %d log entries for %s -> %s' % (len(slices[edge]), edge[0], edge[1])
+        return slices
+
+    def _with_slices(self, slices):
+        """A copy of this checker that serves the checks on the edges of *slices* from them"""
+        checker = copy.copy(self)
+        checker._slices = slices
+
+        # The dispatch tables hold methods bound to self: bind them to the copy instead
+        def rebind(f):
+            return f.__func__.__get__(checker, type(checker)) if getattr(f, "__self__", None) is self else f
+
+        checker.functiondict = dict((name, rebind(f)) for name, f in self.functiondict.items())
+        checker.plans = dict((name, rebind(f)) for name, f in self.plans.items())
+        return checker
 
     #was ProxyErrorsBad
     def check_no_proxy_errors(self, **kwargs):
         """
         Helper method to determine if the proxies logged any major errors related to the functioning of the proxy itself
         """
-        data = self._es.search(body={
-            "size": max_query_results,
-            "query": {
-                "filtered": {
-                    "query": {
-                        "match_all": {}
-                    },
-                    "filter": {
-                        "term": {
-                            "level": "error"
-                        }
-                    }
-                }
-            }
-        })
-#        if self.debug:
-#            print(data)
-        return GremlinTestResult(data["hits"]["total"] == 0, data)
+        for hit in self._store.scan({"term": {"level": "error"}}):
+            return GremlinTestResult(False, str(hit['_source']))
+        return GremlinTestResult(True, "")
 
     #was ProxyErrors
     def get_requests_with_errors(self):
-        """ Helper method to determine if proxies logged any error related to the requests passing through"""
-        data = self._es.search(body={
-            "size": max_query_results,
-            "query": {
-                "filtered": {
-                    "query": {
-                        "match_all": {}
-                    },
-                    "filter": {
-                        "exists": {
-                            "field": "errmsg"
-                        }
-                    }
-                }
-            }
-        })
-        return GremlinTestResult(False, data)
+        """ Helper method to determine if proxies logged any error related to the requests passing through.
+        The errormsg of the result is an iterator over the log entries with errors"""
+        return GremlinTestResult(False, self._store.scan({"exists": {"field": "errmsg"}}))
 
     def check_bounded_response_time(self, **kwargs):
         assert 'source' in kwargs and 'dest' in kwargs and 'max_latency' in kwargs
         dest = kwargs['dest']
         source = kwargs['source']
-        max_latency = _parse_duration(kwargs['max_latency'])
-        data = self._es.search(body={
-            "size": max_query_results,
-            "query": {
-                "filtered": {
-                    "query": {
-                        "match_all": {}
-                    },
-                    "filter": {
-                        "bool": {
-                            "must": [
-                                {"term": {"msg": "Response"}},
-                                {"term": {"source": source}},
-                                {"term": {"dest": dest}},
-                                {"term": {"testid": self._id}}
-                            ]
-                        }
-                    }
-                }
-            }
-        })
-        if self.debug:
-            pprint.pprint(data)
-
-        result = True
-        errormsg = ""
-        if not self._check_non_zero_results(data):
-            result = False
-            errormsg = "No log entries found"
-            return GremlinTestResult(result, errormsg)
-
-        for message in data["hits"]["hits"]:
-            if _parse_duration(message['_source']["duration"]) > max_latency:
-                result = False
+        max_latency = timedelta_ns(parse_duration(kwargs['max_latency']))
+        violations = _Violations(kwargs.get('all', False), self.debug)
+        hits = 0
+        # Compare durations a page at a time, so that the first slow page ends the check
+        for frame in LogFrame.batches(self._edge_hits(source, dest, [{"term": {"msg": "Response"}}]),
+                                      self.page_size, keys=("reqID",), durations=True):
+            hits += len(frame)
+            for row in frame.exceeding("duration", max_latency):
                 # Request ID from service did not
-                errormsg = "{} did not reply in time for request {}, {}".format(
-                    dest, message['_source']["reqID"], message['_source']["duration"])
-                if self.debug:
-                    print errormsg
-        return GremlinTestResult(result, errormsg)
+                if violations.add("{} did not reply in time for request {}, {}ms".format(
+                        dest, frame.value("reqID", row), frame.duration[row] / 1e6)):
+                    return violations.result(hits)
+        return violations.result(hits)
 
     def check_http_success_status(self, **kwargs):
-        data = self._es.search(body={
-            "size": max_query_results,
-            "query": {
-                "filtered": {
-                    "query": {
-                        "match_all": {}
-                    },
-                    "filter": {
-                        "exists": {
-                            "field": "status"
-                        }
-                    }
-                }
-            }})
-        result = True
-        errormsg = ""
-        if not self._check_non_zero_results(data):
-            result = False
-            errormsg = "No log entries found"
-            return GremlinTestResult(result, errormsg)
-
-        for message in data["hits"]["hits"]:
+        violations = _Violations(kwargs.get('all', False), self.debug)
+        hits = 0
+        for message in self._store.scan({"exists": {"field": "status"}}):
+            hits += 1
             if message['_source']["status"] != 200:
-                if self.debug:
-                    print(message['_source'])
-                result = False
-        return GremlinTestResult(result, errormsg)
+                if violations.add("{} -> {} - request {} returned status {}".format(
+                        message['_source'].get("source"), message['_source'].get("dest"),
+                        message['_source'].get("reqID"), message['_source']["status"])):
+                    break
+        return violations.result(hits)
 
     ##check if the interaction between a given pair of services resulted in the required response status
     def check_http_status(self, **kwargs):
@@ -242,41 +398,17 @@ class AssertionChecker(object):
         dest = kwargs['dest']
         status = kwargs['status']
         req_id = kwargs['req_id']
-        data = self._es.search(body={
-            "size": max_query_results,
-            "query": {
-                "filtered": {
-                    "query": {
-                        "match_all": {}
-                    },
-                    "filter": {
-                        "bool" : {
-                            "must": [
-                                {"term": {"msg": "Response"}},
-                                {"term": {"source": source}},
-                                {"term": {"dest": dest}},
-                                {"term": {"req_id": req_id}},
-                                {"term": {"protocol" : "http"}},
-                                {"term": {"testid": self._id}}
-                            ]
-                        }
-                    }
-                }
-            }})
-
-        result = True
-        errormsg = ""
-        if not self._check_non_zero_results(data):
-            result = False
-            errormsg = "No log entries found"
-            return GremlinTestResult(result, errormsg)
-
-        for message in data["hits"]["hits"]:
+        violations = _Violations(kwargs.get('all', False), self.debug)
+        hits = 0
+        for message in self._edge_hits(source, dest, [{"term": {"msg": "Response"}},
+                                                       {"term": {"req_id": req_id}},
+                                                       {"term": {"protocol" : "http"}}]):
+            hits += 1
             if message['_source']["status"] != status:
-                if self.debug:
-                    print(message['_source'])
-                result = False
-        return GremlinTestResult(result, errormsg)
+                if violations.add("{} -> {} - expected status {}, but found {} for request {}".format(
+                        source, dest, status, message['_source']["status"], req_id)):
+                    break
+        return violations.result(hits)
 
     def check_at_most_requests(self, source, dest, num_requests, **kwargs):
         """
@@ -291,60 +423,21 @@ class AssertionChecker(object):
         if self.debug:
             print 'in check_at_most_requests (%s, %s, %s, %s)' % (source, dest, num_requests, self._id)
 
-        # Fetch requests for src->dst
-        data = self._es.search(body={
-            "size": max_query_results,
-            "query": {
-                "filtered": {
-                    "query": {
-                        "match_all": {}
-                    },
-                    "filter": {
-                        "bool": {
-                            "must": [
-                                {"term": {"msg": "Request"}},
-                                {"term": {"source": source}},
-                                {"term": {"dest": dest}},
-                                {"term": {"protocol": "http"}},
-                                {"term": {"testid": self._id}}
-                            ]
-                        }
-                    }
-                }
-            },
-            "aggs": {
-                # Need size, otherwise only top buckets are returned
-                #"size": max_query_results,
-                "byid": {
-                    "terms": {
-                        "field": "reqID",
-                    }
-                }
-            }
-        })
-
-        if self.debug:
-            pprint.pprint(data)
-
-        result = True
-        errormsg = ""
-        if not self._check_non_zero_results(data):
-            result = False
-            errormsg = "No log entries found"
-            return GremlinTestResult(result, errormsg)
-
-        # Check number of requests in each bucket
-        for bucket in data["aggregations"]["byid"]["buckets"]:
-            if bucket["doc_count"] > (num_requests + 1):
-                errormsg = "{} -> {} - expected {} requests, but found {} "\
-                         "requests for id {}".format(
-                            source, dest, num_requests, bucket['doc_count'] - 1,
-                            bucket['key'])
-                result = False
-                if self.debug:
-                    print errormsg
-                return GremlinTestResult(result, errormsg)
-        return GremlinTestResult(result, errormsg)
+        # Count requests for src->dst by request id as they stream in
+        violations = _Violations(kwargs.get('all', False), self.debug)
+        counts = defaultdict(int)
+        hits = 0
+        for message in self._edge_hits(source, dest, [{"term": {"msg": "Request"}},
+                                                       {"term": {"protocol": "http"}}]):
+            hits += 1
+            req_id = message['_source']["reqID"]
+            counts[req_id] += 1
+            # Report each request id once, when it first goes over the limit
+            if counts[req_id] == num_requests + 2:
+                if violations.add("{} -> {} - expected {} requests, but found more than {} "
+                                  "requests for id {}".format(source, dest, num_requests, num_requests, req_id)):
+                    break
+        return violations.result(hits)
 
     def check_bounded_retries(self, **kwargs):
         assert 'source' in kwargs and 'dest' in kwargs and 'retries' in kwargs
@@ -354,233 +447,89 @@ class AssertionChecker(object):
         wait_time = kwargs.pop('wait_time', None)
         errdelta = kwargs.pop('errdelta', datetime.timedelta(milliseconds=10))
         by_uri = kwargs.pop('by_uri', False)
+        key = "reqID" if not by_uri else "uri"
 
         if self.debug:
             print 'in bounded retries (%s, %s, %s)' % (source, dest, retries)
-
-        data = self._es.search(body={
-            "size": max_query_results,
-            "query": {
-                "filtered": {
-                    "query": {
-                        "match_all": {}
-                    },
-                    "filter": {
-                        "bool": {
-                            "must": [
-                                {"term": {"source": source}},
-                                {"term": {"msg": "Request"}},
-                                {"term": {"dest": dest}},
-                                {"term": {"testid": self._id}}
-                            ]
-                        }
-                    }
-                }
-            },
-            "aggs": {
-                "byid": {
-                    "terms": {
-                        "field": "reqID" if not by_uri else "uri",
-                    }
-                }
-            }
-        })
-
-        if self.debug:
-            pprint.pprint(data)
-
-        result = True
-        errormsg = ""
-        if not self._check_non_zero_results(data):
-            result = False
-            errormsg = "No log entries found"
-            return GremlinTestResult(result, errormsg)
+        violations = _Violations(kwargs.get('all', False), self.debug)
+        frame = LogFrame(self._edge_hits(source, dest, [{"term": {"msg": "Request"}}]), keys=(key,))
+        if len(frame) == 0:
+            return violations.result(0)
 
         # Check number of req first
-        for bucket in data["aggregations"]["byid"]["buckets"]:
-            if bucket["doc_count"] > (retries + 1):
-                errormsg = "{} -> {} - expected {} retries, but found {} retries for request {}".format(
-                    source, dest, retries, bucket['doc_count']-1, bucket['key'])
-                result = False
-                if self.debug:
-                    print errormsg
-                return GremlinTestResult(result, errormsg)
+        for code, count in enumerate(frame.counts(key)):
+            if count > retries + 1:
+                if violations.add("{} -> {} - expected {} retries, but found {} retries for request {}".format(
+                        source, dest, retries, count - 1, frame.categories[key][code])):
+                    return violations.result(len(frame))
         if wait_time is None:
-            return GremlinTestResult(result, errormsg)
- 
-        wait_time = _parse_duration(wait_time)
-        # Now we have to check the timestamps
-        for bucket in data["aggregations"]["byid"]["buckets"]:
-            req_id = bucket["key"]
-            req_seq = _get_by_id(req_id, data["hits"]["hits"])
-            req_seq.sort(key=lambda x: isodate.parse_datetime(x['_source']["ts"]))
-            for i in range(len(req_seq) - 1):
-                observed = isodate.parse_datetime(
-                    req_seq[i + 1]['_source']["ts"]) - isodate.parse_datetime(req_seq[i]['_source']["ts"])
-                if not (((wait_time - errdelta) <= observed) or (observed <= (wait_time + errdelta))):
-                    errormsg = "{} -> {} - expected {}+/-{}ms spacing for retry attempt {}, but request {} had a spacing of {}ms".format(
-                        source, dest, wait_time, errdelta.microseconds/1000, i+1, req_id, observed.microseconds/1000)
-                    result = False
-                    if self.debug:
-                        print errormsg
+            return violations.result(len(frame))
+
+        # Now we have to check the spacing between attempts of the same request
+        wait_time = timedelta_ns(parse_duration(wait_time))
+        errdelta = timedelta_ns(errdelta)
+        codes, attempts, spacings = frame.group_spacing(key)
+        for i in range(len(spacings)):
+            if not ((wait_time - errdelta) <= spacings[i] <= (wait_time + errdelta)):
+                if violations.add("{} -> {} - expected {}+/-{}ms spacing for retry attempt {}, but request {} had a spacing of {}ms".format(
+                        source, dest, wait_time / 1e6, errdelta / 1e6, attempts[i], frame.categories[key][codes[i]],
+                        spacings[i] / 1e6)):
                     break
-        return GremlinTestResult(result, errormsg)
+        return violations.result(len(frame))
 
     #remove_retries is a boolean argument. Set to true if reties are attempted inside circuit breaker logic, else set to false
     def check_circuit_breaker(self, **kwargs): #dest, closed_attempts, reset_time, halfopen_attempts):
         assert 'dest' in kwargs and 'source' in kwargs and 'closed_attempts' in kwargs and 'reset_time' in kwargs and 'headerprefix' in kwargs
 
-        dest = kwargs['dest']
-        source = kwargs['source']
-        closed_attempts = kwargs['closed_attempts']
-        reset_time = kwargs['reset_time']
-        headerprefix = kwargs['headerprefix']
-        if 'halfopen_attempts' not in kwargs:
-            halfopen_attempts = 1
-        else:
-            halfopen_attempts = kwargs['halfopen_attempts']
-        if 'remove_retries' not in kwargs:
-            remove_retries = False
-        else:
-            remove_retries = kwargs['remove_retries']
-
+        config = {
+            'closed_attempts': kwargs['closed_attempts'],
+            'reset_time': kwargs['reset_time'],
+            'halfopen_attempts': kwargs.get('halfopen_attempts', 1)
+        }
+        return self.check_circuit_breakers(kwargs['source'], kwargs['dest'], kwargs['headerprefix'], [config],
+                                           remove_retries=kwargs.get('remove_retries', False),
+                                           all=kwargs.get('all', False))[0]
 
+    def check_circuit_breakers(self, source, dest, headerprefix, configs, remove_retries=False, all=False):
+        """
+        Check several circuit breaker configurations against the same logs, in a single pass.
+        Useful to sweep thresholds and reset times over one captured test.
+        :param configs list of dicts with closed_attempts, reset_time and optionally halfopen_attempts
+        :param remove_retries set to true if retries are attempted inside circuit breaker logic
+        :return list of GremlinTestResult, one per configuration
+        """
         # TODO: this has been tested for thresholds but not for recovery
         # timeouts
-        data = self._es.search(body={
-            "size": max_query_results,
-            "query": {
-                "filtered": {
-                    "query": {
-                        "match_all": {}
-                    },
-                    "filter": {
-                        "bool": {
-                            "must": [
-                                {"term": {"source": source}},
-                                {"term": {"dest": dest}},
-                                {"prefix": {"reqID": headerprefix}},
-                                {"term": {"testid": self._id}}
-                            ],
-                            "should": [
-                                {"term": {"msg": "Request"}},
-                                {"term": {"msg": "Response"}},
-                            ]
-                        }
-                    }
-                }
-            },
-            "aggs": {
-                "bysource": {
-                    "terms": {
-                        "field": "source",
-                    }
-                }
-            }
-        })
-
-        if(self.debug):
-            #pprint.pprint(data)
-            pprint.pprint(data["aggregations"]["bysource"]["buckets"])
-
-        
-
-        result = True
-        errormsg = ""
-        if not self._check_non_zero_results(data):
-            result = False
-            errormsg = "No log entries found"
-            return GremlinTestResult(result, errormsg)
-
-        reset_time = _parse_duration(reset_time)
-        circuit_mode = "closed"
-
-        # TODO - remove aggregations
-        for bucket in data["aggregations"]["bysource"]["buckets"]:
-            req_seq = _get_by("source", source, data["hits"]["hits"])
-            req_seq.sort(key=lambda x: isodate.parse_datetime(x['_source']["ts"]))
-
-            #Remove duplicate retries
-            if(remove_retries):
-                req_seq_dup = []
-                for i in range(len(req_seq)):
-                    if(i == len(req_seq)-1):
-                        req_seq_dup.append(req_seq[i])
-
-
-                    elif(req_seq[i]['_source']['reqID'] != req_seq[i+1]['_source']['reqID']):
-                        req_seq_dup.append(req_seq[i])
-
-                req_seq = req_seq_dup
-
-            failures = 0
-            circuit_open_ts = None
-            successes = 0
-            print "starting " + circuit_mode
-            for req in req_seq:
-                if circuit_mode is "open": #circuit_open_ts is not None:
-                    req_spacing = isodate.parse_datetime(req['_source']["ts"]) - circuit_open_ts
-
-                    # Restore to half-open
-                    if req_spacing >= reset_time:
-                        circuit_open_ts = None
-                        circuit_mode = "half-open"
-                        if self.debug:
-                            print "%d: open -> half-open" %(failures +1)
-                        failures = 0 #-1
-                    else:  # We are in open state
-                        # this is an assertion fail, no requests in open state
-                        if req['_source']["msg"] == "Request":
-                            if self.debug:
-                                print "%d: open -> failure" % (failures + 1)
-                            if self.debug:
-                                print "Service %s failed to trip circuit breaker" % source
-                            errormsg = "{} -> {} - new request was issued at ({}s) before reset_timer ({}s)expired".format(source,
-                                                                                                                         dest,
-                                                                                                                         req_spacing,
-                                                                                                                         reset_time) #req['_source'])
-                            result = False
-                            break
-                if circuit_mode is "half-open":
-                    if ((req['_source']["msg"] == "Response" and req['_source']["status"] != 200)
-                        or (req['_source']["msg"] == "Request" and ("abort" in req['_source']["actions"]))):
-                        if self.debug:
-                            print "half-open -> open"
-                        circuit_mode = "open"
-                        circuit_open_ts = isodate.parse_datetime(req['_source']["ts"])
-                        successes = 0
-                    elif (req['_source']["msg"] == "Response" and req['_source']["status"] == 200):
-                        successes += 1
-                        if self.debug:
-                            print "half-open -> half-open (%d)" % successes
-                        # If over threshold, return to closed state
-                        if successes > halfopen_attempts:
-                            if self.debug:
-                                print "half-open -> closed"
-                            circuit_mode = "closed"
-                            failures = 0
-                            circuit_open_ts = None
-                #else:
-                elif circuit_mode is "closed":
-
-                    if ((req['_source']["msg"] == "Response" and req['_source']["status"] != 200)
-                        or (req['_source']["msg"] == "Request" and len(req['_source']["actions"]) > 0)):
-                        # Increment failures
-                        failures += 1
-                        if self.debug:
-                            print "%d: closed->closed" % failures
-                        # print(failures)
-                        # Trip CB, go to open state
-                        if failures > closed_attempts:
-                            if self.debug:
-                                print "%d: closed->open" % failures
-                            circuit_open_ts = isodate.parse_datetime(req['_source']["ts"])
-                            successes = 0
-                            circuit_mode = "open"
-
-        # pprint.pprint(data)
-        return GremlinTestResult(result, errormsg)
-
+        req_seq = self._edge_hits(source, dest, [{"prefix": {"reqID": headerprefix}},
+                                                 {"terms": {"msg": ["Request", "Response"]}}], sort=True)
+
+        #Remove duplicate retries, keeping the last entry of each run with the same reqID
+        if(remove_retries):
+            req_seq = _last_of_runs(req_seq, lambda req: req['_source']['reqID'])
+
+        # Events by source service, each source having a circuit breaker of its own
+        by_source = HitIndex(req_seq, keys=("_source.source",))
+        hits = len(by_source)
+
+        violations = [_Violations(all, self.debug) for config in configs]
+        # Configurations still being checked: unless all is set, each stops at its first
+        # violation, whichever source it is found for
+        pending = range(len(configs))
+        for src, group in by_source.groups("_source.source"):
+            if not pending:
+                break
+            events = [_cb_event(req['_source']) for req in group]
+            breakers = [_CircuitBreaker(debug=self.debug, **config) for config in configs]
+            for event in events:
+                for i in pending:
+                    req_spacing = breakers[i].feed(event)
+                    if req_spacing is not None and violations[i].add(
+                            "{} -> {} - new request was issued at ({}s) before reset_timer ({}s)expired".format(
+                                src, dest, req_spacing / 1e9, breakers[i].reset_time / 1e9)):
+                        pending = [j for j in pending if j != i]
+                if not pending:
+                    break
+        return [v.result(hits) for v in violations]
 
     def check_num_requests(self, source, dest, num_requests, **kwargs):
         """
@@ -594,164 +543,275 @@ class AssertionChecker(object):
         if self.debug:
             print 'in check_num_requests (%s, %s, %s, %s)' % (source, dest, num_requests, self._id)
 
-        # Fetch requests for src->dst
-        data = self._es.search(body={
-            "size": max_query_results,
-            "query": {
-                "filtered": {
-                    "query": {
-                        "match_all": {}
-                    },
-                    "filter": {
-                        "bool": {
-                            "must": [
-                                {"term": {"msg": "Request"}},
-                                {"term": {"source": source}},
-                                {"term": {"dest": dest}},
-                                {"term": {"protocol": "http"}},
-                                {"term": {"testid": self._id}}
-                            ]
-                        }
-                    }
-                }
-            },
-            "aggs": {
-                "byid": {
-                    "terms": {
-                        "field": "testid",
-                    }
-                }
-            }
-        })
+        # Count requests for src->dst
+        hits = 0
+        for message in self._edge_hits(source, dest, [{"term": {"msg": "Request"}},
+                                                       {"term": {"protocol": "http"}}]):
+            hits += 1
 
-        if self.debug:
-            pprint.pprint(data)
-            pprint.pprint(data["aggregations"])
-
-        result = True
-        errormsg = ""
-        if not self._check_non_zero_results(data):
-            result = False
-            errormsg = "No log entries found"
-            return GremlinTestResult(result, errormsg)
-
-        # Check number of requests in each bucket
-        for bucket in data["aggregations"]["byid"]["buckets"]:
-            if bucket["doc_count"] is not (num_requests):
-                errormsg = "{} -> {} - expected {} requests, but found {} "\
-                         "requests for id {}".format(
-                            source, dest, num_requests, bucket['doc_count'],
-                            bucket['key'])
-                result = False
-                if self.debug:
-                    print errormsg
-                return GremlinTestResult(result, errormsg)
-        return GremlinTestResult(result, errormsg)
+        violations = _Violations(debug=self.debug)
+        if hits != num_requests:
+            violations.add("{} -> {} - expected {} requests, but found {} "
+                           "requests for id {}".format(source, dest, num_requests, hits, self._id))
+        return violations.result(hits)
 
 
 
-    def check_bulkhead(self, source, dependencies, slow_dest, rate):
+    def check_bulkhead(self, source, dependencies, slow_dest, rate, **kwargs):
         """
 	Asserts bulkheads by ensuring that the rate of requests to other dests is kept when slow_dest is slow
         :param source the source service name
         :param dependencies list of dependency names of source
         :param slow_dest the name of the dependency that independence is being tested for
-        :param rate number of requests per second that should occur to each dependency
+        :param rate number of requests per second that should occur to each dependency, or the
+                    LoadReport of the load that drove source, whose achieved rate is then used
         :return:
         """
+        rate = getattr(rate, 'achieved_rate', rate)
         #Remove slow dest
-        dependencies.remove(slow_dest)
-
+        dependencies = [d for d in dependencies if d != slow_dest]
 
         s =str(float(1)/float(rate))
-        max_spacing = _parse_duration(s+'s')
+        max_spacing = parse_duration(s+'s')
 
-           
-        
+        violations = _Violations(kwargs.get('all', False), self.debug)
+        max_spacing = timedelta_ns(max_spacing)
+        total = 0
         for dest in dependencies:
-            data = self._es.search(body={
-                "size": max_query_results,
-                "query": {
-                    "filtered": {
-                        "query": {
-                            "match_all": {}
-                        },
-                        "filter": {
-                            "bool": {
-                                "must": [
-                                    {"term": {"msg": "Request"}},
-                                    {"term": {"source": source}},
-                                    {"term": {"dest": dest}},
-                                    {"term": {"testid": self._id}}
-                                ]
-                            }
-                        }
-                    }
-                }
-            })
-
-            if self.debug:
-                pprint.pprint(data)
-
-            result = True
-            errormsg = ""
-            if not self._check_non_zero_results(data):
-                result = False
-                errormsg = "No log entries found"
-                return GremlinTestResult(result, errormsg)
-
-            req_seq = _get_by("source", source, data["hits"]["hits"])
-            req_seq.sort(key=lambda x: isodate.parse_datetime(x['_source']["ts"]))
-
-            last_request = isodate.parse_datetime(req_seq[0]['_source']["ts"])
-
-            for req in req_seq:
-                req_spacing = isodate.parse_datetime(req['_source']["ts"]) - last_request
-                last_request = isodate.parse_datetime(req['_source']["ts"])
-                if self.debug:
-                    print "spacing", req_spacing, max_spacing
-                if req_spacing > max_spacing:
-
-                    errormsg = "{} -> {} - new request was issued at ({}s) but max spacing should be ({}s)".format(source,
-                                                                                                                     dest,
-                                                                                                                     req_spacing,
-                                                                                                                     max_spacing) 
-                    result = False
-                    return GremlinTestResult(result, errormsg)                
-                
-
-                
-
-        return GremlinTestResult(result, errormsg)
-
+            frame = LogFrame(self._edge_hits(source, dest, [{"term": {"msg": "Request"}}]), keys=())
+            if len(frame) == 0:
+                if not violations.count:
+                    return violations.result(0)
+                # Keep the violations already found (with all set, evaluation goes on after them)
+                violations.add("{} -> {} - no requests found".format(source, dest))
+                continue
+            total += len(frame)
+            spacings = frame.spacing()
+            for i in range(len(spacings)):
+                if spacings[i] > max_spacing:
+                    if violations.add("{} -> {} - new request was issued at ({}s) but max spacing should be ({}s)".format(
+                            source, dest, spacings[i] / 1e9, max_spacing / 1e9)):
+                        break
+            if violations.count and not violations.all:
+                break
+
+        return violations.result(total)
+
+
+    def _aggregations(self, filter, aggs=None, size=0):
+        """Run an aggregation-only query: counts and aggregations, plus at most *size* hits"""
+        body = _filtered(filter)
+        body["size"] = size
+        if aggs:
+            body["aggs"] = aggs
+        return self._store.search(body=body)
+
+    def _report(self, violations, total, errormsgs):
+        """Record the worst offenders returned by an aggregation, out of *total* violations"""
+        for errormsg in errormsgs:
+            if violations.add(errormsg):
+                break
+        violations.count = max(violations.count, total)
+
+    def _offending_hits(self, filter, bad, describe, all=False, sort=None):
+        """
+        Plan for checks that fail on any log entry matching *bad* out of those matching *filter*:
+        one size 0 query counting both, returning only the max_offenders worst offenders
+        """
+        top_hits = {"size": self.max_offenders}
+        if sort is not None:
+            top_hits["sort"] = [{sort: {"order": "desc"}}]
+        data = self._aggregations(filter, {
+            "bad": {
+                "filter": bad,
+                "aggs": {"worst": {"top_hits": top_hits}}
+            }
+        })
+        violations = _Violations(all, self.debug)
+        bad = data["aggregations"]["bad"]
+        self._report(violations, bad["doc_count"],
+                     [describe(hit['_source']) for hit in bad["worst"]["hits"]["hits"]])
+        return violations.result(data["hits"]["total"])
 
-    def check_assertion(self, name=None, **kwargs):
+    def _offending_ids(self, filter, field, limit, describe, all=False):
+        """
+        Plan for checks that fail on any *field* value seen more than *limit* times: a group count
+        returning only the max_offenders most frequent values over the limit, and how many there are
+        """
+        total, groups, matched = self._store.group_count(filter, field, min_count=limit + 1,
+                                                         size=self.max_offenders)
+        violations = _Violations(all, self.debug)
+        self._report(violations, matched, [describe(value, count) for value, count in groups])
+        return violations.result(total)
+
+    def _plan_no_proxy_errors(self, all=False, **kwargs):
+        data = self._aggregations({"term": {"level": "error"}}, size=1)
+        if data["hits"]["total"] == 0:
+            return GremlinTestResult(True, "")
+        violations = _Violations(all, self.debug)
+        self._report(violations, data["hits"]["total"], [str(data["hits"]["hits"][0]['_source'])])
+        return violations.result(data["hits"]["total"])
+
+    def _plan_bounded_response_time(self, source, dest, max_latency, all=False, **kwargs):
+        if self.duration_field is None:
+            return None
+        max_ms = parse_duration(max_latency).total_seconds() * 1000
+        return self._offending_hits(
+            self._edge_filter(source, dest, {"term": {"msg": "Response"}}),
+            {"range": {self.duration_field: {"gt": max_ms}}},
+            lambda log: "{} did not reply in time for request {}, {}".format(dest, log["reqID"], log["duration"]),
+            all, sort=self.duration_field)
+
+    def _plan_http_success_status(self, all=False, **kwargs):
+        return self._offending_hits(
+            {"exists": {"field": "status"}},
+            {"bool": {"must_not": [{"term": {"status": 200}}]}},
+            lambda log: "{} -> {} - request {} returned status {}".format(
+                log.get("source"), log.get("dest"), log.get("reqID"), log["status"]),
+            all)
+
+    def _plan_http_status(self, source, dest, status, req_id, all=False, **kwargs):
+        return self._offending_hits(
+            self._edge_filter(source, dest,
+                              {"term": {"msg": "Response"}},
+                              {"term": {"req_id": req_id}},
+                              {"term": {"protocol" : "http"}}),
+            {"bool": {"must_not": [{"term": {"status": status}}]}},
+            lambda log: "{} -> {} - expected status {}, but found {} for request {}".format(
+                source, dest, status, log["status"], req_id),
+            all)
+
+    def _plan_at_most_requests(self, source, dest, num_requests, all=False, **kwargs):
+        return self._offending_ids(
+            self._edge_filter(source, dest, {"term": {"msg": "Request"}}, {"term": {"protocol": "http"}}),
+            "reqID", num_requests + 1,
+            lambda key, count: "{} -> {} - expected {} requests, but found {} requests for id {}".format(
+                source, dest, num_requests, count - 1, key),
+            all)
+
+    def _plan_bounded_retries(self, source, dest, retries, all=False, **kwargs):
+        # Retry spacing needs the timestamps of every request
+        if kwargs.get('wait_time') is not None:
+            return None
+        return self._offending_ids(
+            self._edge_filter(source, dest, {"term": {"msg": "Request"}}),
+            "reqID" if not kwargs.get('by_uri', False) else "uri", retries + 1,
+            lambda key, count: "{} -> {} - expected {} retries, but found {} retries for request {}".format(
+                source, dest, retries, count - 1, key),
+            all)
+
+    def check_assertion(self, name=None, all=False, **kwargs):
         # assertion is something like {"name": "bounded_response_time",
         #                              "service": "productpage",
         #                              "max_latency": "100ms"}
+        # all: if False, the check stops at the first violation it finds
 
         assert name is not None and name in self.functiondict
-        gremlin_test_result = self.functiondict[name](**kwargs)
+        gremlin_test_result = None
+        prefetched = self._slices is not None and name in _edge_checks and \
+            (kwargs.get('source'), kwargs.get('dest')) in self._slices
+        cost = None
+        if self.profile:
+            _cost_meter.start()
+        try:
+            with span("check", check=name) as s:
+                if self.aggregate and self._store.aggregations and name in self.plans and not prefetched:
+                    gremlin_test_result = self.plans[name](all=all, **kwargs)
+                    s.set(plan=gremlin_test_result is not None)
+                if gremlin_test_result is None:
+                    gremlin_test_result = self.functiondict[name](all=all, **kwargs)
+                s.set(success=gremlin_test_result.success)
+        finally:
+            if self.profile:
+                cost = _cost_meter.stop()
 
         if self.debug and not gremlin_test_result.success:
             print gremlin_test_result.errormsg
 
 
-        return AssertionResult(name, str(kwargs), gremlin_test_result.success, gremlin_test_result.errormsg)
+        result = AssertionResult(name, str(kwargs), gremlin_test_result.success, gremlin_test_result.errormsg)
+        result.cost = cost
+        return result
 
-    def check_assertions(self, checklist, all=False):
+    def _workers(self, max_workers):
+        """
+        Pool of max_workers threads for parallel checks, started on first use and kept for later
+        checklists: tearing a ThreadPool down takes about 100ms. A different max_workers replaces it
+        """
+        with self._pool_lock:
+            if self._pool is not None and self._pool_size != max_workers:
+                self._pool.close()
+                self._pool = None
+            if self._pool is None:
+                self._pool = ThreadPool(max_workers)
+                self._pool_size = max_workers
+            return self._pool
+
+    def close(self):
+        """Stop the threads of parallel checks"""
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def _check_parallel(self, checks, all, pool):
+        """
+        Run checks on a pool of threads, returning results in checklist order.
+        Unless all is set, checks after the first failing one (in checklist order) that have
+        not started yet are skipped, and only results up to that failure are returned
+        """
+        results = [None] * len(checks)
+        lock = threading.Lock()
+        first_failure = [len(checks)]
+
+        def run(i):
+            with lock:
+                if i > first_failure[0]:
+                    return
+            results[i] = self.check_assertion(all=all, **checks[i])
+            if not results[i].success and not all:
+                with lock:
+                    first_failure[0] = min(first_failure[0], i)
+
+        pool.map(run, range(len(checks)), chunksize=1)
+        if first_failure[0] < len(checks):
+            print "Error message:", results[first_failure[0]][3]
+            return results[:first_failure[0] + 1]
+        return results
+
+    def check_assertions(self, checklist, all=False, fused=False, parallel=False, max_workers=8):
         """Check a set of assertions
         @param all boolean if False, stop at first failure
+        @param fused boolean if True, fetch the logs of each source -> dest edge in the checklist once,
+               in a single multi-search round trip, and evaluate all checks on that edge against them.
+               The cost of these checks then leaves out the prefetch
+        @param parallel boolean if True, run independent checks concurrently on at most max_workers threads.
+               Results are still returned in checklist order
         @return: False if any assertion fails.
         """
 
         assert isinstance(checklist, dict) and 'checks' in checklist
 
+        checker = self
+        if fused:
+            edges = []
+            for assertion in checklist['checks']:
+                edge = (assertion.get('source'), assertion.get('dest'))
+                if assertion.get('name') in _edge_checks and edge not in edges:
+                    edges.append(edge)
+            if edges:
+                with span("fetch_slices", edges=len(edges)):
+                    checker = self._with_slices(self._fetch_slices(edges))
+
+        if parallel and len(checklist['checks']) > 1:
+            return checker._check_parallel(checklist['checks'], all, self._workers(max_workers))
+
         retval = None
         retlist = []
 
         for assertion in checklist['checks']:
-            retval = self.check_assertion(**assertion)
+            retval = checker.check_assertion(all=all, **assertion)
             retlist.append(retval)
             if not retval.success and not all:
                 print "Error message:", retval[3]
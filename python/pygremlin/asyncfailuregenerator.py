@@ -0,0 +1,160 @@
+# coding=utf-8
+
+import uuid
+
+from .failuregenerator import FailureGenerator
+from .instrumentation import current_span
+
+
+class ProxyFuture(object):
+    """
+    Handle on a set of proxy control-plane calls issued in the background.
+    get() waits for all of them and returns their combined result, re-raising
+    the first error any of them hit.
+    """
+
+    def __init__(self, calls, combine):
+        self._calls = calls
+        self._combine = combine
+
+    def ready(self):
+        return all(call.ready() for call in self._calls)
+
+    def wait(self, timeout=None):
+        for call in self._calls:
+            call.wait(timeout)
+
+    def get(self, timeout=None):
+        """
+        @param timeout: seconds to wait for each outstanding call, None to wait forever.
+                        multiprocessing.TimeoutError is raised when a call is not done in time
+        """
+        return self._combine([call.get(timeout) for call in self._calls])
+
+
+class AsyncFailureGenerator(FailureGenerator):
+    """
+    A FailureGenerator that does not block its caller on the service proxies.
+
+    Scenario methods (delay_requests, crash_service, ...) only queue rules and behave
+    as in FailureGenerator. The control-plane methods (start_new_test, clear_rules_from_all_proxies,
+    list_rules, push_rules, setup_failures) issue one call per proxy instance, all at once, on a
+    shared pool of at most max_concurrency workers and keep-alive sessions, and return a ProxyFuture.
+    Every proxy call is bounded by timeout seconds.
+
+    Call close() once done to release the worker pool.
+    """
+
+    def __init__(self, app, debug=False, max_concurrency=32, timeout=10):
+        """
+        @param app ApplicationGraph: instance of ApplicationGraph object
+        @param max_concurrency: maximum number of proxy calls in flight at any time
+        @param timeout: seconds to wait for each proxy call
+        """
+        FailureGenerator.__init__(self, app, debug=debug, max_workers=max_concurrency, timeout=timeout)
+
+    def _instances(self):
+        return [(service, instance) for service in self.app.get_services()
+                for instance in self.app.get_service_instances(service)]
+
+    def _fan_out(self, func, args_list, combine):
+        pool = self._workers()
+        calls = [pool.apply_async(func, args) for args in args_list]
+        return ProxyFuture(calls, combine)
+
+    def _set_test(self, service, instance, method):
+        if self.debug:
+            print 'Setting test %s on %s - instance %s' % (self._id, service, instance)
+        session = self._sessions.get(instance)
+        resp = getattr(session, method)("http://{}/gremlin/v1/test/{}".format(instance, self._id),
+                                        timeout=self.timeout)
+        resp.raise_for_status()
+
+    def _notify_proxies(self):
+        return self._fan_out(self._set_test, [(s, i, 'get') for s, i in self._instances()],
+                             lambda results: None)
+
+    def start_new_test(self):
+        """
+        Start a new test on all proxies. The new test id is available from get_test_id() right away,
+        the returned future resolves to it once every proxy has acknowledged the test
+        """
+        self._id = uuid.uuid4().hex
+        test_id = self._id
+        return self._fan_out(self._set_test, [(s, i, 'put') for s, i in self._instances()],
+                             lambda results: test_id)
+
+    def _clear_rules(self, service, instance):
+        if self.debug:
+            print 'Clearing rules for %s - instance %s' % (service, instance)
+        try:
+            resp = self._sessions.get(instance).delete("http://{}/gremlin/v1/rules".format(instance),
+                                                       timeout=self.timeout)
+            if resp.status_code == 200:
+                return True
+        except Exception, e:
+            if self.debug:
+                print e
+        print 'Failed to clear rules for %s - instance %s' % (service, instance)
+        return False
+
+    def clear_rules_from_all_proxies(self):
+        """
+            Clear fault injection rules from all known service proxies.
+            The returned future resolves to True if every proxy was cleared.
+        """
+        self._queue = []
+        return self._fan_out(self._clear_rules, self._instances(), all)
+
+    def _list_rules(self, service, instance):
+        installed = self._fetch_rules(service, instance)
+        return service, instance, installed if installed is not None else {}
+
+    def list_rules(self, service=None):
+        """
+            List fault injection rules installed on instances of a given service (or all services).
+            The returned future resolves to a dictionary of service -> instance -> rules
+        """
+        instances = [(s, i) for s, i in self._instances() if service is None or s == service]
+
+        def combine(results):
+            # Services without proxies are listed too, as by FailureGenerator.list_rules
+            rules = dict((s, {}) for s in self.app.get_services() if service is None or s == service)
+            for s, i, instance_rules in results:
+                rules[s][i] = instance_rules
+            return rules
+        return self._fan_out(self._list_rules, instances, combine)
+
+    def push_rules(self, continue_on_errors=False, parallel=True, batch=False):
+        """
+        Install queued rules on every instance of each rule's source service, all instances at once.
+        The returned future resolves to the list of PushResult, one per (service, instance).
+        parallel is accepted for compatibility with FailureGenerator; pushes are always concurrent
+        """
+        work = self._rules_by_instance()
+        return self._fan_out(self._push_to_instance,
+                             [(service, instance, rules, batch, current_span())
+                              for (service, instance), rules in work.items()],
+                             lambda outcomes: self._collect_push_results(outcomes, continue_on_errors))
+
+    def sync_rules(self, gremlins=None, continue_on_errors=False, parallel=True, batch=False):
+        """
+        Make the rules installed on every proxy match the queued rules (see FailureGenerator.sync_rules).
+        With parallel set, all instances are synced at once, otherwise one after the other in a single
+        background call. The returned future resolves to the list of SyncResult
+        """
+        work = self._sync_work(gremlins)
+        if parallel:
+            return self._fan_out(self._sync_instance,
+                                 [(s, i, rules, batch, current_span()) for (s, i), rules in work],
+                                 lambda outcomes: self._collect_sync_results(outcomes, continue_on_errors))
+        return self._fan_out(self._sync_serially, [(work, batch, continue_on_errors)],
+                             lambda outcomes: self._collect_sync_results(outcomes[0], continue_on_errors))
+
+    def setup_failures(self, gremlins, parallel=True, batch=False):
+        """Add gremlins to environment, returns the push_rules future"""
+
+        assert isinstance(gremlins, dict) and 'gremlins' in gremlins
+        for gremlin in gremlins['gremlins']:
+            self.setup_failure(**gremlin)
+        return self.push_rules(batch=batch)
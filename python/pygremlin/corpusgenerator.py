@@ -0,0 +1,205 @@
+# coding=utf-8
+import datetime
+import json
+import random
+
+from .failuregenerator import FailureGenerator
+from .loadgenerator import _gremlin_id
+from .logstore import bulk_load
+from .testing import _first_rule
+from .timeutil import duration_ns
+
+_epoch = datetime.datetime(1970, 1, 1)
+
+
+class _Timestamps(object):
+    """Formats ns since the epoch as proxy log timestamps, formatting the date and time part once per second"""
+
+    def __init__(self):
+        self._second = None
+        self._prefix = None
+
+    def __call__(self, ns):
+        second, fraction = divmod(ns, 10**9)
+        if second != self._second:
+            self._second = second
+            self._prefix = (_epoch + datetime.timedelta(seconds=second)).strftime("%Y-%m-%dT%H:%M:%S.")
+        return "%s%06dZ" % (self._prefix, fraction // 1000)
+
+
+class _Breaker(object):
+    """Circuit breaker of a simulated caller, per (source, dest)"""
+
+    def __init__(self, closed_attempts, reset_time, halfopen_attempts=1):
+        self.closed_attempts = closed_attempts
+        self.reset_time = duration_ns(reset_time)
+        self.halfopen_attempts = halfopen_attempts
+        self.failures = 0
+        self.successes = 0
+        self.open_until = None
+
+    def allows(self, ts):
+        return self.open_until is None or ts >= self.open_until
+
+    def record(self, ts, ok):
+        if self.open_until is not None:
+            # Half-open: the first failure opens the circuit again
+            if not ok:
+                self.open_until = ts + self.reset_time
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.successes > self.halfopen_attempts:
+                    self.open_until = None
+                    self.failures = 0
+            return
+        if not ok:
+            self.failures += 1
+            if self.failures > self.closed_attempts:
+                self.open_until = ts + self.reset_time
+                self.successes = 0
+
+
+class CorpusGenerator(object):
+    """
+    Synthetic proxy logs of a test, in the schema AssertionChecker queries, for profiling checks on large,
+    reproducible inputs.
+
+    Requests enter the application at its entry services (those no other service calls) at *rate* per second,
+    and fan out along the dependencies of the ApplicationGraph: every call logs a Request and a Response entry,
+    the Response once all the calls the dest makes in turn are done. The gremlins are applied to the calls
+    they match, as the proxies would: aborts, delays and their actions, of requests and of responses. Callers may retry failed calls and
+    trip circuit breakers, so retries, aborts and circuit breaker behavior all show up in the logs.
+    """
+
+    def __init__(self, app, gremlins=None, test_id="corpus", requests=1000, rate=100, faulty_fraction=0.5,
+                 mean_latency="5ms", error_rate=0.0, retries=0, retry_wait="100ms", circuit_breaker=None,
+                 start=None, seed=0):
+        """
+        @param app ApplicationGraph: the application
+        @param gremlins: gremlins JSON ({"gremlins": [...]}) of the failure scenario, if any
+        @param requests: number of requests entering the application
+        @param rate: requests entering per second
+        @param faulty_fraction: fraction of the requests tagged with an X-Gremlin-ID the gremlins match,
+               the others have ids like req-<n>
+        @param mean_latency: mean of the (exponentially distributed) time a service takes on its own
+        @param error_rate: probability of a service answering 503 by itself
+        @param retries: number of times a caller retries a failed call, retry_wait apart
+        @param circuit_breaker: dict of closed_attempts, reset_time and optionally halfopen_attempts of the
+               circuit breaker every caller uses, None for no circuit breakers
+        @param start: time of the first request, in seconds since the epoch. Fixed by default, for reproducibility
+        """
+        self.app = app
+        self.test_id = test_id
+        self.requests = requests
+        self.rate = rate
+        self.faulty_fraction = faulty_fraction
+        self.mean_latency = duration_ns(mean_latency)
+        self.error_rate = error_rate
+        self.retries = retries
+        self.retry_wait = duration_ns(retry_wait)
+        self.circuit_breaker = circuit_breaker
+        self.start = int((start if start is not None else 1451606400) * 10**9)
+        self.seed = seed
+        self.rules = []
+        self.patterns = []
+        if gremlins is not None:
+            # Expand the scenarios into rules the way FailureGenerator does, without contacting any proxy
+            fg = FailureGenerator(app)
+            for gremlin in gremlins['gremlins']:
+                fg.setup_failure(**gremlin)
+            self.rules = fg.compile_rules().rules
+            for rule in self.rules:
+                if rule["headerpattern"] not in self.patterns:
+                    self.patterns.append(rule["headerpattern"])
+        self._dependencies = dict((s, list(app.get_dependencies(s))) for s in app.get_services())
+        self.entry_services = [s for s in sorted(app.get_services())
+                               if self._dependencies[s] and not app.get_dependents(s)]
+
+    def _faults(self, rule):
+        """The faults of *rule* that fire this time, drawn with the rule's probabilities"""
+        if rule is None:
+            return []
+        return [fault for fault in ("abort", "delay", "mangle")
+                if rule[fault + "probability"] > 0 and self._random.random() < rule[fault + "probability"]]
+
+    def _call(self, out, source, dest, ts, req_id):
+        """Log a call from source to dest at ts, with retries. Returns (time it ends, whether it succeeded)"""
+        rnd = self._random
+        breaker = self._breakers.get((source, dest)) if self.circuit_breaker is not None else None
+        if self.circuit_breaker is not None and breaker is None:
+            breaker = self._breakers[(source, dest)] = _Breaker(**self.circuit_breaker)
+        rule = _first_rule(self.rules, source, dest, "request", req_id)
+        response_rule = _first_rule(self.rules, source, dest, "response", req_id)
+        for attempt in range(self.retries + 1):
+            if breaker is not None and not breaker.allows(ts):
+                # Open circuit: the caller fails fast without calling dest
+                return ts, False
+            actions = self._faults(rule)
+            out.append({"level": "info", "msg": "Request", "source": source, "dest": dest, "reqID": req_id,
+                        "testid": self.test_id, "ts": ts, "protocol": "http", "uri": "/" + dest, "actions": actions})
+            if "abort" in actions:
+                # As GremlinProxy: a negative errorcode resets the connection, logged as status -1
+                status = max(rule["errorcode"], -1)
+                end = ts + 100000
+            else:
+                end = ts + (duration_ns(rule["delaytime"]) if "delay" in actions else 0)
+                own = int(rnd.expovariate(1.0 / self.mean_latency)) if self.mean_latency else 0
+                end += own // 2
+                for dep in self._dependencies.get(dest, []):
+                    end, ok = self._call(out, dest, dep, end, req_id)
+                end += own - own // 2
+                status = 503 if self.error_rate and rnd.random() < self.error_rate else 200
+                # Response rules apply to whatever dest answered, as GremlinProxy does
+                response_actions = self._faults(response_rule)
+                if "abort" in response_actions:
+                    status = max(response_rule["errorcode"], -1)
+                if "delay" in response_actions:
+                    end += duration_ns(response_rule["delaytime"])
+                actions = actions + response_actions
+            out.append({"level": "info", "msg": "Response", "source": source, "dest": dest, "reqID": req_id,
+                        "testid": self.test_id, "ts": end, "protocol": "http", "status": status,
+                        "duration": "%.3fms" % ((end - ts) / 1e6), "actions": actions})
+            if breaker is not None:
+                breaker.record(end, status == 200)
+            if status == 200:
+                return end, True
+            ts = end + self.retry_wait
+        return end, False
+
+    def entries(self):
+        """Yield the log entries, request by request. Entries of overlapping requests are not in ts order"""
+        self._random = random.Random(self.seed)
+        self._breakers = {}
+        timestamp = _Timestamps()
+        spacing = 10**9 / float(self.rate)
+        faulty = 0
+        for n in range(self.requests):
+            ts = self.start + int(n * spacing)
+            if self.patterns and self._random.random() < self.faulty_fraction:
+                req_id = _gremlin_id(self.patterns[faulty % len(self.patterns)], n)
+                faulty += 1
+            else:
+                req_id = "req-%d" % n
+            out = []
+            for service in self.entry_services:
+                for dest in self._dependencies[service]:
+                    self._call(out, service, dest, ts, req_id)
+            for entry in out:
+                entry["ts"] = timestamp(entry["ts"])
+                yield entry
+
+    def write(self, path):
+        """Write the log entries to *path* as newline delimited JSON, for FileLogStore. Returns the number written"""
+        count = 0
+        encode = json.JSONEncoder(separators=(",", ":")).encode
+        with open(path, "w") as f:
+            for entry in self.entries():
+                f.write(encode(entry))
+                f.write("\n")
+                count += 1
+        return count
+
+    def load(self, path):
+        """Bulk load the log entries into the sqlite file at *path*, for SQLiteLogStore. Returns the number loaded"""
+        return bulk_load(self.entries(), path, test_id=self.test_id)
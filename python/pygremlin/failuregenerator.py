@@ -2,24 +2,126 @@
 
 import requests
 import json
-from collections import defaultdict
+from collections import defaultdict, namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
+import threading
+import hashlib
 import uuid
 import logging
 import httplib
+from .instrumentation import span
+from .timeutil import duration_ns
 logging.basicConfig()
 requests_log = logging.getLogger("requests.packages.urllib3")
 
+PushResult = namedtuple('PushResult', ['service', 'instance', 'rules', 'requests', 'bytes', 'success', 'errormsg'])
+PushStats = namedtuple('PushStats', ['requests', 'bytes', 'requests_saved', 'bytes_saved'])
+CompiledPlan = namedtuple('CompiledPlan', ['rules', 'per_proxy', 'duplicates'])
+SyncResult = namedtuple('SyncResult', ['service', 'instance', 'added', 'removed', 'requests', 'success', 'errormsg'])
+
+#Rule fields understood by the proxies, with their default values
+_rule_defaults = {
+    "source": "",
+    "dest": "",
+    "messagetype": "request",
+    "headerpattern": "*",
+    "bodypattern": "*",
+    "delayprobability": 0.0,
+    "delaydistribution": "uniform",
+    "mangleprobability": 0.0,
+    "mangledistribution": "uniform",
+    "abortprobability": 0.0,
+    "abortdistribution": "uniform",
+    "delaytime": "0s",
+    "errorcode": -1,
+    "searchstring": "",
+    "replacestring": ""
+}
+
+def _canonical_rule(rule):
+    """
+    Return rule with defaults filled in, unknown fields dropped and numbers normalized,
+    so that equivalent rules compare (and hash) equal no matter where they came from
+    """
+    canon = dict(_rule_defaults)
+    for k, v in rule.items():
+        if k in canon:
+            canon[k] = v
+    for k in ("delayprobability", "mangleprobability", "abortprobability"):
+        canon[k] = float(canon[k])
+    canon["errorcode"] = int(canon["errorcode"])
+    return canon
+
+def _rule_hash(rule):
+    return hashlib.sha1(json.dumps(_canonical_rule(rule), sort_keys=True)).hexdigest()
+
+#Status codes with which a proxy tells us it does not implement rules/add_batch
+_batch_unsupported_codes = (404, 405, 501)
+
+def _request_bytes(request):
+    """Approximate on-the-wire size of a prepared request: request line, headers and body"""
+    size = len(request.method) + len(request.path_url) + len(" HTTP/1.1\r\n\r\n")
+    for k, v in request.headers.items():
+        size += len(k) + len(v) + 4
+    return size + len(request.body or "")
+
+
+class _Session(requests.Session):
+    """Session whose requests run in a proxy.request span when instrumentation is on"""
+
+    def request(self, method, url, **kwargs):
+        with span("proxy.request", method=method, url=url) as s:
+            resp = requests.Session.request(self, method, url, **kwargs)
+            if s.recording:
+                s.set(status=resp.status_code, request_bytes=_request_bytes(resp.request),
+                      response_bytes=len(resp.content))
+            return resp
+
+
+class _SessionPool(object):
+    """Keep-alive HTTP sessions to service proxies, one per proxy instance"""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, instance):
+        with self._lock:
+            session = self._sessions.get(instance)
+            if session is None:
+                session = _Session()
+                self._sessions[instance] = session
+            return session
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+
 class FailureGenerator(object):
 
-    def __init__(self, app, debug=False):
+    def __init__(self, app, debug=False, max_workers=16, timeout=None):
         """
         Create a new failure generator
         @param app ApplicationGraph: instance of ApplicationGraph object
+        @param max_workers: upper bound on concurrent proxy connections used by push_rules(parallel=True)
+        @param timeout: seconds to wait for each proxy control-plane call, None to wait forever
+        Call close() once done to release the worker threads and proxy connections
         """
+        assert max_workers > 0
         self.app = app
         self.debug = debug
+        self.max_workers = max_workers
+        self.timeout = timeout
         self._id = None
         self._queue = []
+        self._sessions = _SessionPool()
+        self._no_batch = set()
+        self._push_stats = None
+        self._pool = None
+        self._pool_lock = threading.Lock()
         #some common scenarios
         self.functiondict = {
             'delay_requests' : self.delay_requests,
@@ -36,6 +138,25 @@ class FailureGenerator(object):
             requests_log.setLevel(logging.DEBUG)
             requests_log.propagate = True
 
+    def _workers(self):
+        """
+        Pool of max_workers threads for concurrent proxy calls, started on first use and kept for
+        later calls: tearing a ThreadPool down takes about 100ms, more than a push to local proxies
+        """
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.max_workers)
+            return self._pool
+
+    def close(self):
+        """Wait for outstanding proxy calls, stop the worker threads and close the proxy sessions"""
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+        self._sessions.close()
+
     def _notify_proxies(self):
         if self.debug:
             print 'in _notifyProxies'
@@ -44,7 +165,8 @@ class FailureGenerator(object):
             if self.debug:
                 print(service)
             for instance in self.app.get_service_instances(service):
-                resp = requests.get("http://{}/gremlin/v1/test/{}".format(instance,self._id))
+                resp = self._sessions.get(instance).get("http://{}/gremlin/v1/test/{}".format(instance,self._id),
+                                                      timeout=self.timeout)
                 resp.raise_for_status()
 
 
@@ -54,7 +176,8 @@ class FailureGenerator(object):
             if self.debug:
                 print(service)
             for instance in self.app.get_service_instances(service):
-                resp = requests.put("http://{}/gremlin/v1/test/{}".format(instance,self._id))
+                resp = self._sessions.get(instance).put("http://{}/gremlin/v1/test/{}".format(instance,self._id),
+                                                      timeout=self.timeout)
                 resp.raise_for_status()
         return self._id
 
@@ -86,24 +209,8 @@ class FailureGenerator(object):
         searchstring: <string> string to replace when Mangle is enabled
         replacestring: <string> string to replace with for Mangle fault
         """
-        #The defaults are indicated below
-        myrule = {
-                  "source": "",
-                  "dest": "",
-                  "messagetype": "request",
-                  "headerpattern": "*",
-                  "bodypattern": "*",
-                  "delayprobability": 0.0,
-                  "delaydistribution": "uniform",
-                  "mangleprobability": 0.0,
-                  "mangledistribution": "uniform",
-                  "abortprobability": 0.0,
-                  "abortdistribution": "uniform",
-                  "delaytime": "0s",
-                  "errorcode": -1,
-                  "searchstring": "",
-                  "replacestring": ""
-        }
+        #The defaults are in _rule_defaults
+        myrule = dict(_rule_defaults)
         rule = args.copy()
         #copy
         for i in rule.keys():
@@ -111,13 +218,13 @@ class FailureGenerator(object):
                 continue
             myrule[i] = rule[i]
         #check defaults
-        services = self.app.get_services()
         assert myrule["source"] != "" and myrule["dest"] != ""
-        assert myrule["source"] in services and myrule["dest"] in services
+        assert self.app.has_service(myrule["source"]) and self.app.has_service(myrule["dest"])
         assert myrule['headerpattern'] != "" or myrule["bodypattern"] != ""
         assert myrule['delayprobability'] >0.0 or myrule['abortprobability'] >0.0 or myrule['mangleprobability'] >0.0
         if myrule["delayprobability"] > 0.0:
             assert myrule["delaytime"] != ""
+            duration_ns(myrule["delaytime"])
         if myrule["abortprobability"] > 0.0:
             assert myrule["errorcode"] >= -1
         assert myrule["messagetype"] in ["request", "response", "publish", "subscribe"]
@@ -134,42 +241,277 @@ class FailureGenerator(object):
             for instance in self.app.get_service_instances(service):
                 if self.debug:
                     print 'Clearing rules for %s - instance %s' % (service, instance)
-                resp = requests.delete("http://{}/gremlin/v1/rules".format(instance))
+                resp = self._sessions.get(instance).delete("http://{}/gremlin/v1/rules".format(instance),
+                                                         timeout=self.timeout)
                 if resp.status_code != 200:
                     print 'Failed to clear rules for %s - instance %s' % (service, instance)
 
+    def _fetch_rules(self, service, instance):
+        """Rules installed on a proxy instance, or None if they could not be fetched"""
+        try:
+            resp = self._sessions.get(instance).get("http://{}/gremlin/v1/rules/list".format(instance),
+                                                    timeout=self.timeout)
+            if resp.status_code == 200:
+                return resp.json()
+        except requests.exceptions.RequestException, e:
+            if self.debug:
+                print e
+        print 'Failed to fetch rules from %s - instance %s' % (service, instance)
+        return None
+
     def list_rules(self, service=None):
         """
             List fault fault injection rules installed on instances of a given service (or all services)
             returns a JSON dictionary
         """
         rules = {}
-        for service in self.app.get_services():
-            rules[service] = {}
-            for instance in self.app.get_service_instances(service):
-                rules[service][instance] = {}
-                resp = requests.get("http://{}/gremlin/v1/rules/list".format(instance))
-                if resp.status_code != 200:
-                    print 'Failed to fetch rules from %s - instance %s' % (service, instance)
-                    continue
-                rules[service][instance] = resp.json()
-                return rules
+        for s in self.app.get_services():
+            if service is not None and s != service:
+                continue
+            rules[s] = {}
+            for instance in self.app.get_service_instances(s):
+                installed = self._fetch_rules(s, instance)
+                rules[s][instance] = installed if installed is not None else {}
+        return rules
 
-    #TODO: Create a plugin model here, to support gremlinproxy and nginx
-    def push_rules(self, continue_on_errors=False):
+    def _sync_instance(self, service, instance, desired, batch=False, parent=None):
+        """
+        Bring the rules installed on one proxy instance in line with desired: remove what is
+        not desired, then add what is missing. If the installed rules cannot be listed,
+        all rules are cleared and desired is pushed from scratch.
+        Returns (SyncResult, exception), exception being None on success
+        """
+        with span("proxy.sync", parent=parent, service=service, instance=instance, rules=len(desired)):
+            installed = self._fetch_rules(service, instance)
+            session = self._sessions.get(instance)
+            wanted = OrderedDict((_rule_hash(rule), rule) for rule in desired)
+            nrequests = 1
+            removed = 0
+            try:
+                if installed is None:
+                    resp = session.delete("http://{}/gremlin/v1/rules".format(instance), timeout=self.timeout)
+                    nrequests += 1
+                    resp.raise_for_status()
+                    adds = wanted.values()
+                else:
+                    present = set()
+                    for rule in installed:
+                        key = _rule_hash(rule)
+                        if key in wanted and key not in present:
+                            present.add(key)
+                            continue
+                        resp = session.post("http://{}/gremlin/v1/rules/remove".format(instance),
+                                            headers={"Content-Type" : "application/json"},
+                                            data=json.dumps(rule), timeout=self.timeout)
+                        nrequests += 1
+                        resp.raise_for_status()
+                        removed += 1
+                    adds = [rule for key, rule in wanted.items() if key not in present]
+            except requests.exceptions.RequestException, e:
+                return SyncResult(service, instance, 0, removed, nrequests, False, str(e)), e
+            result, _, _, e = self._push_to_instance(service, instance, adds, batch)
+            return SyncResult(service, instance, result.rules, removed, nrequests + result.requests,
+                              result.success, result.errormsg), e
+
+    def sync_rules(self, gremlins=None, continue_on_errors=False, parallel=False, batch=False):
+        """
+        Make the rules installed on every proxy match the queued rules, sending only the
+        rules/remove and rules/add calls needed to get there. Rules already in place are left alone,
+        so stepping through scenarios that share rules neither clears nor re-pushes them.
+        @param gremlins: if given, replace the queue with the rules for these gremlins first (see setup_failures)
+        @param continue_on_errors: keep syncing the remaining instances after a failure
+        @param parallel: sync all instances concurrently, using at most max_workers connections
+        @param batch: add missing rules with one rules/add_batch request per instance
+        @return list of SyncResult, one per (service, instance)
+        """
+        work = self._sync_work(gremlins)
+        with span("sync_rules", instances=len(work), parallel=parallel, batch=batch) as sync:
+            if parallel and len(work) > 1:
+                outcomes = self._workers().map(lambda item: self._sync_instance(item[0][0], item[0][1], item[1],
+                                                                                batch, parent=sync), work)
+            else:
+                outcomes = self._sync_serially(work, batch, continue_on_errors)
+        return self._collect_sync_results(outcomes, continue_on_errors)
+
+    def _sync_work(self, gremlins=None):
+        """
+        ((service, instance), desired rules) for every proxy instance, after replacing the queue
+        with the rules for gremlins if given
+        """
+        if gremlins is not None:
+            assert isinstance(gremlins, dict) and 'gremlins' in gremlins
+            self._queue = []
+            for gremlin in gremlins['gremlins']:
+                self.setup_failure(**gremlin)
+        desired = self._rules_by_instance()
+        return [((service, instance), desired.get((service, instance), []))
+                for service in self.app.get_services()
+                for instance in self.app.get_service_instances(service)]
+
+    def _sync_serially(self, work, batch, continue_on_errors):
+        """_sync_instance outcomes of syncing the instances one after the other"""
+        outcomes = []
+        for (service, instance), rules in work:
+            outcomes.append(self._sync_instance(service, instance, rules, batch))
+            if outcomes[-1][1] is not None and not continue_on_errors:
+                break
+        return outcomes
+
+    def _collect_sync_results(self, outcomes, continue_on_errors):
+        """Turn _sync_instance outcomes into SyncResults, raising the first error if asked to"""
+        results = []
+        error = None
+        for result, e in outcomes:
+            results.append(result)
+            if e is None:
+                continue
+            print "FAILURE: Could not sync rules on instance %s of service %s" % (result.instance, result.service)
+            print e
+            if error is None:
+                error = e
+        if self.debug:
+            print 'Synced rules: %d added, %d removed, %d requests' % (sum(r.added for r in results),
+                                                                     sum(r.removed for r in results),
+                                                                     sum(r.requests for r in results))
+        if error is not None and not continue_on_errors:
+            raise error
+        return results
+
+    def compile_rules(self):
+        """
+        Reduce the queued rules to the set that is pushed: rules are canonicalized and exact
+        duplicates dropped. Distinct rules matching the same messages are all kept, in queue
+        order, since which of them a proxy applies is up to the proxy (GremlinProxy applies the
+        first one only), so folding them into one rule would change what fires.
+        The queue itself is left untouched.
+        @return CompiledPlan of the rules to push (in queue order), the number of rules
+                per proxy instance, and how many rules were dropped as duplicates
+        """
+        seen = set()
+        rules = []
+        duplicates = 0
         for rule in self._queue:
-            instances = self.app.get_service_instances(rule["source"])
-            for instance in instances:
-                try:
-                    resp = requests.post("http://{}/gremlin/v1/rules/add".format(instance),
-                                         headers = {"Content-Type" : "application/json"},
-                                         data=json.dumps(rule))
+            canon = _canonical_rule(rule)
+            key = _rule_hash(canon)
+            if key in seen:
+                duplicates += 1
+                continue
+            seen.add(key)
+            rules.append(canon)
+        per_proxy = defaultdict(int)
+        for rule in rules:
+            for instance in self.app.get_service_instances(rule["source"]):
+                per_proxy[instance] += 1
+        if self.debug:
+            print 'Compiled %d rules into %d (%d duplicates)' % (len(self._queue), len(rules), duplicates)
+        return CompiledPlan(rules, dict(per_proxy), duplicates)
+
+    def _rules_by_instance(self):
+        """Group compiled rules by the proxy instances they have to be installed on, preserving queue order"""
+        work = OrderedDict()
+        for rule in self.compile_rules().rules:
+            for instance in self.app.get_service_instances(rule["source"]):
+                work.setdefault((rule["source"], instance), []).append(rule)
+        return work
+
+    def _push_to_instance(self, service, instance, rules, batch=False, parent=None):
+        """
+        Install rules on a single proxy instance over its keep-alive session.
+        With batch set, all rules go out in one rules/add_batch request, unless the
+        proxy is known not to support it, in which case they are posted one by one.
+        Returns a (PushResult, requests_saved, bytes_saved, exception) tuple, exception being None on success
+        """
+        with span("proxy.push", parent=parent, service=service, instance=instance, rules=len(rules)):
+            session = self._sessions.get(instance)
+            headers = {"Content-Type" : "application/json"}
+            bodies = [json.dumps(rule) for rule in rules]
+            pushed = 0
+            nrequests = 0
+            nbytes = 0
+            try:
+                if batch and len(rules) > 1 and instance not in self._no_batch:
+                    resp = session.post("http://{}/gremlin/v1/rules/add_batch".format(instance),
+                                        headers=headers, data="[" + ", ".join(bodies) + "]",
+                                        timeout=self.timeout)
+                    nrequests += 1
+                    nbytes += _request_bytes(resp.request)
+                    if resp.status_code not in _batch_unsupported_codes:
+                        resp.raise_for_status()
+                        #Each rule would otherwise have paid for its own request line (to rules/add) and headers
+                        overhead = nbytes - len(resp.request.body) - len("_batch")
+                        unbatched = sum(overhead + len(b) for b in bodies)
+                        return (PushResult(service, instance, len(rules), nrequests, nbytes, True, ""),
+                                len(rules) - 1, unbatched - nbytes, None)
+                    if self.debug:
+                        print 'Instance %s of service %s does not support rules/add_batch' % (instance, service)
+                    self._no_batch.add(instance)
+                for body in bodies:
+                    resp = session.post("http://{}/gremlin/v1/rules/add".format(instance),
+                                        headers=headers, data=body, timeout=self.timeout)
+                    nrequests += 1
+                    nbytes += _request_bytes(resp.request)
                     resp.raise_for_status()
-                except requests.exceptions.ConnectionError, e:
-                    print "FAILURE: Could not add rule to instance %s of service %s" % (instance, rule["source"])
-                    print e
-                    if not continue_on_errors:
-                        raise e
+                    pushed += 1
+            except requests.exceptions.RequestException, e:
+                return PushResult(service, instance, pushed, nrequests, nbytes, False, str(e)), 0, 0, e
+            return PushResult(service, instance, pushed, nrequests, nbytes, True, ""), 0, 0, None
+
+    #TODO: Create a plugin model here, to support gremlinproxy and nginx
+    def push_rules(self, continue_on_errors=False, parallel=False, batch=False):
+        """
+        Install queued rules on every instance of each rule's source service.
+        @param continue_on_errors: keep pushing to the remaining instances after a failure
+        @param parallel: push to all instances concurrently, using at most max_workers connections.
+                         Rules for one instance are always sent in queue order, over that instance's session
+        @param batch: send all rules for an instance in a single rules/add_batch request,
+                      falling back to one rules/add request per rule for proxies without batch support
+        @return list of PushResult, one per (service, instance). Totals are available from get_push_stats()
+        """
+        work = self._rules_by_instance()
+        outcomes = []
+        with span("push_rules", instances=len(work), parallel=parallel, batch=batch) as push:
+            if parallel and len(work) > 1:
+                outcomes = self._workers().map(lambda item: self._push_to_instance(item[0][0], item[0][1], item[1],
+                                                                                   batch, parent=push),
+                                               work.items())
+            else:
+                for (service, instance), rules in work.items():
+                    outcomes.append(self._push_to_instance(service, instance, rules, batch))
+                    if outcomes[-1][3] is not None and not continue_on_errors:
+                        break
+        return self._collect_push_results(outcomes, continue_on_errors)
+
+    def _collect_push_results(self, outcomes, continue_on_errors):
+        """Turn _push_to_instance outcomes into PushResults and push stats, raising the first error if asked to"""
+        results = []
+        error = None
+        requests_saved = 0
+        bytes_saved = 0
+        for result, nrequests, nbytes, e in outcomes:
+            results.append(result)
+            requests_saved += nrequests
+            bytes_saved += nbytes
+            if e is None:
+                continue
+            print "FAILURE: Could not add rule to instance %s of service %s" % (result.instance, result.service)
+            print e
+            if error is None:
+                error = e
+        self._push_stats = PushStats(sum(r.requests for r in results),
+                                     sum(r.bytes for r in results),
+                                     requests_saved, bytes_saved)
+        if self.debug:
+            print 'Pushed rules: %s' % str(self._push_stats)
+        if error is not None and not continue_on_errors:
+            raise error
+        return results
+
+    def get_push_stats(self):
+        """
+        Totals for the last push_rules call: requests sent, bytes sent,
+        and the requests and (approximate) bytes saved by batching
+        """
+        return self._push_stats
 
     def _generate_rules(self, rtype, **args):
         rule = args.copy()
@@ -292,10 +634,13 @@ class FailureGenerator(object):
         assert scenario is not None and scenario in self.functiondict
         self.functiondict[scenario](**args)
 
-    def setup_failures(self, gremlins):
-        """Add gremlins to environment"""
+    def setup_failures(self, gremlins, parallel=False, batch=False):
+        """Add gremlins to environment
+        @param parallel: push the resulting rules to all proxies concurrently
+        @param batch: push all rules for a proxy instance in one request
+        """
 
         assert isinstance(gremlins, dict) and 'gremlins' in gremlins
         for gremlin in gremlins['gremlins']:
             self.setup_failure(**gremlin)
-        self.push_rules()
+        return self.push_rules(parallel=parallel, batch=batch)
@@ -0,0 +1,75 @@
+# coding=utf-8
+import heapq
+
+
+def _path_getter(path):
+    """Function returning the value at a dotted field path such as "_source.reqID", or None"""
+    parts = tuple(path.split("."))
+
+    def get(hit):
+        for part in parts:
+            if not isinstance(hit, dict):
+                return None
+            hit = hit.get(part)
+        return hit
+    return get
+
+
+class HitIndex(object):
+    """
+    Elasticsearch hits, in their original order, with a hash index on each of a set of field paths
+    (e.g. "_source.reqID", "_source.source", "_source.uri"). The index is built in one pass over the
+    hits, after which all the hits with a given value of an indexed field are found in O(1)
+    """
+
+    def __init__(self, hits, keys=("_source.reqID",)):
+        """
+        @param hits: iterable of elasticsearch hits
+        @param keys: dotted field paths to index
+        """
+        self.hits = []
+        self._getters = dict((key, _path_getter(key)) for key in keys)
+        self._rows = dict((key, {}) for key in keys)
+        getters = self._getters.items()
+        for row, hit in enumerate(hits):
+            self.hits.append(hit)
+            for key, get in getters:
+                value = get(hit)
+                # Lists and objects are not hashable, and no term query matches them
+                if isinstance(value, (list, dict)):
+                    continue
+                rows = self._rows[key].get(value)
+                if rows is None:
+                    self._rows[key][value] = [row]
+                else:
+                    rows.append(row)
+
+    def __len__(self):
+        return len(self.hits)
+
+    def __iter__(self):
+        return iter(self.hits)
+
+    def indexed(self, key):
+        return key in self._rows
+
+    def rows(self, key, value):
+        """Positions of the hits with *key=value*, in hit order"""
+        return self._rows[key].get(value, [])
+
+    def rows_in(self, key, values):
+        """Positions of the hits whose *key* is any of *values*, in hit order"""
+        index = self._rows[key]
+        return list(heapq.merge(*[index[v] for v in set(values) if v in index]))
+
+    def get(self, key, value):
+        """All hits with *key=value*, in hit order"""
+        return [self.hits[row] for row in self.rows(key, value)]
+
+    def groups(self, key):
+        """Yield (value, hits) for every distinct value of *key*, in order of first appearance"""
+        for value, rows in sorted(self._rows[key].items(), key=lambda item: item[1][0]):
+            yield value, [self.hits[row] for row in rows]
+
+    def values(self, key):
+        return self._rows[key].keys()
@@ -0,0 +1,346 @@
+# coding=utf-8
+"""
+Tracing hooks of the hot paths: proxy control-plane calls, log store queries, JSON parsing and
+check evaluation each run in a span recording its latency and, where they apply, payload bytes
+and hit counts. Finished spans go to the sinks registered with add_sink, e.g.
+
+    with PrometheusTextFile("/var/lib/node_exporter/pygremlin.prom"):
+        checker.check_assertions(checklist)
+
+While no sink is registered, span() returns a shared do-nothing span, so the hooks cost about
+one function call each.
+"""
+import json
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+
+_sinks = ()
+_sinks_lock = threading.Lock()
+_local = threading.local()
+
+
+class _NoSpan(object):
+    """The span handed out while nothing is recording"""
+
+    recording = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+    def add(self, key, value):
+        pass
+
+    def end(self, error=None):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+class Span(object):
+    """
+    A timed operation. Used as a context manager, it is the parent of the spans opened in its
+    block (on the same thread); otherwise end() finishes it, e.g. for a generator that yields
+    in between
+    """
+
+    recording = True
+
+    def __init__(self, name, attributes, parent=None):
+        self.name = name
+        self.attributes = attributes
+        if parent is None or not parent.recording:
+            stack = _stack()
+            parent = stack[-1] if stack else None
+        self.parent_id = parent.span_id if parent is not None else None
+        self.trace_id = parent.trace_id if parent is not None else "%032x" % random.getrandbits(128)
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.error = None
+        self.end_ns = None
+        self.start_ns = int(time.time() * 1e9)
+
+    @property
+    def duration_ns(self):
+        return self.end_ns - self.start_ns if self.end_ns is not None else None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, key, value):
+        """Add value to a counter attribute, e.g. bytes read"""
+        self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def end(self, error=None):
+        if self.end_ns is not None:
+            return
+        self.end_ns = int(time.time() * 1e9)
+        if error is not None:
+            self.error = str(error) or error.__class__.__name__
+        for sink in _sinks:
+            sink.on_end(self)
+
+    def __enter__(self):
+        _stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        stack = _stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        self.end(exc_value if exc_type is not None else None)
+        return False
+
+    def __repr__(self):
+        return "Span({!r}, {}, {}ns)".format(self.name, self.attributes, self.duration_ns)
+
+
+def enabled():
+    """Whether any sink is recording spans"""
+    return bool(_sinks)
+
+
+def span(name, parent=None, **attributes):
+    """
+    Start a span, a do-nothing one if no sink is registered
+    @param parent: parent span, e.g. of a span started on a worker thread. By default the
+                   innermost span open on this thread
+    """
+    if not _sinks:
+        return _NO_SPAN
+    return Span(name, attributes, parent)
+
+
+def current_span():
+    """The innermost span open on this thread, or a do-nothing span"""
+    stack = getattr(_local, "stack", None)
+    return stack[-1] if stack else _NO_SPAN
+
+
+def add_sink(sink):
+    """Send every span finished from now on to sink.on_end"""
+    global _sinks
+    with _sinks_lock:
+        _sinks = _sinks + (sink,)
+    return sink
+
+
+def remove_sink(sink):
+    global _sinks
+    with _sinks_lock:
+        _sinks = tuple(s for s in _sinks if s is not sink)
+
+
+class SpanSink(object):
+    """
+    Base class of span sinks. As a context manager, a sink records the spans finished
+    in its block, and is closed at the end of it
+    """
+
+    def on_end(self, span):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return add_sink(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        remove_sink(self)
+        self.close()
+        return False
+
+
+class SpanRecorder(SpanSink):
+    """Keeps finished spans in memory, in the order they finish"""
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def on_end(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
+
+    def children(self, span):
+        """Spans recorded under span, at any depth"""
+        ids = set([span.span_id])
+        found = []
+        # Children finish before their parents, so walking back from the end sees parents first
+        for s in reversed(self.spans):
+            if s.parent_id in ids:
+                ids.add(s.span_id)
+                found.append(s)
+        found.reverse()
+        return found
+
+
+def _label_value(value):
+    return unicode(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class PrometheusTextFile(SpanSink):
+    """
+    Aggregates spans by name into Prometheus metrics, written in the text exposition format
+    to a file for the node_exporter textfile collector:
+
+        pygremlin_span_seconds_count / _sum    number and total duration of spans
+        pygremlin_span_errors_total            spans that ended with an exception
+        pygremlin_span_<counter>_total         totals of the counter attributes (bytes, hits, ...)
+
+    The file is replaced atomically on write() and close()
+    """
+
+    def __init__(self, path, labels=("check",), counters=("hits", "bytes", "request_bytes", "response_bytes"),
+                 prefix="pygremlin_span"):
+        """
+        @param labels: span attributes that become labels next to the span name
+        @param counters: numeric span attributes that are totalled
+        """
+        self.path = path
+        self.labels = labels
+        self.counters = counters
+        self.prefix = prefix
+        self._seconds = defaultdict(float)
+        self._counts = defaultdict(int)
+        self._errors = defaultdict(int)
+        self._totals = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+
+    def on_end(self, span):
+        key = (span.name,) + tuple(span.attributes.get(label) for label in self.labels)
+        with self._lock:
+            self._counts[key] += 1
+            self._seconds[key] += span.duration_ns / 1e9
+            if span.error is not None:
+                self._errors[key] += 1
+            for counter in self.counters:
+                if counter in span.attributes:
+                    self._totals[counter][key] += span.attributes[counter]
+
+    def _labels(self, key):
+        pairs = [("span", key[0])] + [(label, value) for label, value in zip(self.labels, key[1:])
+                                      if value is not None]
+        return ",".join(u'{}="{}"'.format(label, _label_value(value)) for label, value in pairs)
+
+    def text(self):
+        """The metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            lines.append("# HELP {}_seconds Time spent in pygremlin operations".format(self.prefix))
+            lines.append("# TYPE {}_seconds summary".format(self.prefix))
+            for key in sorted(self._counts):
+                lines.append(u"{}_seconds_count{{{}}} {}".format(self.prefix, self._labels(key), self._counts[key]))
+                lines.append(u"{}_seconds_sum{{{}}} {!r}".format(self.prefix, self._labels(key), self._seconds[key]))
+            lines.append("# TYPE {}_errors_total counter".format(self.prefix))
+            for key in sorted(self._errors):
+                lines.append(u"{}_errors_total{{{}}} {}".format(self.prefix, self._labels(key), self._errors[key]))
+            for attribute in sorted(self._totals):
+                lines.append("# TYPE {}_{}_total counter".format(self.prefix, attribute))
+                for key, value in sorted(self._totals[attribute].items()):
+                    lines.append(u"{}_{}_total{{{}}} {!r}".format(self.prefix, attribute, self._labels(key), value))
+        return u"\n".join(lines) + u"\n"
+
+    def write(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(self.text().encode("utf-8"))
+        os.rename(tmp, self.path)
+
+    def close(self):
+        self.write()
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, (int, long)):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": unicode(value)}
+
+
+def otlp_span(span):
+    """A span in the OTLP/JSON encoding of OpenTelemetry"""
+    encoded = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": 1,
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.end_ns),
+        "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in sorted(span.attributes.items())],
+        "status": {"code": 2, "message": span.error} if span.error is not None else {}
+    }
+    if span.parent_id is not None:
+        encoded["parentSpanId"] = span.parent_id
+    return encoded
+
+
+class OTLPSpanSink(SpanSink):
+    """
+    Batches spans into OTLP/JSON trace export requests ({"resourceSpans": [...]}), as accepted by
+    OpenTelemetry collectors on /v1/traces. Each batch is passed to *export*, e.g.
+
+        OTLPSpanSink(export=lambda doc: requests.post("http://collector:4318/v1/traces", json=doc))
+
+    and/or appended to the file at *path*, one request per line
+    """
+
+    def __init__(self, export=None, path=None, batch_size=512, service_name="pygremlin"):
+        assert export is not None or path is not None
+        self.export = export
+        self.path = path
+        self.batch_size = batch_size
+        self.service_name = service_name
+        self._batch = []
+        self._lock = threading.Lock()
+
+    def on_end(self, span):
+        with self._lock:
+            self._batch.append(otlp_span(span))
+            if len(self._batch) < self.batch_size:
+                return
+            batch, self._batch = self._batch, []
+        self._send(batch)
+
+    def _send(self, batch):
+        doc = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+            "scopeSpans": [{"scope": {"name": "pygremlin"}, "spans": batch}]
+        }]}
+        if self.path is not None:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(doc) + "\n")
+        if self.export is not None:
+            self.export(doc)
+
+    def flush(self):
+        with self._lock:
+            batch, self._batch = self._batch, []
+        if batch:
+            self._send(batch)
+
+    def close(self):
+        self.flush()
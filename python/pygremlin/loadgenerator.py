@@ -0,0 +1,515 @@
+# coding=utf-8
+import Queue
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+from .assertionchecker import AssertionResult
+from .timeutil import duration_ns
+
+# Values below 2**_sub_bits us get a bucket of their own, larger ones 2**(_sub_bits-1) buckets per
+# power of two: about 1.5% worst case relative error, whatever the magnitude
+_sub_bits = 7
+_half = 1 << (_sub_bits - 1)
+
+
+def _bucket(us):
+    if us < (1 << _sub_bits):
+        return us
+    shift = us.bit_length() - _sub_bits
+    return _half * shift + (us >> shift)
+
+
+def _bucket_floor(index):
+    """Smallest value in us of a bucket"""
+    if index < (1 << _sub_bits):
+        return index
+    shift = index // _half - 1
+    return (index - _half * shift) << shift
+
+
+class LatencyHistogram(object):
+    """
+    Log-linear histogram of latencies with microsecond resolution, in the spirit of HdrHistogram:
+    recording is a dict increment, and percentiles are accurate to within 1.5%
+    """
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, ns):
+        """Record a latency in nanoseconds"""
+        self.counts[_bucket(max(0, int(ns)) // 1000)] += 1
+        self.count += 1
+        self.total += ns
+        if self.min is None or ns < self.min:
+            self.min = ns
+        if self.max is None or ns > self.max:
+            self.max = ns
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def mean(self):
+        return self.total / float(self.count) if self.count else 0
+
+    def percentile(self, p):
+        """Latency in ns that p percent of the recorded latencies are at or below (the highest value of its bucket)"""
+        if not self.count:
+            return 0
+        if p >= 100:
+            return self.max
+        rank = max(1, int(round(p / 100.0 * self.count)))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self.max, (_bucket_floor(index + 1) * 1000) - 1)
+        return self.max
+
+    def buckets(self):
+        """(lower bound in ns, count) of every non empty bucket, in increasing latency order"""
+        return [(_bucket_floor(index) * 1000, self.counts[index]) for index in sorted(self.counts)]
+
+
+def _gremlin_id(headerpattern, n):
+    """Value of the X-Gremlin-ID header of the n-th request, matched by the regex *headerpattern*"""
+    if headerpattern.endswith(".*"):
+        headerpattern = headerpattern[:-2]
+    elif headerpattern.endswith("*"):
+        headerpattern = headerpattern[:-1]
+    return "{}{}".format(headerpattern, n)
+
+
+class LoadReport(object):
+    """
+    Client side view of a load run: request counts, response status counts, errors (requests that got
+    no response) and a histogram of the latencies of the requests that got a response
+    """
+
+    def __init__(self, url, requests, errors, statuses, elapsed, histogram, sent=None):
+        """
+        @param sent: send times in seconds of the requests, when known. The achieved rate is then
+                     measured between the first and last send rather than over the whole run
+        """
+        self.url = url
+        self.requests = requests
+        self.errors = errors
+        self.statuses = statuses
+        self.elapsed = elapsed
+        self.histogram = histogram
+        self.sent = sent
+
+    @property
+    def achieved_rate(self):
+        """Requests per second actually sent"""
+        if self.sent and len(self.sent) > 1 and max(self.sent) > min(self.sent):
+            return (len(self.sent) - 1) / (max(self.sent) - min(self.sent))
+        return self.requests / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        h = self.histogram
+        return "{} requests to {} in {:.2f}s ({:.1f}/s), {} errors, statuses {}, latency " \
+               "p50 {:.1f}ms p99 {:.1f}ms max {:.1f}ms".format(
+                   self.requests, self.url, self.elapsed, self.achieved_rate, self.errors, dict(self.statuses),
+                   h.percentile(50) / 1e6, h.percentile(99) / 1e6, (h.max or 0) / 1e6)
+
+    def check_bounded_response_time(self, max_latency, percentile=100):
+        """
+        Check that *percentile* percent of the requests got a response within max_latency, as seen by the client
+        :return AssertionResult, like the proxy side checks of AssertionChecker
+        """
+        info = str({'max_latency': max_latency, 'percentile': percentile})
+        if self.histogram.count == 0:
+            return AssertionResult('client_bounded_response_time', info, False, "No responses received")
+        latency = self.histogram.percentile(percentile)
+        if latency > duration_ns(max_latency):
+            return AssertionResult('client_bounded_response_time', info, False,
+                                   "{} - {}th percentile latency was {}ms".format(self.url, percentile, latency / 1e6))
+        return AssertionResult('client_bounded_response_time', info, True, "")
+
+    def check_http_success_status(self, min_ratio=1.0):
+        """Check that at least min_ratio of the requests got a 200 response"""
+        info = str({'min_ratio': min_ratio})
+        ok = self.statuses.get(200, 0)
+        if self.requests == 0 or ok < min_ratio * self.requests:
+            return AssertionResult('client_http_success_status', info, False,
+                                   "{} - {} of {} requests got a 200 response, {} errors".format(
+                                       self.url, ok, self.requests, self.errors))
+        return AssertionResult('client_http_success_status', info, True, "")
+
+
+class LoadGenerator(object):
+    """
+    Sends HTTP requests to a URL from concurrent workers, each with its own keep-alive session,
+    at up to *rate* requests per second (as fast as possible if no rate is given) for *duration*.
+    Every request carries an X-Gremlin-ID header matched by *headerpattern*, so that the fault
+    injection rules of the test apply to it
+    """
+
+    def __init__(self, url, headerpattern="*", rate=None, concurrency=8, duration="10s",
+                 max_requests=None, method="GET", headers=None, timeout=10, debug=False):
+        """
+        @param url: URL to send requests to, e.g. the gateway of the application
+        @param headerpattern: headerpattern of the gremlins, the n-th request has X-Gremlin-ID <pattern minus trailing *>n
+        @param rate: requests per second across all workers, None for no limit
+        @param concurrency: number of workers
+        @param duration: how long to send requests for, a duration string such as "30s" or seconds
+        @param max_requests: stop after this many requests, if sooner
+        @param timeout: seconds to wait for each response
+        """
+        assert concurrency > 0
+        self.url = url
+        self.headerpattern = headerpattern
+        self.rate = rate
+        self.concurrency = concurrency
+        self.duration = duration_ns(duration) / 1e9 if isinstance(duration, basestring) else duration
+        self.max_requests = max_requests
+        self.method = method
+        self.headers = headers or {}
+        self.timeout = timeout
+        self.debug = debug
+
+    @classmethod
+    def from_json(cls, spec, gremlins=None, **kwargs):
+        """
+        Load generator described by the "load" section of a checklist or gremlins JSON, e.g.
+        {"load": {"url": "http://localhost:9080/productpage", "rate": 100, "concurrency": 16,
+                  "duration": "30s", "headerpattern": "testUser-timeout-*"}}
+        Without a headerpattern, that of the first gremlin in *gremlins* is used
+        """
+        spec = dict(spec.get('load', spec))
+        if 'headerpattern' not in spec and gremlins is not None and gremlins.get('gremlins'):
+            spec['headerpattern'] = gremlins['gremlins'][0].get('headerpattern', "*")
+        spec.update(kwargs)
+        return cls(**spec)
+
+    def _worker(self, next_request, start, histogram, statuses, errors, sent_times):
+        session = requests.Session()
+        try:
+            while True:
+                n = next_request()
+                if n is None:
+                    return
+                if self.rate:
+                    # Request n is due n/rate seconds into the run
+                    delay = start + n / float(self.rate) - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                headers = dict(self.headers)
+                headers["X-Gremlin-ID"] = _gremlin_id(self.headerpattern, n)
+                # When the request actually goes out: with all workers busy, that can be long after it was due
+                sent = time.time()
+                sent_times.append(sent - start)
+                try:
+                    resp = session.request(self.method, self.url, headers=headers, timeout=self.timeout)
+                    resp.content
+                except requests.exceptions.RequestException, e:
+                    if self.debug:
+                        print e
+                    errors.append(n)
+                    continue
+                histogram.record((time.time() - sent) * 1e9)
+                statuses[resp.status_code] += 1
+        finally:
+            session.close()
+
+    def run(self):
+        """Send the load, blocking until done. Returns a LoadReport"""
+        start = time.time()
+        end = start + self.duration
+        lock = threading.Lock()
+        counter = [0]
+
+        def next_request():
+            with lock:
+                n = counter[0]
+                if (self.max_requests is not None and n >= self.max_requests) or time.time() >= end or \
+                        (self.rate and start + n / float(self.rate) >= end):
+                    return None
+                counter[0] += 1
+                return n
+
+        histograms = [LatencyHistogram() for i in range(self.concurrency)]
+        statuses = [defaultdict(int) for i in range(self.concurrency)]
+        errors = []
+        sent_times = []
+        workers = [threading.Thread(target=self._worker,
+                                    args=(next_request, start, histograms[i], statuses[i], errors, sent_times))
+                   for i in range(self.concurrency)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        histogram = LatencyHistogram()
+        merged = defaultdict(int)
+        for i in range(self.concurrency):
+            histogram.merge(histograms[i])
+            for status, count in statuses[i].items():
+                merged[status] += count
+        report = LoadReport(self.url, counter[0], len(errors), merged, time.time() - start, histogram,
+                            sent=sent_times)
+        if self.debug:
+            print report
+        return report
+
+
+class ConstantProfile(object):
+    """Arrivals evenly spaced at *rate* per second"""
+
+    def __init__(self, rate):
+        assert rate > 0
+        self.rate = float(rate)
+
+    def arrivals(self, duration):
+        """Offsets in seconds of the arrivals within the first *duration* seconds"""
+        n = 0
+        while n / self.rate < duration:
+            yield n / self.rate
+            n += 1
+
+
+class PoissonProfile(object):
+    """Arrivals of a Poisson process with *rate* per second on average: exponential inter-arrival times"""
+
+    def __init__(self, rate, seed=None):
+        assert rate > 0
+        self.rate = float(rate)
+        self.seed = seed
+
+    def arrivals(self, duration):
+        rnd = random.Random(self.seed)
+        t = 0.0
+        while t < duration:
+            yield t
+            t += rnd.expovariate(self.rate)
+
+
+class StepProfile(object):
+    """
+    Constant rate arrivals in consecutive steps, e.g. [("10s", 10), ("10s", 50), ("10s", 100)].
+    With ramp=True the rate instead goes linearly from each step's rate to the next one's
+    """
+
+    def __init__(self, steps, ramp=False):
+        """
+        @param steps: list of (duration, rate per second), durations as duration strings or seconds
+        """
+        assert steps
+        self.steps = [(duration_ns(d) / 1e9 if isinstance(d, basestring) else float(d), float(r)) for d, r in steps]
+        self.ramp = ramp
+
+    def arrivals(self, duration=None):
+        """Arrivals of all steps, or of the first *duration* seconds of them"""
+        start = 0.0
+        for i, (length, rate) in enumerate(self.steps):
+            end_rate = self.steps[i + 1][1] if self.ramp and i + 1 < len(self.steps) else rate
+            # The n-th arrival of the step is where the integral of the rate reaches n
+            slope = (end_rate - rate) / length
+            n = 0
+            while True:
+                if slope:
+                    disc = rate * rate + 2 * slope * n
+                    if disc < 0:
+                        break
+                    t = (math.sqrt(disc) - rate) / slope
+                elif rate > 0:
+                    t = n / rate
+                else:
+                    break
+                if t >= length or (duration is not None and start + t >= duration):
+                    break
+                yield start + t
+                n += 1
+            start += length
+
+    @property
+    def rate(self):
+        """Average rate over all steps"""
+        return sum(length * rate for length, rate in self.steps) / sum(length for length, rate in self.steps)
+
+
+def profile_from_json(spec):
+    """
+    Arrival profile from a JSON description: {"profile": "constant", "rate": 100}, {"profile": "poisson", "rate": 100},
+    {"profile": "step", "steps": [["10s", 10], ["10s", 100]]} or the same with "ramp"
+    """
+    kind = spec.get("profile", "constant")
+    if kind == "constant":
+        return ConstantProfile(spec["rate"])
+    if kind == "poisson":
+        return PoissonProfile(spec["rate"], seed=spec.get("seed"))
+    if kind in ("step", "ramp"):
+        return StepProfile(spec["steps"], ramp=kind == "ramp")
+    raise ValueError("Unknown traffic profile {}".format(kind))
+
+
+class _TimerWheel(object):
+    """
+    Hashed timing wheel: entries are hashed by due tick into a ring of slots, so that adding an entry
+    and collecting those of the current tick do not depend on how many entries are pending
+    """
+
+    def __init__(self, tick, slots=1024):
+        self.tick = tick
+        self.slots = [[] for i in range(slots)]
+        self.current = 0
+        self.size = 0
+
+    def horizon(self):
+        """Offset in seconds up to which entries can be added without wrapping around the ring more than once"""
+        return (self.current + len(self.slots)) * self.tick
+
+    def add(self, due, item):
+        t = max(int(due / self.tick), self.current)
+        self.slots[t % len(self.slots)].append((t, due, item))
+        self.size += 1
+
+    def advance(self):
+        """Entries of the current tick, in due order, moving on to the next tick"""
+        slot = self.slots[self.current % len(self.slots)]
+        due = [entry for entry in slot if entry[0] == self.current]
+        if due:
+            slot[:] = [entry for entry in slot if entry[0] != self.current]
+            self.size -= len(due)
+            due.sort()
+        self.current += 1
+        return [(t, item) for tick, t, item in due]
+
+
+class OpenLoopGenerator(LoadGenerator):
+    """
+    Sends requests on a schedule set by an arrival profile (constant, Poisson, step or ramp),
+    whether or not earlier requests got a response: an open loop, as real users behave.
+
+    Requests are scheduled on a timer wheel and handed to up to max_concurrency workers. Latencies are
+    measured from when each request was due to be sent, not from when a worker got to send it, so that a
+    slow service does not hide its own queueing from the results (coordinated omission). The latencies
+    from the actual send are kept in the report's service_histogram
+    """
+
+    def __init__(self, url, profile, headerpattern="*", duration="10s", max_concurrency=64,
+                 tick=0.001, method="GET", headers=None, timeout=10, debug=False):
+        """
+        @param profile: ConstantProfile, PoissonProfile or StepProfile, or its JSON description (see profile_from_json)
+        @param max_concurrency: maximum number of requests in flight. Requests due while all workers are busy wait
+                                for one, and that wait counts in their latency
+        @param tick: resolution in seconds of the timer wheel
+        """
+        LoadGenerator.__init__(self, url, headerpattern=headerpattern, concurrency=max_concurrency, duration=duration,
+                               method=method, headers=headers, timeout=timeout, debug=debug)
+        self.profile = profile_from_json(profile) if isinstance(profile, dict) else profile
+        self.rate = self.profile.rate
+        self.tick = tick
+
+    @classmethod
+    def from_json(cls, spec, gremlins=None, **kwargs):
+        """
+        Like LoadGenerator.from_json, with the arrival profile in the "load" section, e.g.
+        {"load": {"url": "...", "profile": "poisson", "rate": 100, "duration": "30s"}}
+        """
+        spec = dict(spec.get('load', spec))
+        profile = dict((k, spec.pop(k)) for k in ("profile", "rate", "steps", "seed") if k in spec)
+        return super(OpenLoopGenerator, cls).from_json(spec, gremlins=gremlins, profile=profile, **kwargs)
+
+    def _open_worker(self, queue, start, histogram, service_histogram, statuses, errors, sent_times):
+        session = requests.Session()
+        try:
+            while True:
+                work = queue.get()
+                if work is None:
+                    return
+                n, due = work
+                headers = dict(self.headers)
+                headers["X-Gremlin-ID"] = _gremlin_id(self.headerpattern, n)
+                # When the request actually goes out: with all workers busy, that can be long after it was due
+                sent = time.time()
+                sent_times.append(sent - start)
+                try:
+                    resp = session.request(self.method, self.url, headers=headers, timeout=self.timeout)
+                    resp.content
+                except requests.exceptions.RequestException, e:
+                    if self.debug:
+                        print e
+                    errors.append(n)
+                    continue
+                done = time.time()
+                histogram.record((done - start - due) * 1e9)
+                service_histogram.record((done - sent) * 1e9)
+                statuses[resp.status_code] += 1
+        finally:
+            session.close()
+
+    def run(self):
+        """Send the load, blocking until the schedule is done and all responses are in. Returns a LoadReport"""
+        queue = Queue.Queue()
+        histograms = [LatencyHistogram() for i in range(self.concurrency)]
+        service_histograms = [LatencyHistogram() for i in range(self.concurrency)]
+        statuses = [defaultdict(int) for i in range(self.concurrency)]
+        errors = []
+        sent = []
+        start = time.time()
+        workers = [threading.Thread(target=self._open_worker,
+                                    args=(queue, start, histograms[i], service_histograms[i], statuses[i], errors,
+                                          sent))
+                   for i in range(self.concurrency)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        wheel = _TimerWheel(self.tick)
+        arrivals = iter(self.profile.arrivals(self.duration))
+        upcoming = next(arrivals, None)
+        n = 0
+        while upcoming is not None or wheel.size:
+            # Keep the wheel filled one revolution ahead
+            while upcoming is not None and upcoming < wheel.horizon():
+                wheel.add(upcoming, n)
+                n += 1
+                upcoming = next(arrivals, None)
+            # Wait for the tick to come round, then send each of its requests on time
+            delay = start + wheel.current * self.tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            for due, i in wheel.advance():
+                delay = start + due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                queue.put((i, due))
+            if not wheel.size and upcoming is not None:
+                # Nothing pending for a whole revolution: jump to the next arrival
+                wheel.current = int(upcoming / self.tick)
+        for worker in workers:
+            queue.put(None)
+        for worker in workers:
+            worker.join()
+
+        histogram = LatencyHistogram()
+        service_histogram = LatencyHistogram()
+        merged = defaultdict(int)
+        for i in range(self.concurrency):
+            histogram.merge(histograms[i])
+            service_histogram.merge(service_histograms[i])
+            for status, count in statuses[i].items():
+                merged[status] += count
+        report = LoadReport(self.url, n, len(errors), merged, time.time() - start, histogram, sent=sent)
+        report.service_histogram = service_histogram
+        if self.debug:
+            print report
+        return report
@@ -0,0 +1,126 @@
+# coding=utf-8
+from .timeutil import duration_ns, timestamp_ns
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class LogFrame(object):
+    """
+    Columnar view of a slice of proxy log entries, built in one pass over the hits.
+
+    Timestamps and durations are held as integer nanoseconds (-1 where a log entry has none),
+    status as an integer (-1 if missing), and the *keys* fields as integer codes into
+    categories[field]. With numpy installed all columns are numpy arrays and the group
+    operations below are vectorized; otherwise they are plain lists.
+    """
+
+    def __init__(self, hits, keys=("source", "dest", "msg", "reqID"), durations=False):
+        """
+        @param hits: iterable of elasticsearch hits (dicts with a _source)
+        @param keys: categorical fields to encode
+        @param durations: decode the duration strings of the log entries
+        """
+        self.categories = dict((k, []) for k in keys)
+        codes = dict((k, {}) for k in keys)
+        columns = dict((k, []) for k in keys)
+        ts = []
+        status = []
+        duration = []
+        for hit in hits:
+            log = hit['_source']
+            ts.append(timestamp_ns(log["ts"]) if "ts" in log else -1)
+            status.append(log.get("status", -1))
+            if durations and "duration" in log:
+                duration.append(duration_ns(log["duration"]))
+            else:
+                duration.append(-1)
+            for k in keys:
+                v = log.get(k)
+                code = codes[k].get(v)
+                if code is None:
+                    code = codes[k][v] = len(self.categories[k])
+                    self.categories[k].append(v)
+                columns[k].append(code)
+        if np is not None:
+            self.ts = np.array(ts, dtype=np.int64)
+            self.status = np.array(status, dtype=np.int64)
+            self.duration = np.array(duration, dtype=np.int64)
+            self.codes = dict((k, np.array(v, dtype=np.int32)) for k, v in columns.items())
+        else:
+            self.ts = ts
+            self.status = status
+            self.duration = duration
+            self.codes = columns
+
+    @classmethod
+    def batches(cls, hits, size, **kwargs):
+        """Yield LogFrames over consecutive batches of at most *size* hits"""
+        batch = []
+        for hit in hits:
+            batch.append(hit)
+            if len(batch) == size:
+                yield cls(batch, **kwargs)
+                batch = []
+        if batch:
+            yield cls(batch, **kwargs)
+
+    def __len__(self):
+        return len(self.ts)
+
+    def value(self, key, row):
+        """Value of categorical field *key* in row"""
+        return self.categories[key][self.codes[key][row]]
+
+    def exceeding(self, column, threshold):
+        """Rows (in frame order) where the integer column is above threshold"""
+        values = getattr(self, column)
+        if np is not None:
+            return np.flatnonzero(values > threshold).tolist()
+        return [i for i, v in enumerate(values) if v > threshold]
+
+    def counts(self, key):
+        """Number of rows per code of *key*, indexed by code"""
+        if np is not None:
+            return np.bincount(self.codes[key], minlength=len(self.categories[key]))
+        counts = [0] * len(self.categories[key])
+        for code in self.codes[key]:
+            counts[code] += 1
+        return counts
+
+    def spacing(self):
+        """Time between consecutive rows in ts order, in nanoseconds"""
+        if np is not None:
+            return np.diff(np.sort(self.ts))
+        ts = sorted(self.ts)
+        return [b - a for a, b in zip(ts, ts[1:])]
+
+    def group_spacing(self, key):
+        """
+        Time since the previous row of the same *key* group, for every row that is not the
+        first of its group. Returns (codes, attempts, spacings): the group code, the position
+        of the row within its group (1 for the second row) and the spacing in nanoseconds,
+        ordered by group and then by ts
+        """
+        codes = self.codes[key]
+        if np is not None:
+            order = np.lexsort((self.ts, codes))
+            c = codes[order]
+            t = self.ts[order]
+            same = c[1:] == c[:-1]
+            index = np.arange(len(c))
+            starts = np.maximum.accumulate(np.where(np.r_[True, ~same], index, 0))
+            return c[1:][same], (index - starts)[1:][same], np.diff(t)[same]
+        order = sorted(range(len(codes)), key=lambda i: (codes[i], self.ts[i]))
+        groups, attempts, spacings = [], [], []
+        attempt = 0
+        for prev, cur in zip(order, order[1:]):
+            if codes[prev] != codes[cur]:
+                attempt = 0
+                continue
+            attempt += 1
+            groups.append(codes[cur])
+            attempts.append(attempt)
+            spacings.append(self.ts[cur] - self.ts[prev])
+        return groups, attempts, spacings
@@ -0,0 +1,608 @@
+# coding=utf-8
+import heapq
+import json
+import mmap
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+from elasticsearch import Elasticsearch
+from elasticsearch.serializer import JSONSerializer
+
+from .instrumentation import span
+from .timeutil import timestamp_ns
+
+GroupCounts = namedtuple('GroupCounts', ['total', 'groups', 'matched'])
+
+
+def _match(clause, log):
+    """
+    Evaluate a filter clause against a log entry, client side.
+    Only the clauses used on edge log slices are supported: term, terms, prefix, exists and bool
+    """
+    kind, spec = clause.items()[0]
+    if kind == "term":
+        field, value = spec.items()[0]
+        return log.get(field) == value
+    if kind == "terms":
+        field, values = spec.items()[0]
+        return log.get(field) in values
+    if kind == "prefix":
+        field, value = spec.items()[0]
+        return isinstance(log.get(field), basestring) and log[field].startswith(value)
+    if kind == "exists":
+        return log.get(spec["field"]) is not None
+    if kind == "bool":
+        return (all(_match(c, log) for c in spec.get("must", [])) and
+                not any(_match(c, log) for c in spec.get("must_not", [])) and
+                (not spec.get("should") or any(_match(c, log) for c in spec["should"])))
+    raise ValueError("Unsupported filter clause {}".format(kind))
+
+
+def _filtered(filter, sort=None):
+    """Query body matching every log entry that passes *filter*, optionally sorted on a field"""
+    body = {
+        "query": {
+            "filtered": {
+                "query": {
+                    "match_all": {}
+                },
+                "filter": filter
+            }
+        }
+    }
+    if sort is not None:
+        body["sort"] = [{sort: {"order": "asc"}}]
+    return body
+
+
+def _sort_key(field):
+    """Sort key on a log field of hits, entries missing the field last like elasticsearch does"""
+    if field == "ts":
+        return lambda hit: (0, timestamp_ns(hit['_source']["ts"])) if "ts" in hit['_source'] else (1, 0)
+    return lambda hit: (0, hit['_source'][field]) if field in hit['_source'] else (1, 0)
+
+
+def _traced(hits, name, **attributes):
+    """
+    Pass *hits* through in a span, with the number of hits and the time spent producing them,
+    not counting the time the consumer holds on to each hit, as busy_ns
+    """
+    scan = span(name, **attributes)
+    if not scan.recording:
+        return hits
+    return _timed(hits, scan)
+
+
+def _sorted(hits, key):
+    """Yield *hits* sorted on *key*, sorting them on the first next(), within the busy time of _traced"""
+    for hit in sorted(hits, key=key):
+        yield hit
+
+
+def _timed(hits, scan):
+    n = 0
+    busy = 0.0
+    try:
+        start = time.time()
+        for hit in hits:
+            busy += time.time() - start
+            n += 1
+            yield hit
+            start = time.time()
+        busy += time.time() - start
+    finally:
+        scan.set(hits=n, busy_ns=int(busy * 1e9))
+        scan.end()
+
+
+class _TracedSerializer(JSONSerializer):
+    """Decodes elasticsearch responses in an es.parse span, with the size of the response"""
+
+    def loads(self, s):
+        with span("es.parse", bytes=len(s)):
+            return JSONSerializer.loads(self, s)
+
+
+class LogStore(object):
+    """
+    Where AssertionChecker reads proxy logs from. Filters are elasticsearch filter clauses
+    (term, terms, prefix, exists and bool), hits are dicts with the log entry as _source.
+
+    Subclasses implement scan; fetch_slices, count and group_count have generic implementations
+    on top of it. Stores that can evaluate elasticsearch aggregations set aggregations to True
+    and implement search, which lets AssertionChecker run its query plans against them
+    """
+
+    aggregations = False
+
+    def scan(self, filter, sort=None):
+        """Yield the hits matching *filter*, sorted ascending on the *sort* field if given"""
+        raise NotImplementedError
+
+    def fetch_slices(self, filters):
+        """Hits matching each of *filters*, sorted on ts, as a list of lists"""
+        return [list(self.scan(filter, sort="ts")) for filter in filters]
+
+    def count(self, filter):
+        """Number of hits matching *filter*"""
+        return sum(1 for hit in self.scan(filter))
+
+    def group_count(self, filter, field, min_count=1, size=None):
+        """
+        Number of hits matching *filter* per value of *field*, for the values seen at least
+        *min_count* times. Returns GroupCounts(total hits, [(value, count)] most frequent first,
+        at most *size* of them, number of values seen at least *min_count* times)
+        """
+        total = 0
+        counts = defaultdict(int)
+        for hit in self.scan(filter):
+            total += 1
+            counts[hit['_source'].get(field)] += 1
+        groups = sorted([(v, c) for v, c in counts.items() if c >= min_count], key=lambda g: -g[1])
+        return GroupCounts(total, groups[:size] if size is not None else groups, len(groups))
+
+    def search(self, body):
+        """Run an elasticsearch query body, aggregations included"""
+        raise NotImplementedError
+
+    def tail(self, filter, poll_interval=1.0, stop=None):
+        """
+        Yield the hits matching *filter* as they reach the store, until the threading.Event *stop* is set.
+        New entries are looked for every poll_interval seconds
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class ElasticsearchStore(LogStore):
+    """Proxy logs in elasticsearch, read page by page through the scroll API"""
+
+    aggregations = True
+
+    def __init__(self, host, page_size=1000, scroll="1m"):
+        """
+        @param host: the elasticsearch host, or an Elasticsearch client
+        @param page_size: number of log entries fetched per round trip to elasticsearch
+        @param scroll: how long elasticsearch keeps a scroll context alive between two pages
+        """
+        self._es = host if hasattr(host, "search") else Elasticsearch(host, serializer=_TracedSerializer())
+        self.page_size = page_size
+        self.scroll = scroll
+
+    def _request(self, method, **kwargs):
+        """One round trip to elasticsearch, in an es.<method> span with the number of hits returned"""
+        with span("es." + method) as s:
+            data = getattr(self._es, method)(**kwargs)
+            if s.recording:
+                if "hits" in data:
+                    s.set(hits=len(data["hits"]["hits"]))
+                elif "responses" in data:
+                    s.set(hits=sum(len(r["hits"]["hits"]) for r in data["responses"] if "hits" in r))
+            return data
+
+    def scan(self, filter, sort=None):
+        """
+        Yield the hits matching *filter* page by page, so that no more than page_size
+        log entries are held at a time. Sorting is preserved across pages
+        """
+        data = self._request("search", body=_filtered(filter, sort), scroll=self.scroll, size=self.page_size)
+        scroll_id = data.get("_scroll_id")
+        # Stop once all hits are in, rather than asking for the empty page after the last one
+        remaining = data["hits"]["total"]
+        try:
+            while data["hits"]["hits"]:
+                for hit in data["hits"]["hits"]:
+                    yield hit
+                remaining -= len(data["hits"]["hits"])
+                if remaining <= 0:
+                    break
+                data = self._request("scroll", scroll_id=scroll_id, scroll=self.scroll)
+                scroll_id = data.get("_scroll_id", scroll_id)
+        finally:
+            if scroll_id is not None:
+                try:
+                    self._request("clear_scroll", scroll_id=scroll_id)
+                except Exception:
+                    pass
+
+    def fetch_slices(self, filters):
+        """
+        All slices in one multi-search round trip. Slices larger than page_size are
+        completed through the scroll API
+        """
+        body = []
+        for filter in filters:
+            query = _filtered(filter, sort="ts")
+            query["size"] = self.page_size
+            body.extend([{}, query])
+        slices = []
+        for filter, data in zip(filters, self._request("msearch", body=body)["responses"]):
+            if "error" not in data and data["hits"]["total"] <= len(data["hits"]["hits"]):
+                slices.append(data["hits"]["hits"])
+            else:
+                slices.append(list(self.scan(filter, sort="ts")))
+        return slices
+
+    def count(self, filter):
+        return self._request("count", body={"query": _filtered(filter)["query"]})["count"]
+
+    def group_count(self, filter, field, min_count=1, size=None):
+        body = _filtered(filter)
+        body["size"] = 0
+        body["aggs"] = {
+            "groups": {
+                "terms": {
+                    "field": field,
+                    "min_doc_count": min_count,
+                    # All the buckets over min_count, to count them: a cardinality aggregation would
+                    # count the values under it too. Only keys and counts come back, and the list
+                    # is cut to size here
+                    "size": 0,
+                    "order": {"_count": "desc"}
+                }
+            }
+        }
+        data = self._request("search", body=body)
+        groups = [(b["key"], b["doc_count"]) for b in data["aggregations"]["groups"]["buckets"]]
+        return GroupCounts(data["hits"]["total"], groups[:size] if size is not None else groups, len(groups))
+
+    def search(self, body):
+        return self._request("search", body=body)
+
+    def tail(self, filter, poll_interval=1.0, stop=None):
+        """
+        Poll for the hits with a ts at or after the last one seen, in ts order. Entries indexed
+        after entries with a later ts are missed, so this relies on the proxies shipping logs in order
+        """
+        stop = stop or threading.Event()
+        last_ts = None
+        seen = set()
+        while not stop.is_set():
+            query = filter if last_ts is None else {"bool": {"must": [filter, {"range": {"ts": {"gte": last_ts}}}]}}
+            for hit in self.scan(query, sort="ts"):
+                ts = hit['_source'].get("ts")
+                if ts == last_ts and hit["_id"] in seen:
+                    continue
+                if ts != last_ts:
+                    last_ts = ts
+                    seen = set()
+                seen.add(hit["_id"])
+                yield hit
+                if stop.is_set():
+                    return
+            stop.wait(poll_interval)
+
+
+class _LogFile(object):
+    """
+    A newline delimited JSON log file, memory mapped, with an index of the offset of every
+    line by (testid, source, dest). The index is saved next to the file, as <file>.idx, and
+    reused for as long as the file keeps the same size and modification time
+    """
+
+    def __init__(self, path, save_index=True):
+        self.path = path
+        self._file = open(path, "rb")
+        stat = os.fstat(self._file.fileno())
+        self._stamp = [stat.st_size, stat.st_mtime]
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else ""
+        self.edges = self._load_index()
+        if self.edges is None:
+            self.edges = self._build_index()
+            if save_index:
+                self._save_index()
+
+    def close(self):
+        if self._map:
+            self._map.close()
+        self._file.close()
+
+    def _load_index(self):
+        try:
+            with open(self.path + ".idx") as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if data.get("stamp") != self._stamp:
+            return None
+        return dict((tuple(key), offsets) for key, offsets in data["edges"])
+
+    def _save_index(self):
+        try:
+            with open(self.path + ".idx", "w") as f:
+                json.dump({"stamp": self._stamp,
+                           "edges": [[list(key), offsets] for key, offsets in self.edges.items()]}, f)
+        except IOError:
+            pass
+
+    def _build_index(self):
+        edges = defaultdict(list)
+        offset = 0
+        for line in iter(self._file.readline, ""):
+            # A last line still being written is left out, the file size changes once it is complete
+            if not line.endswith("\n"):
+                break
+            if line.strip():
+                log = self._source(json.loads(line))
+                edges[(log.get("testid"), log.get("source"), log.get("dest"))].append(offset)
+            offset += len(line)
+        return dict(edges)
+
+    @staticmethod
+    def _source(entry):
+        # Lines are either log entries or elasticsearch hits, as dumped by a scroll
+        return entry["_source"] if "_source" in entry else entry
+
+    def read(self, offset):
+        end = self._map.find("\n", offset)
+        return {"_source": self._source(json.loads(self._map[offset:end if end >= 0 else len(self._map)]))}
+
+    def offsets(self, testid=None, source=None, dest=None):
+        """Offsets of the lines of the given testid, source and dest (None matching any), in file order"""
+        if testid is not None and source is not None and dest is not None:
+            return self.edges.get((testid, source, dest), [])
+        return list(heapq.merge(*[offsets for (t, s, d), offsets in self.edges.items()
+                                  if (testid is None or t == testid) and
+                                  (source is None or s == source) and
+                                  (dest is None or d == dest)]))
+
+
+def _edge_terms(filter):
+    """testid, source and dest a filter requires (None where it does not restrict the field)"""
+    clauses = filter["bool"].get("must", []) if "bool" in filter else [filter]
+    terms = {}
+    for clause in clauses:
+        if "term" in clause:
+            field, value = clause["term"].items()[0]
+            if field in ("testid", "source", "dest"):
+                terms[field] = value
+    return terms.get("testid"), terms.get("source"), terms.get("dest")
+
+
+class FileLogStore(LogStore):
+    """
+    Proxy logs in local newline delimited JSON files, one log entry (or elasticsearch hit) per line.
+    Files are memory mapped and streamed; queries on a testid, source or dest only read the lines
+    the per file index points to. Lets checks run without an elasticsearch cluster, e.g. in CI
+    """
+
+    def __init__(self, paths, save_index=True):
+        """
+        @param paths: path, or list of paths, of log files
+        @param save_index: keep the index of each file next to it for later runs
+        """
+        if isinstance(paths, basestring):
+            paths = [paths]
+        self._paths = paths
+        self._save_index = save_index
+        self._files = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        with self._lock:
+            if self._files is None:
+                self._files = [_LogFile(path, self._save_index) for path in self._paths]
+        return self._files
+
+    def close(self):
+        with self._lock:
+            for f in self._files or []:
+                f.close()
+            self._files = None
+
+    def _hits(self, filter):
+        testid, source, dest = _edge_terms(filter)
+        for f in self._open():
+            for offset in f.offsets(testid, source, dest):
+                hit = f.read(offset)
+                if _match(filter, hit['_source']):
+                    yield hit
+
+    def scan(self, filter, sort=None):
+        if sort is None:
+            return _traced(self._hits(filter), "file.scan")
+        return _traced(_sorted(self._hits(filter), _sort_key(sort)), "file.scan")
+
+    def tail(self, filter, poll_interval=1.0, stop=None):
+        """Follow the log files from their beginning, like tail -f, as the proxies or logstash append to them"""
+        stop = stop or threading.Event()
+        files = [[open(path, "rb"), ""] for path in self._paths]
+        try:
+            while not stop.is_set():
+                idle = True
+                for f in files:
+                    for line in iter(f[0].readline, ""):
+                        # Hold on to a partly written last line until the rest of it comes in
+                        if not line.endswith("\n"):
+                            f[1] += line
+                            break
+                        line, f[1] = f[1] + line, ""
+                        idle = False
+                        if not line.strip():
+                            continue
+                        hit = {"_source": _LogFile._source(json.loads(line))}
+                        if _match(filter, hit['_source']):
+                            yield hit
+                            if stop.is_set():
+                                return
+                if idle:
+                    stop.wait(poll_interval)
+        finally:
+            for f in files:
+                f[0].close()
+
+
+# Log fields that are columns of the sqlite snapshot table, the rest is only in the JSON document
+_columns = ("testid", "source", "dest", "msg", "reqID", "status")
+
+
+def _where(clause):
+    """
+    SQL condition and parameters for a filter clause, as far as it can be evaluated on the
+    snapshot columns. Returns None for the parts that can only be checked on the documents
+    """
+    kind, spec = clause.items()[0]
+    if kind in ("term", "terms", "prefix"):
+        field, value = spec.items()[0]
+        if field not in _columns:
+            return None
+        if kind == "term":
+            return "{} = ?".format(field), [value]
+        if kind == "terms":
+            return "{} IN ({})".format(field, ",".join("?" * len(value))), list(value)
+        # LIKE is case insensitive in sqlite, which is fine to narrow down the rows
+        return "{} LIKE ? ESCAPE '\\'".format(field), [value.replace("\\", "\\\\").replace("%", "\\%")
+                                                         .replace("_", "\\_") + "%"]
+    if kind == "exists" and spec["field"] in _columns:
+        return "{} IS NOT NULL".format(spec["field"]), []
+    if kind == "bool":
+        must = [w for w in map(_where, spec.get("must", [])) if w is not None]
+        if must:
+            return " AND ".join("(%s)" % sql for sql, params in must), sum([params for sql, params in must], [])
+    return None
+
+
+class SQLiteLogStore(LogStore):
+    """
+    Proxy logs of one or more tests snapshotted into a local sqlite file (see snapshot).
+    testid, source, dest, msg, reqID and ts are indexed columns, so re-checking a test against
+    the snapshot does not touch elasticsearch at all
+    """
+
+    def __init__(self, path):
+        """
+        @param path: sqlite file written by snapshot
+        """
+        self.path = path
+        # sqlite connections cannot be shared across threads (see check_assertions(parallel=True)),
+        # every thread gets its own, all of them kept for close
+        self._local = threading.local()
+        self._connections = set()
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or conn not in self._connections:
+            # Only used by the thread that opens it, but closed by whichever thread calls close
+            conn = self._local.conn = sqlite3.connect(self.path, check_same_thread=False)
+            with self._lock:
+                self._connections.add(conn)
+        return conn
+
+    def close(self):
+        """Close the connections of all the threads that queried the store"""
+        with self._lock:
+            connections, self._connections = self._connections, set()
+        for conn in connections:
+            conn.close()
+
+    def _query(self, columns, filter, suffix="", params=()):
+        where = _where(filter)
+        sql = "SELECT {} FROM logs".format(columns)
+        args = []
+        if where is not None:
+            sql += " WHERE " + where[0]
+            args = where[1]
+        return self._connection().execute(sql + suffix, args + list(params))
+
+    def scan(self, filter, sort=None):
+        return _traced(self._scan(filter, sort), "sqlite.scan")
+
+    def _scan(self, filter, sort):
+        # A generator, so that the query, which sqlite runs up to the first row (the whole sort for
+        # an ORDER BY) when it is executed, counts in the busy time of the scan
+        if sort == "ts":
+            rows = self._query("doc", filter, " ORDER BY ts_ns IS NULL, ts_ns")
+        else:
+            rows = self._query("doc", filter)
+            if sort is not None:
+                for hit in _sorted(self._hits(rows, filter), _sort_key(sort)):
+                    yield hit
+                return
+        for hit in self._hits(rows, filter):
+            yield hit
+
+    @staticmethod
+    def _hits(rows, filter):
+        for doc, in rows:
+            hit = {"_source": json.loads(doc)}
+            if _match(filter, hit['_source']):
+                yield hit
+
+    def _exact(self, filter):
+        """True if the whole filter is evaluated by sqlite"""
+        kind, spec = filter.items()[0]
+        if kind == "bool":
+            return not spec.get("must_not") and not spec.get("should") and \
+                all(self._exact(c) for c in spec.get("must", []))
+        return kind in ("term", "terms", "exists") and _where(filter) is not None
+
+    def count(self, filter):
+        if not self._exact(filter):
+            return LogStore.count(self, filter)
+        with span("sqlite.count"):
+            return self._query("COUNT(*)", filter).fetchone()[0]
+
+    def group_count(self, filter, field, min_count=1, size=None):
+        if field not in _columns or not self._exact(filter):
+            return LogStore.group_count(self, filter, field, min_count, size)
+        with span("sqlite.group_count", field=field):
+            groups = self._query("{}, COUNT(*) AS n".format(field), filter,
+                                 " GROUP BY {} HAVING n >= ? ORDER BY n DESC LIMIT ?".format(field),
+                                 (min_count, size if size is not None else -1)).fetchall()
+            matched = len(groups)
+            if size is not None and matched == size:
+                # The listing is cut to size: count the values over min_count separately
+                matched = self._query("COUNT(*) FROM (SELECT {}".format(field), filter,
+                                      " GROUP BY {} HAVING COUNT(*) >= ?)".format(field),
+                                      (min_count,)).fetchone()[0]
+        return GroupCounts(self.count(filter), [(value, n) for value, n in groups], matched)
+
+
+def bulk_load(logs, path, test_id=None, batch_size=1000):
+    """
+    Write log entries (dicts) into the sqlite file at *path*, for use with SQLiteLogStore.
+    If test_id is given, entries of that test already in the file are replaced
+    @return: number of log entries written
+    """
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("CREATE TABLE IF NOT EXISTS logs (testid TEXT, source TEXT, dest TEXT, msg TEXT, "
+                     "reqID TEXT, status INTEGER, ts TEXT, ts_ns INTEGER, doc TEXT)")
+        conn.execute("DROP INDEX IF EXISTS logs_edge")
+        if test_id is not None:
+            conn.execute("DELETE FROM logs WHERE testid = ?", (test_id,))
+        count = 0
+        rows = []
+        for log in logs:
+            rows.append([log.get(c) for c in _columns] +
+                        [log.get("ts"), timestamp_ns(log["ts"]) if "ts" in log else None, json.dumps(log)])
+            if len(rows) == batch_size:
+                conn.executemany("INSERT INTO logs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                count += len(rows)
+                rows = []
+        conn.executemany("INSERT INTO logs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        count += len(rows)
+        # Indexing once all rows are in is much faster than maintaining the index on every insert
+        conn.execute("CREATE INDEX logs_edge ON logs (testid, source, dest, msg, reqID, ts_ns)")
+        conn.execute("CREATE INDEX IF NOT EXISTS logs_req ON logs (testid, reqID, ts_ns)")
+        conn.commit()
+    finally:
+        conn.close()
+    return count
+
+
+def snapshot(store, test_id, path, batch_size=1000):
+    """
+    Copy all log entries of a test from *store* (e.g. an ElasticsearchStore) into the sqlite file
+    at *path*, for later use with SQLiteLogStore. Several tests can be snapshotted into the same file;
+    snapshotting a test again replaces its entries
+    @return: number of log entries copied
+    """
+    return bulk_load((hit['_source'] for hit in store.scan({"term": {"testid": test_id}})),
+                     path, test_id=test_id, batch_size=batch_size)
@@ -0,0 +1,26 @@
+# coding=utf-8
+"""
+Snapshot the proxy logs of a test from elasticsearch into a local sqlite file, so that checklists
+can be re-checked against it with AssertionChecker(None, test_id, backend=SQLiteLogStore(path)).
+
+    python -m pygremlin.snapshot <elasticsearch host> <test id> <file>
+"""
+import argparse
+
+from .logstore import ElasticsearchStore, snapshot
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Snapshot the proxy logs of a test into a sqlite file")
+    parser.add_argument("host", help="elasticsearch host")
+    parser.add_argument("test_id", help="id of the test to snapshot")
+    parser.add_argument("path", help="sqlite file to write")
+    parser.add_argument("--page-size", type=int, default=1000,
+                        help="number of log entries fetched per round trip to elasticsearch")
+    args = parser.parse_args(argv)
+    count = snapshot(ElasticsearchStore(args.host, page_size=args.page_size), args.test_id, args.path)
+    print 'Copied %d log entries of test %s to %s' % (count, args.test_id, args.path)
+
+
+if __name__ == "__main__":
+    main()
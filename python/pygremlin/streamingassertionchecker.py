@@ -0,0 +1,265 @@
+# coding=utf-8
+import datetime
+import threading
+from collections import defaultdict
+
+from .assertionchecker import AssertionChecker, AssertionResult, _CircuitBreaker, _cb_event
+from .logstore import _match
+from .timeutil import duration_ns, timedelta_ns, timestamp_ns
+
+
+class AssertionViolation(Exception):
+    """Raised by watch_assertions as soon as a check is violated. result is the failed AssertionResult"""
+
+    def __init__(self, result):
+        Exception.__init__(self, "{}: {}".format(result.name, result.errormsg))
+        self.result = result
+
+
+class _Monitor(object):
+    """
+    Incremental state of a check over a stream of log entries. filter selects the entries the
+    check looks at; feed returns an error message when an entry violates the check, else None
+    """
+
+    # Whether seeing no log entries at all fails the check
+    requires_hits = True
+
+    def __init__(self, filter):
+        self.filter = filter
+        self.hits = 0
+
+    def feed(self, log):
+        raise NotImplementedError
+
+    def finish(self):
+        """Called once the stream ends, returns an error message for a violation only known then"""
+        return None
+
+
+class _NoProxyErrors(_Monitor):
+
+    # Passes exactly when the proxies logged no errors
+    requires_hits = False
+
+    def __init__(self, checker, **kwargs):
+        _Monitor.__init__(self, {"term": {"level": "error"}})
+
+    def feed(self, log):
+        return str(log)
+
+
+class _BoundedResponseTime(_Monitor):
+
+    def __init__(self, checker, source, dest, max_latency, **kwargs):
+        _Monitor.__init__(self, checker._edge_filter(source, dest, {"term": {"msg": "Response"}}))
+        self.dest = dest
+        self.max_latency = duration_ns(max_latency)
+        # Running max latency, so that only a new worst reply is reported
+        self.max_seen = self.max_latency
+
+    def feed(self, log):
+        duration = duration_ns(log["duration"]) if "duration" in log else -1
+        if duration > self.max_seen:
+            self.max_seen = duration
+            return "{} did not reply in time for request {}, {}ms".format(self.dest, log.get("reqID"), duration / 1e6)
+
+
+class _HttpSuccessStatus(_Monitor):
+
+    def __init__(self, checker, **kwargs):
+        _Monitor.__init__(self, {"exists": {"field": "status"}})
+
+    def feed(self, log):
+        if log["status"] != 200:
+            return "{} -> {} - request {} returned status {}".format(
+                log.get("source"), log.get("dest"), log.get("reqID"), log["status"])
+
+
+class _HttpStatus(_Monitor):
+
+    def __init__(self, checker, source, dest, status, req_id, **kwargs):
+        _Monitor.__init__(self, checker._edge_filter(source, dest,
+                                                     {"term": {"msg": "Response"}},
+                                                     {"term": {"req_id": req_id}},
+                                                     {"term": {"protocol": "http"}}))
+        self.source = source
+        self.dest = dest
+        self.status = status
+        self.req_id = req_id
+
+    def feed(self, log):
+        if log["status"] != self.status:
+            return "{} -> {} - expected status {}, but found {} for request {}".format(
+                self.source, self.dest, self.status, log["status"], self.req_id)
+
+
+class _AtMostRequests(_Monitor):
+
+    def __init__(self, checker, source, dest, num_requests, **kwargs):
+        _Monitor.__init__(self, checker._edge_filter(source, dest, {"term": {"msg": "Request"}},
+                                                     {"term": {"protocol": "http"}}))
+        self.source = source
+        self.dest = dest
+        self.num_requests = num_requests
+        self.counts = defaultdict(int)
+
+    def feed(self, log):
+        req_id = log["reqID"]
+        self.counts[req_id] += 1
+        if self.counts[req_id] == self.num_requests + 2:
+            return "{} -> {} - expected {} requests, but found more than {} requests for id {}".format(
+                self.source, self.dest, self.num_requests, self.num_requests, req_id)
+
+
+class _BoundedRetries(_Monitor):
+
+    def __init__(self, checker, source, dest, retries, wait_time=None,
+                 errdelta=datetime.timedelta(milliseconds=10), by_uri=False, **kwargs):
+        _Monitor.__init__(self, checker._edge_filter(source, dest, {"term": {"msg": "Request"}}))
+        self.source = source
+        self.dest = dest
+        self.retries = retries
+        self.wait_time = duration_ns(wait_time) if wait_time is not None else None
+        self.errdelta = timedelta_ns(errdelta)
+        self.key = "reqID" if not by_uri else "uri"
+        self.counts = defaultdict(int)
+        self.last_ts = {}
+
+    def feed(self, log):
+        key = log.get(self.key)
+        self.counts[key] += 1
+        attempt = self.counts[key] - 1
+        if attempt == self.retries + 1:
+            return "{} -> {} - expected {} retries, but found {} retries for request {}".format(
+                self.source, self.dest, self.retries, attempt, key)
+        if self.wait_time is None:
+            return None
+        ts = timestamp_ns(log["ts"])
+        last_ts, self.last_ts[key] = self.last_ts.get(key), ts
+        if last_ts is not None and not (self.wait_time - self.errdelta <= ts - last_ts <= self.wait_time + self.errdelta):
+            return "{} -> {} - expected {}+/-{}ms spacing for retry attempt {}, but request {} had a spacing of {}ms".format(
+                self.source, self.dest, self.wait_time / 1e6, self.errdelta / 1e6, attempt, key, (ts - last_ts) / 1e6)
+
+
+class _CircuitBreakerMonitor(_Monitor):
+
+    def __init__(self, checker, source, dest, headerprefix, closed_attempts, reset_time,
+                 halfopen_attempts=1, remove_retries=False, **kwargs):
+        _Monitor.__init__(self, checker._edge_filter(source, dest, {"prefix": {"reqID": headerprefix}},
+                                                     {"terms": {"msg": ["Request", "Response"]}}))
+        self.dest = dest
+        self.remove_retries = remove_retries
+        self.breakers = defaultdict(lambda: _CircuitBreaker(closed_attempts, reset_time, halfopen_attempts,
+                                                             checker.debug))
+        # With remove_retries, the last entry seen of each source, held back until the next
+        # entry tells whether it was the last of its run of retries
+        self.pending = {}
+
+    def _feed(self, source, event):
+        breaker = self.breakers[source]
+        req_spacing = breaker.feed(event)
+        if req_spacing is not None:
+            return "{} -> {} - new request was issued at ({}s) before reset_timer ({}s)expired".format(
+                source, self.dest, req_spacing / 1e9, breaker.reset_time / 1e9)
+
+    def feed(self, log):
+        source = log["source"]
+        event = _cb_event(log)
+        if not self.remove_retries:
+            return self._feed(source, event)
+        pending, self.pending[source] = self.pending.get(source), (log["reqID"], event)
+        if pending is not None and pending[0] != log["reqID"]:
+            return self._feed(source, pending[1])
+
+    def finish(self):
+        pending, self.pending = self.pending, {}
+        for source, (req_id, event) in pending.items():
+            errormsg = self._feed(source, event)
+            if errormsg is not None:
+                return errormsg
+
+
+class StreamingAssertionChecker(AssertionChecker):
+    """
+    An AssertionChecker that can also evaluate a checklist while the test is running.
+
+    watch_assertions follows the log entries of the test as they reach the log store (see LogStore.tail)
+    and keeps the state of every check up to date, entry by entry: counters, running max latency,
+    circuit breaker state machines. It raises AssertionViolation the moment a check fails, so that a
+    long test can be stopped early.
+    """
+
+    # Checks that can be evaluated incrementally
+    monitors = {
+        'no_proxy_errors': _NoProxyErrors,
+        'bounded_response_time': _BoundedResponseTime,
+        'http_success_status': _HttpSuccessStatus,
+        'http_status': _HttpStatus,
+        'bounded_retries': _BoundedRetries,
+        'circuit_breaker': _CircuitBreakerMonitor,
+        'at_most_requests': _AtMostRequests
+    }
+
+    def watch_assertions(self, checklist, duration=None, poll_interval=1.0, stop=None, raise_on_violation=True):
+        """
+        Check a set of assertions on the log entries of the test as they come in
+        @param duration seconds to watch for, None to watch until stop is set
+        @param poll_interval seconds between two looks for new log entries
+        @param stop threading.Event that ends the watch when set, e.g. by the thread running the load
+        @param raise_on_violation if False, keep watching after a violation and report it in the results
+        @return: list of AssertionResult, in checklist order, once the watch ends. A check that saw no
+                 log entries fails, as in check_assertions, except no_proxy_errors
+        """
+        assert isinstance(checklist, dict) and 'checks' in checklist
+        monitors = []
+        for assertion in checklist['checks']:
+            kwargs = dict(assertion)
+            name = kwargs.pop('name', None)
+            if name not in self.monitors:
+                raise ValueError("Check {} cannot be evaluated while the test is running".format(name))
+            monitors.append((name, kwargs, self.monitors[name](self, **kwargs)))
+        errormsgs = [None] * len(monitors)
+
+        def violated(i, errormsg):
+            name, kwargs, monitor = monitors[i]
+            if self.debug:
+                print errormsg
+            if errormsgs[i] is None:
+                errormsgs[i] = errormsg
+            if raise_on_violation:
+                raise AssertionViolation(AssertionResult(name, str(kwargs), False, errormsg))
+
+        stop = stop or threading.Event()
+        timer = None
+        if duration is not None:
+            timer = threading.Timer(duration, stop.set)
+            timer.daemon = True
+            timer.start()
+        # Proxy errors are not tied to a test
+        filter = {"term": {"testid": self._id}}
+        if any(name == 'no_proxy_errors' for name, kwargs, monitor in monitors):
+            filter = {"bool": {"should": [filter, {"term": {"level": "error"}}]}}
+        try:
+            for hit in self._store.tail(filter, poll_interval=poll_interval, stop=stop):
+                log = hit['_source']
+                for i, (name, kwargs, monitor) in enumerate(monitors):
+                    if _match(monitor.filter, log):
+                        monitor.hits += 1
+                        errormsg = monitor.feed(log)
+                        if errormsg is not None:
+                            violated(i, errormsg)
+            for i, (name, kwargs, monitor) in enumerate(monitors):
+                errormsg = monitor.finish()
+                if errormsg is not None:
+                    violated(i, errormsg)
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+        results = []
+        for (name, kwargs, monitor), errormsg in zip(monitors, errormsgs):
+            if errormsg is None and monitor.hits == 0 and monitor.requires_hits:
+                errormsg = "No log entries found"
+            results.append(AssertionResult(name, str(kwargs), errormsg is None, errormsg or ""))
+        return results
@@ -0,0 +1,368 @@
+# coding=utf-8
+"""
+An in-process fault injection proxy implementing ProxyInterface.md, for exercising FailureGenerator and
+AssertionChecker end to end on one machine, e.g. to benchmark them against hundreds of proxies.
+"""
+import BaseHTTPServer
+import SocketServer
+import datetime
+import json
+import random
+import re
+import select
+import socket
+import struct
+import threading
+import time
+
+import requests
+
+from .applicationgraph import ApplicationGraph
+from .failuregenerator import _canonical_rule, _rule_hash
+from .timeutil import duration_ns
+
+
+def _timestamp():
+    """Current time in the proxies' log format, RFC 3339 UTC with fractional seconds"""
+    now = time.time()
+    return datetime.datetime.utcfromtimestamp(now).strftime("%Y-%m-%dT%H:%M:%S.%f") + "Z"
+
+
+_patterns = {}
+
+
+def _matches(pattern, value):
+    """Whether the headerpattern or bodypattern regex *pattern* of a rule matches *value*"""
+    if pattern in ("*", ".*", ""):
+        return True
+    regex = _patterns.get(pattern)
+    if regex is None:
+        regex = _patterns[pattern] = re.compile(pattern)
+    return regex.search(value or "") is not None
+
+
+def _first_rule(rules, source, dest, messagetype, req_id, body=""):
+    """First of the (canonical) *rules* matching a message, as the proxies apply them, or None"""
+    for rule in rules:
+        if rule["source"] == source and rule["dest"] == dest and rule["messagetype"] == messagetype \
+                and _matches(rule["headerpattern"], req_id) and _matches(rule["bodypattern"], body):
+            return rule
+    return None
+
+
+class ProxyLog(object):
+    """
+    Sink for the JSON log entries of proxies, in the schema AssertionChecker queries. Entries are kept
+    in memory and/or appended to a newline delimited JSON file that FileLogStore can read
+    """
+
+    def __init__(self, path=None, keep=True):
+        """
+        @param path: file to append the log entries to, one JSON object per line
+        @param keep: also keep the entries in the entries list
+        """
+        self.entries = []
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._file = open(path, "a") if path is not None else None
+
+    def __call__(self, entry):
+        line = json.dumps(entry) + "\n" if self._file is not None else None
+        with self._lock:
+            if self.keep:
+                self.entries.append(entry)
+            if line is not None:
+                self._file.write(line)
+                self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class _ProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Buffer each response and send it in one go (flushed by handle_one_request), rather than
+    # header by header, which costs a delayed ACK round trip per request on keep-alive connections
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        if self.server.debug:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else ""
+
+    def _reply(self, code, body="", content_type="application/json"):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _control(self, method, path, body):
+        proxy = self.server
+        if path == "/gremlin/v1/rules/list" and method == "GET":
+            return self._reply(200, json.dumps(proxy.list_rules()))
+        if path == "/gremlin/v1/rules" and method == "DELETE":
+            proxy.clear_rules()
+            return self._reply(200)
+        if path.startswith("/gremlin/v1/test/"):
+            if method in ("GET", "PUT"):
+                proxy.test_id = path[len("/gremlin/v1/test/"):]
+            elif method == "DELETE":
+                proxy.test_id = None
+            return self._reply(200)
+        if method == "POST" and path in ("/gremlin/v1/rules/add", "/gremlin/v1/rules/add_batch", "/gremlin/v1/rules/remove"):
+            try:
+                data = json.loads(body)
+            except ValueError:
+                return self._reply(400, json.dumps({"error": "invalid JSON"}))
+            if path.endswith("/remove"):
+                return self._reply(200 if proxy.remove_rule(data) else 404)
+            proxy.add_rules(data if path.endswith("/add_batch") else [data])
+            return self._reply(200)
+        self._reply(404)
+
+    def _handle(self, method):
+        body = self._body()
+        path = self.path
+        if path.startswith("/gremlin/"):
+            return self._control(method, path, body)
+        self.server.forward(self, method, path, body)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+class GremlinProxy(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Fault injection proxy for the outbound calls of one instance of *service*. Requests to
+    http://<instance>/<dest>/<path> are forwarded to http://<upstreams[dest]>/<path>, or answered with
+    a 200 stub response when dest has no upstream. abort, delay and mangle rules are applied to them
+    when their headerpattern matches the X-Gremlin-ID header, and every request and response is logged
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    # Room for load generators opening many keep-alive connections at once
+    request_queue_size = 128
+
+    def __init__(self, service, upstreams=None, address=("127.0.0.1", 0), log=None, debug=False):
+        """
+        @param service: name of the service whose outbound calls go through the proxy
+        @param upstreams: dest -> "host:port" the calls to dest are forwarded to
+        @param address: (host, port) to listen on, port 0 for any free port
+        @param log: callable receiving each log entry (a dict), e.g. a ProxyLog
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, address, _ProxyHandler)
+        self.service = service
+        self.upstreams = upstreams or {}
+        self.log = log
+        self.debug = debug
+        self.test_id = None
+        self._rules = []
+        self._rules_lock = threading.Lock()
+        self._local = threading.local()
+        self._thread = None
+
+    @property
+    def instance(self):
+        """host:port of the proxy, as listed in service_proxies"""
+        return "{}:{}".format(*self.server_address[:2])
+
+    def start(self):
+        """Serve in a background thread of its own (see ProxyPool to serve many proxies from one thread)"""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self.shutdown()
+            self._thread = None
+        self.server_close()
+
+    def add_rules(self, rules):
+        with self._rules_lock:
+            self._rules = self._rules + [_canonical_rule(rule) for rule in rules]
+
+    def remove_rule(self, rule):
+        key = _rule_hash(rule)
+        with self._rules_lock:
+            for i, installed in enumerate(self._rules):
+                if _rule_hash(installed) == key:
+                    self._rules = self._rules[:i] + self._rules[i + 1:]
+                    return True
+        return False
+
+    def list_rules(self):
+        return list(self._rules)
+
+    def clear_rules(self):
+        with self._rules_lock:
+            self._rules = []
+
+    def _rule(self, dest, messagetype, req_id, body):
+        """First installed rule matching a message, if any"""
+        # The rules list is replaced, never changed in place, so it can be read without the lock
+        return _first_rule(self._rules, self.service, dest, messagetype, req_id, body)
+
+    @staticmethod
+    def _faults(rule):
+        """The faults of *rule* that fire this time, drawn with the rule's probabilities"""
+        if rule is None:
+            return []
+        return [fault for fault in ("abort", "delay", "mangle")
+                if rule[fault + "probability"] > 0 and random.random() < rule[fault + "probability"]]
+
+    def _log(self, msg, dest, req_id, **fields):
+        if self.log is None:
+            return
+        entry = {"level": "info", "msg": msg, "source": self.service, "dest": dest, "reqID": req_id,
+                 "testid": self.test_id, "protocol": "http", "ts": _timestamp()}
+        entry.update(fields)
+        self.log(entry)
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def forward(self, handler, method, path, body):
+        start = time.time()
+        parts = path.split("/", 2)
+        dest = parts[1]
+        rest = "/" + (parts[2] if len(parts) > 2 else "")
+        req_id = handler.headers.get("X-Gremlin-ID")
+        rule = self._rule(dest, "request", req_id, body)
+        faults = self._faults(rule)
+        self._log("Request", dest, req_id, uri=rest, actions=faults)
+        if "abort" in faults:
+            if rule["errorcode"] < 0:
+                # Reset the connection
+                handler.close_connection = 1
+                handler.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                self._log("Response", dest, req_id, status=-1, duration="{:.3f}ms".format((time.time() - start) * 1e3),
+                          actions=faults)
+                return
+            status, content = rule["errorcode"], ""
+        else:
+            if "delay" in faults:
+                time.sleep(duration_ns(rule["delaytime"]) / 1e9)
+            if "mangle" in faults and rule["searchstring"]:
+                body = body.replace(rule["searchstring"].encode("utf-8"), rule["replacestring"].encode("utf-8"))
+            upstream = self.upstreams.get(dest)
+            if upstream is None:
+                status, content = 200, "ok"
+            else:
+                headers = dict((k, v) for k, v in handler.headers.items() if k.lower() not in ("host", "content-length"))
+                try:
+                    resp = self._session().request(method, "http://{}{}".format(upstream, rest),
+                                                   headers=headers, data=body or None, timeout=30)
+                    status, content = resp.status_code, resp.content
+                except requests.exceptions.RequestException, e:
+                    self._log("Response", dest, req_id, level="error", errmsg=str(e), status=502,
+                              duration="{:.3f}ms".format((time.time() - start) * 1e3))
+                    return handler._reply(502)
+            response_rule = self._rule(dest, "response", req_id, content)
+            response_faults = self._faults(response_rule)
+            if "abort" in response_faults:
+                status, content = response_rule["errorcode"], ""
+            if "delay" in response_faults:
+                time.sleep(duration_ns(response_rule["delaytime"]) / 1e9)
+            if "mangle" in response_faults and response_rule["searchstring"]:
+                content = content.replace(response_rule["searchstring"].encode("utf-8"),
+                                          response_rule["replacestring"].encode("utf-8"))
+            faults = faults + response_faults
+        self._log("Response", dest, req_id, status=status,
+                  duration="{:.3f}ms".format((time.time() - start) * 1e3), actions=faults)
+        handler._reply(status, content, content_type="text/plain")
+
+
+class ProxyPool(object):
+    """
+    Many GremlinProxy instances served from a single thread, which polls all their listening sockets;
+    only requests in flight get a thread of their own. Lets one process run hundreds of proxies
+    """
+
+    def __init__(self, log=None, debug=False):
+        """
+        @param log: log sink shared by all proxies, e.g. a ProxyLog
+        """
+        self.log = log
+        self.debug = debug
+        self.proxies = []
+        self._thread = None
+        self._running = False
+        self._wakeup = socket.socketpair()
+
+    def add(self, service, upstreams=None, address=("127.0.0.1", 0)):
+        """Create a proxy for an instance of *service*. Proxies added while the pool is running are served too"""
+        proxy = GremlinProxy(service, upstreams=upstreams, address=address, log=self.log, debug=self.debug)
+        self.proxies.append(proxy)
+        self._wakeup[1].send("x")
+        return proxy
+
+    def _serve(self):
+        while self._running:
+            servers = dict((proxy.fileno(), proxy) for proxy in self.proxies)
+            poller = select.poll()
+            for fd in servers:
+                poller.register(fd, select.POLLIN)
+            poller.register(self._wakeup[0].fileno(), select.POLLIN)
+            for fd, event in poller.poll():
+                if fd == self._wakeup[0].fileno():
+                    self._wakeup[0].recv(4096)
+                    break
+                servers[fd]._handle_request_noblock()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._wakeup[1].send("x")
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for proxy in self.proxies:
+            proxy.server_close()
+        self._wakeup[0].close()
+        self._wakeup[1].close()
+
+    def application(self, dependencies, instances=1, upstreams=None):
+        """
+        Start proxies for an application and return its ApplicationGraph, with the proxies as service_proxies
+        @param dependencies: service -> list of the services it calls, as in the topology JSON
+        @param instances: number of proxy instances per calling service
+        @param upstreams: service -> "host:port" to forward calls to it to, if any
+        """
+        services = set(dependencies)
+        for dests in dependencies.values():
+            services.update(dests)
+        spec = {"services": [], "dependencies": dependencies}
+        for service in sorted(services):
+            entry = {"name": service}
+            if dependencies.get(service):
+                routes = dict((dest, (upstreams or {}).get(dest)) for dest in dependencies[service])
+                entry["service_proxies"] = [self.add(service, dict((d, u) for d, u in routes.items() if u)).instance
+                                            for i in range(instances)]
+            spec["services"].append(entry)
+        return ApplicationGraph(spec)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import datetime
+import re
+
+import isodate
+from isodate.tzinfo import FixedOffset
+
+# Go style durations as written in rules and proxy logs: "10ms", "1s500ms", "1.5h", "250µs"
+_duration_re = re.compile(r"([0-9]*(?:\.[0-9]*)?)(\D+)", re.UNICODE)
+_unit_ns = {
+    "h": 3600 * 10**9,
+    "m": 60 * 10**9,
+    "s": 10**9,
+    "ms": 10**6,
+    "us": 10**3,
+    u"µs": 10**3,
+    u"μs": 10**3,
+    "\xc2\xb5s": 10**3,
+    "ns": 1,
+}
+
+# RFC 3339 timestamps as logged by the proxies, e.g. 2016-03-07T17:29:01.123456789Z
+_timestamp_re = re.compile(r"^(\d{4})-(\d\d)-(\d\d)[Tt ](\d\d):(\d\d):(\d\d)(?:\.(\d{1,9}))?"
+                           r"(?:([Zz])|([+-])(\d\d):?(\d\d))$")
+_epoch_ordinal = datetime.date(1970, 1, 1).toordinal()
+_epoch = datetime.datetime(1970, 1, 1, tzinfo=isodate.UTC)
+
+
+# Bounded cache of parsed durations. Like the re module's pattern cache, it is simply
+# emptied when full: on Python 2 least recently used bookkeeping costs more than a parse
+_durations = {}
+_max_durations = 1024
+_offsets = {}
+
+
+def duration_ns(s):
+    """
+    Nanoseconds in a duration string such as "10ms" or "1s500ms".
+    Durations are cached, as the same few strings come up over and over again in logs and rules
+    """
+    ns = _durations.get(s)
+    if ns is not None:
+        return ns
+    if len(_durations) >= _max_durations:
+        _durations.clear()
+    ns = 0
+    for value, unit in _duration_re.findall(s):
+        if unit not in _unit_ns:
+            raise ValueError("Unknown time unit in duration {!r}".format(s))
+        try:
+            ns += int(round(float(value) * _unit_ns[unit]))
+        except ValueError:
+            # A unit without a number, treated as an empty duration
+            return 0
+    _durations[s] = ns
+    return ns
+
+
+def parse_duration(s):
+    """Duration string such as "10ms" or "1s500ms" as a timedelta"""
+    return datetime.timedelta(microseconds=duration_ns(s) // 1000)
+
+
+def timedelta_ns(delta):
+    return ((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds) * 1000
+
+
+def _days(year, month, day):
+    """Days since the epoch"""
+    return datetime.date(year, month, day).toordinal() - _epoch_ordinal
+
+
+def _seconds(hour, minute, second):
+    """Seconds since midnight, rejecting times isodate would reject too"""
+    if hour > 23 or minute > 59 or second > 59:
+        raise ValueError("Time out of range: {:02d}:{:02d}:{:02d}".format(hour, minute, second))
+    return hour * 3600 + minute * 60 + second
+
+
+def _offset_seconds(m):
+    if m.group(8) is not None:
+        return 0
+    seconds = int(m.group(10)) * 3600 + int(m.group(11)) * 60
+    return -seconds if m.group(9) == "-" else seconds
+
+
+def timestamp_ns(ts):
+    """
+    Nanoseconds since the epoch of a timestamp. RFC 3339 timestamps, as logged by the proxies,
+    take a fast path; anything else goes through isodate. Timestamps without a time zone are UTC
+    """
+    # The proxies' own format: UTC, with or without fractional seconds
+    if ts[-1:] == "Z" and ts[4:5] == "-" and ts[10:11] == "T" and (len(ts) == 20 or ts[19:20] == "."):
+        try:
+            days = _days(int(ts[0:4]), int(ts[5:7]), int(ts[8:10]))
+            seconds = days * 86400 + _seconds(int(ts[11:13]), int(ts[14:16]), int(ts[17:19]))
+            return seconds * 10**9 + (int(ts[20:-1].ljust(9, "0")[:9]) if len(ts) > 21 else 0)
+        except ValueError:
+            pass
+    m = _timestamp_re.match(ts)
+    if m is None:
+        dt = isodate.parse_datetime(ts)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=isodate.UTC)
+        return timedelta_ns(dt - _epoch)
+    days = _days(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+    seconds = days * 86400 + _seconds(int(m.group(4)), int(m.group(5)), int(m.group(6)))
+    fraction = m.group(7)
+    ns = int(fraction.ljust(9, "0")) if fraction else 0
+    return (seconds - _offset_seconds(m)) * 10**9 + ns
+
+
+def parse_timestamp(ts):
+    """
+    Timestamp string as a timezone aware datetime, with the same fast path as timestamp_ns.
+    Drop in replacement for isodate.parse_datetime
+    """
+    m = _timestamp_re.match(ts)
+    if m is None:
+        return isodate.parse_datetime(ts)
+    fraction = m.group(7)
+    if m.group(8) is not None:
+        tz = isodate.UTC
+    else:
+        offset = _offset_seconds(m)
+        tz = _offsets.get(offset)
+        if tz is None:
+            sign = -1 if offset < 0 else 1
+            tz = _offsets[offset] = FixedOffset(sign * (abs(offset) // 3600), sign * (abs(offset) % 3600 // 60),
+                                                 m.group(9) + m.group(10) + ":" + m.group(11))
+    return datetime.datetime(int(m.group(1)), int(m.group(2)), int(m.group(3)),
+                             int(m.group(4)), int(m.group(5)), int(m.group(6)),
+                             int(fraction[:6].ljust(6, "0")) if fraction else 0, tz)
@@ -14,5 +14,11 @@ setup(
         'elasticsearch',
         'isodate'
       ],
+    extras_require = {
+        'fast': ['numpy']
+    },
+    entry_points = {
+        'console_scripts': ['gremlin-snapshot = pygremlin.snapshot:main']
+    },
     zip_safe = False
 )
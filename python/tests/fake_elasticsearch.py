@@ -0,0 +1,91 @@
+# coding=utf-8
+"""An in-memory stand-in for the Elasticsearch client methods ElasticsearchStore calls"""
+import copy
+
+from pygremlin.logstore import _match, _sort_key
+from pygremlin.timeutil import timestamp_ns
+
+
+def _matches(clause, log):
+    kind, spec = clause.items()[0]
+    if kind == "range":
+        field, bounds = spec.items()[0]
+        if field not in log:
+            return False
+        value = timestamp_ns(log[field]) if field == "ts" else log[field]
+        for op, bound in bounds.items():
+            bound = timestamp_ns(bound) if field == "ts" else bound
+            if not {"gt": value > bound, "gte": value >= bound, "lt": value < bound, "lte": value <= bound}[op]:
+                return False
+        return True
+    if kind == "bool":
+        return (all(_matches(c, log) for c in spec.get("must", [])) and
+                not any(_matches(c, log) for c in spec.get("must_not", [])) and
+                (not spec.get("should") or any(_matches(c, log) for c in spec["should"])))
+    return _match(clause, log)
+
+
+class FakeElasticsearch(object):
+    """
+    Holds log entries in memory and answers search, scroll, clear_scroll, msearch and count
+    for filtered queries. Every call is recorded in calls as (method, kwargs)
+    """
+
+    def __init__(self, logs=()):
+        self.logs = []
+        self.calls = []
+        self.scrolls = {}
+        # Indexes of the msearch queries to answer with an error
+        self.msearch_errors = set()
+        for log in logs:
+            self.index(log)
+
+    def index(self, log):
+        self.logs.append({"_id": str(len(self.logs)), "_source": copy.deepcopy(log)})
+
+    def _hits(self, body):
+        hits = [hit for hit in self.logs if _matches(body["query"]["filtered"]["filter"], hit["_source"])]
+        for sort in body.get("sort", []):
+            hits.sort(key=_sort_key(sort.keys()[0]))
+        return hits
+
+    def _page(self, scroll_id):
+        hits, size = self.scrolls[scroll_id]
+        self.scrolls[scroll_id] = (hits[size:], size)
+        return {"_scroll_id": scroll_id, "hits": {"total": len(hits), "hits": hits[:size]}}
+
+    def search(self, body, scroll=None, size=10):
+        self.calls.append(("search", {"body": body, "scroll": scroll, "size": size}))
+        hits = self._hits(body)
+        if scroll is None:
+            return {"hits": {"total": len(hits), "hits": hits[:body.get("size", size)]}}
+        scroll_id = "scroll-%d" % len(self.calls)
+        self.scrolls[scroll_id] = (hits, size)
+        return self._page(scroll_id)
+
+    def scroll(self, scroll_id, scroll=None):
+        self.calls.append(("scroll", {"scroll_id": scroll_id}))
+        return self._page(scroll_id)
+
+    def clear_scroll(self, scroll_id):
+        self.calls.append(("clear_scroll", {"scroll_id": scroll_id}))
+        del self.scrolls[scroll_id]
+        return {}
+
+    def msearch(self, body):
+        self.calls.append(("msearch", {"body": body}))
+        responses = []
+        for i, query in enumerate(body[1::2]):
+            if i in self.msearch_errors:
+                responses.append({"error": "SearchPhaseExecutionException[too many clauses]"})
+                continue
+            hits = self._hits(query)
+            responses.append({"hits": {"total": len(hits), "hits": hits[:query.get("size", 10)]}})
+        return {"responses": responses}
+
+    def count(self, body):
+        self.calls.append(("count", {"body": body}))
+        return {"count": len(self._hits({"query": body["query"]}))}
+
+    def methods(self):
+        return [method for method, kwargs in self.calls]
@@ -0,0 +1,78 @@
+# coding=utf-8
+import random
+import unittest
+
+import networkx as nx
+
+from pygremlin import ApplicationGraph
+
+
+def random_graph(n, edges, seed):
+    rnd = random.Random(seed)
+    dependencies = {}
+    for k in range(edges):
+        source, dest = rnd.randrange(n), rnd.randrange(n)
+        if source != dest:
+            dependencies.setdefault("s%d" % source, []).append("s%d" % dest)
+    return ApplicationGraph({"services": [{"name": "s%d" % i} for i in range(n)], "dependencies": dependencies})
+
+
+class ApplicationGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = ApplicationGraph({
+            "services": [{"name": "gateway", "service_proxies": ["127.0.0.1:9877"]},
+                         {"name": "productpage", "service_proxies": ["127.0.0.1:9876"]},
+                         {"name": "reviews"}, {"name": "details"}],
+            "dependencies": {"gateway": ["productpage"], "productpage": ["reviews", "details"]}})
+
+    def test_lookups_return_lists(self):
+        services = self.app.get_services()
+        self.assertIsInstance(services, list)
+        self.assertEqual(sorted(services), ["details", "gateway", "productpage", "reviews"])
+        dependencies = self.app.get_dependencies("productpage")
+        self.assertEqual(sorted(dependencies), ["details", "reviews"])
+        # Callers own the lists they get
+        dependencies.append("ratings")
+        services.remove("gateway")
+        self.assertEqual(sorted(self.app.get_dependencies("productpage")), ["details", "reviews"])
+        self.assertTrue(self.app.has_service("gateway"))
+        self.assertEqual(self.app.get_dependents("productpage"), ["gateway"])
+        self.assertEqual(self.app.get_dependents("gateway"), [])
+
+    def test_index_follows_graph_changes(self):
+        self.app.get_dependencies("reviews")
+        self.app.add_service("ratings")
+        self.app.add_dependency("reviews", "ratings")
+        self.assertEqual(self.app.get_dependencies("reviews"), ["ratings"])
+        self.assertEqual(self.app.upstream_closure("ratings"), frozenset(["reviews", "productpage", "gateway"]))
+
+    def test_closures(self):
+        self.assertEqual(self.app.downstream_closure("gateway"), frozenset(["productpage", "reviews", "details"]))
+        self.assertEqual(self.app.upstream_closure("details"), frozenset(["productpage", "gateway"]))
+        self.assertEqual(self.app.downstream_closure("details"), frozenset())
+        self.assertEqual(self.app.blast_radius(["reviews"]), frozenset(["reviews", "productpage", "gateway"]))
+
+    def test_closures_with_cycles(self):
+        app = ApplicationGraph({"services": [{"name": s} for s in "abcd"],
+                                "dependencies": {"a": ["b"], "b": ["c"], "c": ["a", "d"]}})
+        self.assertEqual(app.downstream_closure("a"), frozenset("bcd"))
+        self.assertEqual(app.upstream_closure("a"), frozenset("bc"))
+        self.assertEqual(app.upstream_closure("d"), frozenset("abc"))
+
+    def test_closures_match_networkx(self):
+        for seed in range(200):
+            app = random_graph(random.Random(seed).randint(1, 30), random.Random(seed).randint(0, 60), seed)
+            graph = app._get_networkX()
+            for service in app.get_services():
+                self.assertEqual(app.downstream_closure(service), frozenset(nx.descendants(graph, service)))
+                self.assertEqual(app.upstream_closure(service), frozenset(nx.ancestors(graph, service)))
+            failed = app.get_services()[:3]
+            expected = set(failed)
+            for service in failed:
+                expected |= nx.ancestors(graph, service)
+            self.assertEqual(app.blast_radius(failed), frozenset(expected))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,298 @@
+# coding=utf-8
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from pygremlin import AssertionChecker, FileLogStore, LogStore, SQLiteLogStore, bulk_load, instrumentation, logstore
+from pygremlin.assertionchecker import CheckCost
+from pygremlin.instrumentation import SpanRecorder
+
+
+def _ts(ms):
+    return "2016-01-01T00:%02d:%02d.%03d000Z" % (ms // 60000, ms // 1000 % 60, ms % 1000)
+
+
+def request_logs(source, dest, counts, test_id="T", responses=False, status=200, duration=5):
+    """
+    Request log entries from source to dest, counts[req_id] of them per request id, 10ms apart.
+    With responses set, each request is answered with *status* after *duration* ms
+    """
+    logs = []
+    n = 0
+    for req_id in sorted(counts):
+        for i in range(counts[req_id]):
+            common = {"level": "info", "source": source, "dest": dest, "reqID": req_id, "testid": test_id,
+                      "protocol": "http", "uri": "/" + dest}
+            logs.append(dict(common, msg="Request", ts=_ts(n * 10)))
+            if responses:
+                logs.append(dict(common, msg="Response", ts=_ts(n * 10 + duration), status=status,
+                                 duration="%dms" % duration))
+            n += 1
+    return logs
+
+
+class CountingStore(LogStore):
+    """Delegates to *store*, counting the round trips made to it"""
+
+    def __init__(self, store):
+        self.store = store
+        self.calls = []
+
+    def scan(self, filter, sort=None):
+        self.calls.append("scan")
+        return self.store.scan(filter, sort)
+
+    def fetch_slices(self, filters):
+        self.calls.append("fetch_slices")
+        return self.store.fetch_slices(filters)
+
+
+class LogsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def file_store(self, logs):
+        path = os.path.join(self.dir, "proxy.log")
+        with open(path, "w") as f:
+            for log in logs:
+                f.write(json.dumps(log) + "\n")
+        return FileLogStore(path, save_index=False)
+
+    def sqlite_store(self, logs):
+        path = os.path.join(self.dir, "test.db")
+        bulk_load(logs, path, test_id="T")
+        return SQLiteLogStore(path)
+
+
+class OffendingIdsTest(LogsTestCase):
+
+    def setUp(self):
+        LogsTestCase.setUp(self)
+        counts = dict(("req-%d" % i, 3) for i in range(8))
+        counts.update(("ok-%d" % i, 1) for i in range(4))
+        self.logs = request_logs("A", "B", counts)
+
+    def check(self, store):
+        checker = AssertionChecker(None, "T", backend=store, max_offenders=2)
+        listed = store.group_count(checker._edge_filter("A", "B"), "reqID", min_count=2, size=2)
+        self.assertEqual(listed.total, 28)
+        self.assertEqual(len(listed.groups), 2)
+        self.assertEqual(listed.matched, 8)
+        result = checker._plan_at_most_requests("A", "B", 1, all=True)
+        self.assertFalse(result.success)
+        self.assertTrue(result.errormsg.endswith("(8 violations)"), result.errormsg)
+
+    def test_count_is_not_capped_by_max_offenders(self):
+        self.check(self.file_store(self.logs))
+
+    def test_count_is_not_capped_by_max_offenders_in_sqlite(self):
+        self.check(self.sqlite_store(self.logs))
+
+
+class AnySourceChecker(AssertionChecker):
+    """Reads the logs of every source calling dest when source is None"""
+
+    def _edge_filter(self, source, dest, *clauses):
+        edge_filter = AssertionChecker._edge_filter(self, source, dest, *clauses)
+        if source is None:
+            edge_filter["bool"]["must"].pop(0)
+        return edge_filter
+
+
+class CircuitBreakersTest(LogsTestCase):
+
+    def setUp(self):
+        LogsTestCase.setUp(self)
+        # Both sources keep calling B right after their circuit should have opened
+        self.logs = request_logs("A1", "B", {"req-1": 4}, responses=True, status=503) + \
+            request_logs("A2", "B", {"req-2": 4}, responses=True, status=503)
+        self.checker = AnySourceChecker(None, "T", backend=self.file_store(self.logs))
+        self.configs = [{"closed_attempts": 1, "reset_time": "1s"},
+                        {"closed_attempts": 10, "reset_time": "1s"}]
+
+    def test_first_violation_only(self):
+        results = self.checker.check_circuit_breakers("A1", "B", "req-", self.configs) + \
+            self.checker.check_circuit_breakers("A2", "B", "req-", self.configs)
+        self.assertEqual([r.success for r in results], [False, True, False, True])
+        results = self.checker.check_circuit_breakers(None, "B", "req-", self.configs)
+        self.assertEqual([r.success for r in results], [False, True])
+        self.assertFalse(results[0].errormsg.endswith("violations)"), results[0].errormsg)
+
+    def test_all_violations(self):
+        results = self.checker.check_circuit_breakers(None, "B", "req-", self.configs, all=True)
+        self.assertEqual([r.success for r in results], [False, True])
+        self.assertTrue(results[0].errormsg.endswith("(4 violations)"), results[0].errormsg)
+
+
+class BulkheadTest(LogsTestCase):
+
+    def setUp(self):
+        LogsTestCase.setUp(self)
+        # A calls B every 10ms, and never calls C
+        self.checker = AssertionChecker(None, "T", backend=self.file_store(
+            request_logs("A", "B", dict(("req-%d" % i, 1) for i in range(5)))))
+
+    def test_violations_are_kept_when_a_dependency_has_no_requests(self):
+        for all in (False, True):
+            result = self.checker.check_bulkhead("A", ["B", "C", "S"], "S", 200, all=all)
+            self.assertFalse(result.success)
+            self.assertTrue(result.errormsg.startswith("A -> B - new request"), result.errormsg)
+        self.assertTrue(result.errormsg.endswith("(5 violations)"), result.errormsg)
+
+    def test_no_requests(self):
+        self.assertEqual(self.checker.check_bulkhead("A", ["C", "B"], "S", 200).errormsg, "No log entries found")
+        self.assertTrue(self.checker.check_bulkhead("A", ["B", "S"], "S", 50).success)
+
+
+class EdgeHitsTest(LogsTestCase):
+
+    clauses = [
+        [{"term": {"msg": "Response"}}],
+        [{"terms": {"msg": ["Request", "Response"]}}],
+        [{"term": {"msg": "Request"}}, {"term": {"protocol": "http"}}],
+        [{"prefix": {"reqID": "req-1"}}, {"term": {"reqID": "req-1"}}, {"term": {"msg": "Response"}}],
+        [{"term": {"reqID": "missing"}}],
+        [{"term": {"protocol": "http"}}],
+    ]
+
+    def test_prefetched_slices_answer_like_the_store(self):
+        counts = dict(("req-%d" % i, 1 + i % 3) for i in range(12))
+        logs = request_logs("A", "B", counts, responses=True) + request_logs("A", "C", counts, responses=True)
+        checker = AssertionChecker(None, "T", backend=self.file_store(logs))
+        fused = checker._with_slices(checker._fetch_slices([("A", "B")]))
+        index = fused._slices[("A", "B")]
+        lookups = []
+        rows_in = index.rows_in
+        index.rows_in = lambda key, values: lookups.append(key) or rows_in(key, values)
+        for clauses in self.clauses:
+            expected = list(checker._edge_hits("A", "B", clauses, sort=True))
+            self.assertEqual(list(fused._edge_hits("A", "B", clauses)), expected, clauses)
+        # Every clause list but the last has a term on an indexed field
+        self.assertEqual(lookups, ["_source.msg", "_source.msg", "_source.msg", "_source.reqID", "_source.reqID"])
+        # Edges without a slice still go to the store
+        self.assertEqual(list(fused._edge_hits("A", "C", self.clauses[0], sort=True)),
+                         list(checker._edge_hits("A", "C", self.clauses[0], sort=True)))
+
+
+class ChecklistTestCase(LogsTestCase):
+
+    checklist = {"checks": [
+        {"name": "bounded_response_time", "source": "A", "dest": "B", "max_latency": "100ms"},
+        {"name": "bounded_response_time", "source": "A", "dest": "B", "max_latency": "2ms"},
+        {"name": "at_most_requests", "source": "A", "dest": "B", "num_requests": 1},
+        {"name": "bounded_retries", "source": "A", "dest": "B", "retries": 2},
+        {"name": "bounded_retries", "source": "A", "dest": "C", "retries": 0},
+        {"name": "circuit_breaker", "source": "A", "dest": "B", "closed_attempts": 2, "reset_time": "1s",
+         "headerprefix": "req-"}
+    ]}
+
+    def setUp(self):
+        LogsTestCase.setUp(self)
+        counts = dict(("req-%d" % i, 1 + i % 3) for i in range(10))
+        self.logs = request_logs("A", "B", counts, responses=True, status=503) + \
+            request_logs("A", "C", dict(("req-%d" % i, 1) for i in range(5)), responses=True)
+
+
+class FusedChecksTest(ChecklistTestCase):
+
+    def test_one_round_trip(self):
+        store = CountingStore(self.file_store(self.logs))
+        checker = AssertionChecker(None, "T", backend=store)
+        fused = checker.check_assertions(self.checklist, all=True, fused=True)
+        self.assertEqual(store.calls, ["fetch_slices"])
+        self.assertEqual(checker._slices, None)
+        store.calls = []
+        unfused = checker.check_assertions(self.checklist, all=True)
+        self.assertEqual(len(store.calls), len(self.checklist["checks"]))
+        self.assertEqual([r[:4] for r in fused], [r[:4] for r in unfused])
+        self.assertEqual([r.success for r in fused], [True, False, False, True, True, False])
+
+
+class ParallelChecksTest(ChecklistTestCase):
+
+    def test_parallel_checks_share_one_pool(self):
+        checker = AssertionChecker(None, "T", backend=self.file_store(self.logs))
+        try:
+            serial = checker.check_assertions(self.checklist, all=True)
+            parallel = checker.check_assertions(self.checklist, all=True, parallel=True, max_workers=4)
+            pool = checker._pool
+            self.assertEqual([r[:4] for r in parallel], [r[:4] for r in serial])
+            checker.check_assertions(self.checklist, all=True, parallel=True, fused=True, max_workers=4)
+            self.assertIs(checker._pool, pool)
+            # Stops at the first failure, in checklist order
+            first = checker.check_assertions(self.checklist, parallel=True, max_workers=4)
+            self.assertEqual([r.success for r in first], [True, False])
+        finally:
+            checker.close()
+        self.assertEqual(checker._pool, None)
+
+
+class CheckCostTest(LogsTestCase):
+
+    def setUp(self):
+        LogsTestCase.setUp(self)
+        self.logs = request_logs("A", "B", dict(("req-%d" % i, 2) for i in range(20)), responses=True, status=503)
+        self.check = {"name": "circuit_breaker", "source": "A", "dest": "B", "closed_attempts": 1,
+                      "reset_time": "1s", "headerprefix": "req-"}
+
+    def test_results_are_still_4_tuples(self):
+        checker = AssertionChecker(None, "T", backend=self.file_store(self.logs), profile=True)
+        result = checker.check_assertion(**self.check)
+        name, info, success, errormsg = result
+        self.assertEqual((name, success), ("circuit_breaker", False))
+        self.assertIsInstance(result.cost, CheckCost)
+        self.assertEqual(result.cost.queries, 1)
+        self.assertEqual(result.cost.hits, 80)
+
+    def test_not_measured_by_default(self):
+        store = self.file_store(self.logs)
+        enabled = []
+        scan = store.scan
+        store.scan = lambda filter, sort=None: enabled.append(instrumentation.enabled()) or scan(filter, sort)
+        self.assertEqual(AssertionChecker(None, "T", backend=store).check_assertion(**self.check).cost, None)
+        # Spans are only recorded, on any thread, while a check is measured
+        AssertionChecker(None, "T", backend=store, profile=True).check_assertion(**self.check)
+        self.assertEqual(enabled, [False, True])
+
+    def slow_sort(self):
+        """Patch in a sort key that takes 1ms per log entry, returning the patch to undo"""
+        sort_key = logstore._sort_key
+
+        def slow_sort_key(field):
+            key = sort_key(field)
+            return lambda hit: time.sleep(0.001) or key(hit)
+
+        logstore._sort_key = slow_sort_key
+        return lambda: setattr(logstore, "_sort_key", sort_key)
+
+    def test_query_time_counts_the_sort(self):
+        checker = AssertionChecker(None, "T", backend=self.file_store(self.logs), profile=True)
+        undo = self.slow_sort()
+        try:
+            cost = checker.check_assertion(**self.check).cost
+        finally:
+            undo()
+        self.assertTrue(cost.query_ns >= 0.07e9, cost)
+        self.assertTrue(cost.eval_ns < cost.query_ns, cost)
+
+    def test_scan_time_counts_the_sort_in_sqlite(self):
+        store = self.sqlite_store(self.logs)
+        undo = self.slow_sort()
+        try:
+            with SpanRecorder() as recorder:
+                hits = list(store.scan({"term": {"testid": "T"}}, sort="status"))
+        finally:
+            undo()
+        self.assertEqual(len(hits), 80)
+        scan, = [s for s in recorder.spans if s.name == "sqlite.scan"]
+        self.assertTrue(scan.attributes["busy_ns"] >= 0.07e9, scan)
+
+if __name__ == '__main__':
+    unittest.main()
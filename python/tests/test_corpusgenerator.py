@@ -0,0 +1,60 @@
+# coding=utf-8
+import os
+
+from pygremlin import ApplicationGraph, AssertionChecker, CorpusGenerator, SQLiteLogStore
+
+from .test_assertionchecker import LogsTestCase
+
+
+def _gremlins(scenario, **kwargs):
+    return {"gremlins": [dict(scenario=scenario, dest="B", headerpattern="testUser-*", **kwargs)]}
+
+
+class CorpusGeneratorTest(LogsTestCase):
+
+    def setUp(self):
+        LogsTestCase.setUp(self)
+        self.app = ApplicationGraph({"services": [{"name": "A"}, {"name": "B"}], "dependencies": {"A": ["B"]}})
+
+    def checker(self, gremlins, **kwargs):
+        """AssertionChecker on a corpus of A calling B, every request matching the gremlins"""
+        path = os.path.join(self.dir, "corpus.db")
+        if os.path.exists(path):
+            os.remove(path)
+        CorpusGenerator(self.app, gremlins, faulty_fraction=1.0, mean_latency="1ms", **kwargs).load(path)
+        store = SQLiteLogStore(path)
+        self.addCleanup(store.close)
+        return AssertionChecker(None, "corpus", backend=store)
+
+    def test_circuit_breaker(self):
+        # B always fails, for 3s, so that the circuit goes half-open, and opens again, twice
+        breaker = {"closed_attempts": 2, "reset_time": "1s"}
+        check = dict(source="A", dest="B", headerprefix="req-", **breaker)
+        checker = self.checker(None, requests=300, error_rate=1.0, circuit_breaker=breaker)
+        self.assertTrue(checker.check_circuit_breaker(**check).success)
+        # Three calls trip the circuit, then one call in each of the two half-open periods
+        self.assertTrue(checker.check_num_requests("A", "B", 5).success)
+        result = self.checker(None, requests=300, error_rate=1.0).check_circuit_breaker(**check)
+        self.assertFalse(result.success)
+        self.assertIn("before reset_timer (1.0s)expired", result.errormsg)
+
+    def test_bounded_retries(self):
+        checker = self.checker(_gremlins("abort_requests", errorcode=503), requests=20, retries=2, retry_wait="100ms")
+        self.assertTrue(checker.check_bounded_retries(source="A", dest="B", retries=2, wait_time="100ms").success)
+        result = checker.check_bounded_retries(source="A", dest="B", retries=1)
+        self.assertFalse(result.success)
+        self.assertIn("expected 1 retries, but found 2 retries", result.errormsg)
+
+    def test_response_rules(self):
+        checker = self.checker(_gremlins("abort_responses", errorcode=503), requests=20, retries=1)
+        self.assertFalse(checker.check_http_success_status().success)
+        self.assertTrue(checker.check_bounded_retries(source="A", dest="B", retries=1).success)
+        for hit in checker._store.scan({"term": {"msg": "Response"}}):
+            self.assertEqual((hit["_source"]["status"], hit["_source"]["actions"]), (503, ["abort"]))
+        for hit in checker._store.scan({"term": {"msg": "Request"}}):
+            self.assertEqual(hit["_source"]["actions"], [])
+
+        check = dict(source="A", dest="B", max_latency="20ms")
+        self.assertTrue(self.checker(None, requests=20).check_bounded_response_time(**check).success)
+        delays = _gremlins("delay_responses", delaytime="50ms")
+        self.assertFalse(self.checker(delays, requests=20).check_bounded_response_time(**check).success)
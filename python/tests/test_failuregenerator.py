@@ -0,0 +1,260 @@
+# coding=utf-8
+import multiprocessing
+import socket
+import time
+import unittest
+
+import requests
+
+from pygremlin import ApplicationGraph, AsyncFailureGenerator, FailureGenerator
+from pygremlin.failuregenerator import _canonical_rule
+from pygremlin.testing import GremlinProxy, ProxyPool, _ProxyHandler, _first_rule
+
+
+class CompileRulesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = ApplicationGraph({"services": [{"name": "A", "service_proxies": ["a:9876"]}, {"name": "B"}],
+                                     "dependencies": {"A": ["B"]}})
+        self.fg = FailureGenerator(self.app)
+
+    def test_duplicates_are_dropped(self):
+        self.fg.abort_requests(source="A", dest="B", errorcode=503)
+        self.fg.abort_requests(source="A", dest="B", errorcode=503, abortprobability=1)
+        plan = self.fg.compile_rules()
+        self.assertEqual(len(plan.rules), 1)
+        self.assertEqual(plan.duplicates, 1)
+        self.assertEqual(plan.per_proxy, {"a:9876": 1})
+
+    def test_compiled_rules_fire_like_the_queue(self):
+        self.fg.delay_requests(source="A", dest="B", delaytime="100ms", headerpattern="test-*")
+        self.fg.abort_requests(source="A", dest="B", errorcode=503, headerpattern="test-*")
+        self.fg.abort_requests(source="A", dest="B", errorcode=404, headerpattern="other-*")
+        self.fg.delay_requests(source="A", dest="B", delaytime="100ms", headerpattern="test-*")
+        queued = [_canonical_rule(rule) for rule in self.fg._queue]
+        compiled = self.fg.compile_rules().rules
+        self.assertEqual(len(compiled), 3)
+        for req_id in ("test-1", "other-1", "none"):
+            self.assertEqual(_first_rule(compiled, "A", "B", "request", req_id),
+                             _first_rule(queued, "A", "B", "request", req_id))
+        # The delay queued first still wins over the abort on the same messages
+        self.assertEqual(_first_rule(compiled, "A", "B", "request", "test-1")["delayprobability"], 1.0)
+        self.assertEqual(_first_rule(compiled, "A", "B", "request", "test-1")["abortprobability"], 0.0)
+
+
+class PushRulesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.proxies = ProxyPool().start()
+        self.app = self.proxies.application({"A": ["B", "C"], "B": ["C"]}, instances=2)
+        self.fg = FailureGenerator(self.app, max_workers=4)
+
+    def tearDown(self):
+        self.fg.close()
+        self.proxies.stop()
+
+    def installed(self):
+        rules = self.fg.list_rules()
+        return dict((service, sorted(len(r) for r in instances.values())) for service, instances in rules.items())
+
+    def test_parallel_push_installs_rules_on_every_instance(self):
+        self.fg.abort_requests(source="A", dest="B", errorcode=503)
+        self.fg.delay_requests(source="B", dest="C", delaytime="10ms")
+        results = self.fg.push_rules(parallel=True)
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(r.success for r in results))
+        self.assertEqual(self.installed(), {"A": [1, 1], "B": [1, 1], "C": []})
+
+    def test_parallel_pushes_share_one_worker_pool(self):
+        self.fg.abort_requests(source="A", dest="B", errorcode=503)
+        self.fg.push_rules(parallel=True)
+        pool = self.fg._workers()
+        self.fg.clear_rules_from_all_proxies()
+        self.fg.abort_requests(source="A", dest="C", errorcode=503)
+        self.fg.push_rules(parallel=True)
+        self.assertIs(self.fg._workers(), pool)
+        self.assertEqual(self.installed(), {"A": [1, 1], "B": [0, 0], "C": []})
+
+
+class _NoBatchHandler(_ProxyHandler):
+    """A proxy without rules/add_batch"""
+
+    def _control(self, method, path, body):
+        if path == "/gremlin/v1/rules/add_batch":
+            return self._reply(404)
+        return _ProxyHandler._control(self, method, path, body)
+
+
+class BatchPushTest(unittest.TestCase):
+
+    def setUp(self):
+        self.proxies = ProxyPool().start()
+        self.app = self.proxies.application({"A": ["B", "C"]})
+        self.proxy, = [p for p in self.proxies.proxies if p.service == "A"]
+        self.fg = FailureGenerator(self.app)
+
+    def tearDown(self):
+        self.fg.close()
+        self.proxies.stop()
+
+    def queue_rules(self):
+        self.fg.abort_requests(source="A", dest="B", errorcode=503, headerpattern="a-*")
+        self.fg.abort_requests(source="A", dest="C", errorcode=503, headerpattern="b-*")
+        self.fg.delay_requests(source="A", dest="C", delaytime="10ms", headerpattern="c-*")
+
+    def push(self, batch):
+        self.fg.clear_rules_from_all_proxies()
+        self.queue_rules()
+        result, = self.fg.push_rules(batch=batch)
+        self.assertTrue(result.success)
+        self.assertEqual(result.rules, 3)
+        self.assertEqual(len(self.proxy.list_rules()), 3)
+        return result, self.fg.get_push_stats()
+
+    def test_batch(self):
+        result, stats = self.push(batch=True)
+        self.assertEqual(result.requests, 1)
+        self.assertEqual((stats.requests, stats.bytes), (1, result.bytes))
+        self.assertEqual(stats.requests_saved, 2)
+        # The bytes saved are about those of the two extra requests a push without batching sends
+        unbatched, unbatched_stats = self.push(batch=False)
+        self.assertEqual(unbatched.requests, 3)
+        self.assertEqual(unbatched_stats, (3, unbatched.bytes, 0, 0))
+        self.assertAlmostEqual(stats.bytes + stats.bytes_saved, unbatched.bytes, delta=5)
+
+    def test_fallback_without_batch_support(self):
+        self.proxy.RequestHandlerClass = _NoBatchHandler
+        result, stats = self.push(batch=True)
+        # The failed batch request, then one per rule
+        self.assertEqual(result.requests, 4)
+        self.assertEqual((stats.requests, stats.bytes, stats.requests_saved, stats.bytes_saved),
+                         (4, result.bytes, 0, 0))
+        self.assertIn(self.proxy.instance, self.fg._no_batch)
+        # Known not to support batches: straight to one request per rule
+        result, stats = self.push(batch=True)
+        self.assertEqual(result.requests, 3)
+        self.assertEqual(stats.requests, 3)
+
+
+class AsyncFailureGeneratorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.proxies = ProxyPool().start()
+        self.app = self.proxies.application({"A": ["B", "C"], "B": ["C"]}, instances=2)
+        self.fg = AsyncFailureGenerator(self.app, timeout=5)
+
+    def tearDown(self):
+        self.fg.close()
+        self.proxies.stop()
+
+    def test_start_new_test(self):
+        future = self.fg.start_new_test()
+        test_id = self.fg.get_test_id()
+        self.assertEqual(future.get(), test_id)
+        self.assertTrue(future.ready())
+        self.assertEqual([p.test_id for p in self.proxies.proxies if p.service != "C"], [test_id] * 4)
+
+    def test_push_list_and_clear(self):
+        self.fg.abort_requests(source="A", dest="B", errorcode=503)
+        self.fg.delay_requests(source="B", dest="C", delaytime="10ms")
+        results = self.fg.push_rules().get()
+        self.assertEqual(sorted((r.service, r.rules, r.success) for r in results),
+                         [("A", 1, True), ("A", 1, True), ("B", 1, True), ("B", 1, True)])
+        rules = self.fg.list_rules().get()
+        self.assertEqual(sorted(rules), ["A", "B", "C"])
+        self.assertEqual([len(r) for r in rules["A"].values()], [1, 1])
+        self.assertEqual([r[0]["dest"] for r in rules["B"].values()], ["C", "C"])
+        self.assertEqual(self.fg.list_rules(service="B").get().keys(), ["B"])
+        self.assertTrue(self.fg.clear_rules_from_all_proxies().get())
+        self.assertEqual(self.fg.list_rules(service="A").get(), {"A": dict((i, []) for i in rules["A"])})
+
+
+class UnresponsiveProxyTest(unittest.TestCase):
+    """One instance of A accepts connections but never answers"""
+
+    def setUp(self):
+        self.proxy = GremlinProxy("A").start()
+        self.hung = socket.socket()
+        self.hung.bind(("127.0.0.1", 0))
+        self.hung.listen(8)
+        self.hung_instance = "127.0.0.1:%d" % self.hung.getsockname()[1]
+        self.app = ApplicationGraph({"services": [{"name": "A", "service_proxies": [self.proxy.instance,
+                                                                                   self.hung_instance]},
+                                                  {"name": "B"}],
+                                     "dependencies": {"A": ["B"]}})
+        self.fg = AsyncFailureGenerator(self.app, timeout=0.2)
+
+    def tearDown(self):
+        self.fg.close()
+        self.proxy.stop()
+        self.hung.close()
+
+    def test_calls_time_out(self):
+        start = time.time()
+        self.assertRaises(requests.exceptions.Timeout, self.fg.start_new_test().get)
+        self.assertFalse(self.fg.clear_rules_from_all_proxies().get())
+        self.assertEqual(self.fg.list_rules().get()["A"][self.hung_instance], {})
+        self.fg.abort_requests(source="A", dest="B", errorcode=503)
+        results = dict((r.instance, r) for r in self.fg.push_rules(continue_on_errors=True).get())
+        self.assertTrue(results[self.proxy.instance].success)
+        self.assertFalse(results[self.hung_instance].success)
+        self.assertTrue(results[self.hung_instance].errormsg)
+        self.assertEqual(len(self.proxy.list_rules()), 1)
+        self.fg.abort_requests(source="A", dest="B", errorcode=503)
+        self.assertRaises(requests.exceptions.Timeout, self.fg.push_rules().get)
+        # Each call gave up after the proxy timeout, all instances at once
+        self.assertTrue(time.time() - start < 3, time.time() - start)
+
+    def test_future_timeout(self):
+        self.fg.timeout = 1
+        future = self.fg.start_new_test()
+        self.assertRaises(multiprocessing.TimeoutError, future.get, 0.1)
+        self.assertFalse(future.ready())
+        self.assertRaises(requests.exceptions.Timeout, future.get)
+
+
+class SyncRulesTest(unittest.TestCase):
+
+    first = {"gremlins": [{"scenario": "abort_requests", "source": "A", "dest": "B", "errorcode": 503},
+                          {"scenario": "delay_requests", "source": "A", "dest": "C", "delaytime": "10ms"}]}
+    second = {"gremlins": [{"scenario": "abort_requests", "source": "A", "dest": "B", "errorcode": 503},
+                           {"scenario": "abort_requests", "source": "B", "dest": "C", "errorcode": 503}]}
+
+    def setUp(self):
+        self.proxies = ProxyPool().start()
+        self.app = self.proxies.application({"A": ["B", "C"], "B": ["C"]}, instances=2)
+
+    def tearDown(self):
+        self.proxies.stop()
+
+    def check_sync(self, sync):
+        results = sync(self.first)
+        self.assertEqual(sorted((r.service, r.added, r.removed) for r in results),
+                         [("A", 2, 0), ("A", 2, 0), ("B", 0, 0), ("B", 0, 0)])
+        # Only the rules that differ between the scenarios are sent
+        results = sync(self.second)
+        self.assertEqual(sorted((r.service, r.added, r.removed) for r in results),
+                         [("A", 0, 1), ("A", 0, 1), ("B", 1, 0), ("B", 1, 0)])
+        self.assertTrue(all(r.success for r in results))
+
+    def test_sync(self):
+        fg = FailureGenerator(self.app)
+        try:
+            for parallel in (False, True):
+                fg.sync_rules({"gremlins": []}, parallel=parallel)
+                self.check_sync(lambda gremlins: fg.sync_rules(gremlins, parallel=parallel))
+        finally:
+            fg.close()
+
+    def test_async_sync(self):
+        fg = AsyncFailureGenerator(self.app)
+        try:
+            for parallel in (False, True):
+                fg.sync_rules({"gremlins": []}, parallel=parallel).get()
+                self.check_sync(lambda gremlins: fg.sync_rules(gremlins, parallel=parallel).get())
+        finally:
+            fg.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
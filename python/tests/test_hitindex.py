@@ -0,0 +1,27 @@
+# coding=utf-8
+import unittest
+
+from pygremlin.hitindex import HitIndex
+
+
+class HitIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.hits = [{"_source": {"reqID": "req-1", "headers": {"X-Gremlin-ID": "req-1"}}},
+                     {"_source": {"reqID": "req-2", "headers": ["X-Gremlin-ID"]}},
+                     {"_source": {"reqID": "req-1"}}]
+        self.index = HitIndex(self.hits, keys=("_source.reqID", "_source.headers"))
+
+    def test_lookup(self):
+        self.assertEqual(self.index.get("_source.reqID", "req-1"), [self.hits[0], self.hits[2]])
+        self.assertEqual(self.index.rows_in("_source.reqID", ["req-2", "req-1", "req-3"]), [0, 1, 2])
+        self.assertEqual([value for value, hits in self.index.groups("_source.reqID")], ["req-1", "req-2"])
+
+    def test_unhashable_values_are_not_indexed(self):
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.values("_source.headers"), [None])
+        self.assertEqual(self.index.rows("_source.headers", None), [2])
+
+
+if __name__ == '__main__':
+    unittest.main()
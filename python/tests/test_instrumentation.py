@@ -0,0 +1,116 @@
+# coding=utf-8
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from pygremlin.instrumentation import OTLPSpanSink, PrometheusTextFile, Span, span
+
+
+def _span(name, seconds, error=None, **attributes):
+    s = Span(name, attributes)
+    s.start_ns = 10**18
+    s.end(error)
+    s.end_ns = s.start_ns + int(seconds * 1e9)
+    return s
+
+
+class InstrumentationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+class PrometheusTextFileTest(InstrumentationTestCase):
+
+    def test_exposition_text(self):
+        sink = PrometheusTextFile(os.path.join(self.dir, "pygremlin.prom"))
+        sink.on_end(_span("es.search", 0.5, check="bounded_retries", hits=10))
+        sink.on_end(_span("es.search", 0.25, error=ValueError("boom"), check="bounded_retries", hits=5))
+        sink.on_end(_span("parse", 1, bytes=100, other="not a label"))
+        self.assertEqual(sink.text(), "\n".join([
+            '# HELP pygremlin_span_seconds Time spent in pygremlin operations',
+            '# TYPE pygremlin_span_seconds summary',
+            'pygremlin_span_seconds_count{span="es.search",check="bounded_retries"} 2',
+            'pygremlin_span_seconds_sum{span="es.search",check="bounded_retries"} 0.75',
+            'pygremlin_span_seconds_count{span="parse"} 1',
+            'pygremlin_span_seconds_sum{span="parse"} 1.0',
+            '# TYPE pygremlin_span_errors_total counter',
+            'pygremlin_span_errors_total{span="es.search",check="bounded_retries"} 1',
+            '# TYPE pygremlin_span_bytes_total counter',
+            'pygremlin_span_bytes_total{span="parse"} 100',
+            '# TYPE pygremlin_span_hits_total counter',
+            'pygremlin_span_hits_total{span="es.search",check="bounded_retries"} 15',
+        ]) + "\n")
+
+    def test_label_values_are_escaped(self):
+        sink = PrometheusTextFile(os.path.join(self.dir, "pygremlin.prom"), prefix="test")
+        sink.on_end(_span("check", 1, check=u'say "h\u00e9"\\\n'))
+        self.assertIn(u'test_seconds_count{span="check",check="say \\"h\u00e9\\"\\\\\\n"} 1\n', sink.text())
+
+    def test_write_replaces_the_file(self):
+        path = os.path.join(self.dir, "pygremlin.prom")
+        with PrometheusTextFile(path) as sink:
+            with span("check", check=u"h\u00e9"):
+                pass
+        with open(path) as f:
+            self.assertEqual(f.read().decode("utf-8"), sink.text())
+        self.assertEqual(os.listdir(self.dir), ["pygremlin.prom"])
+
+
+class OTLPSpanSinkTest(InstrumentationTestCase):
+
+    def test_export_requests(self):
+        path = os.path.join(self.dir, "spans.json")
+        docs = []
+        with OTLPSpanSink(export=docs.append, path=path, batch_size=2, service_name="test") as sink:
+            with span("check", check="bounded_retries") as parent:
+                with span("es.search", hits=3, ratio=0.5, fused=True) as child:
+                    pass
+            try:
+                with span("parse"):
+                    raise ValueError("bad json")
+            except ValueError:
+                pass
+            # A full batch goes out at once, the rest when the sink is closed
+            self.assertEqual(len(docs), 1)
+        self.assertEqual(len(docs), 2)
+
+        for doc in docs:
+            self.assertEqual(doc["resourceSpans"][0]["resource"],
+                             {"attributes": [{"key": "service.name", "value": {"stringValue": "test"}}]})
+            self.assertEqual(doc["resourceSpans"][0]["scopeSpans"][0]["scope"], {"name": "pygremlin"})
+        spans = [doc["resourceSpans"][0]["scopeSpans"][0]["spans"] for doc in docs]
+        self.assertEqual([[s["name"] for s in batch] for batch in spans], [["es.search", "check"], ["parse"]])
+
+        encoded = spans[0][0]
+        self.assertEqual(encoded, {
+            "traceId": parent.trace_id,
+            "spanId": child.span_id,
+            "parentSpanId": parent.span_id,
+            "name": "es.search",
+            "kind": 1,
+            "startTimeUnixNano": str(child.start_ns),
+            "endTimeUnixNano": str(child.end_ns),
+            "attributes": [{"key": "fused", "value": {"boolValue": True}},
+                           {"key": "hits", "value": {"intValue": "3"}},
+                           {"key": "ratio", "value": {"doubleValue": 0.5}}],
+            "status": {}})
+        self.assertEqual(len(encoded["traceId"]), 32)
+        self.assertEqual(len(encoded["spanId"]), 16)
+        self.assertNotIn("parentSpanId", spans[0][1])
+        self.assertEqual(spans[0][1]["attributes"], [{"key": "check", "value": {"stringValue": "bounded_retries"}}])
+        self.assertEqual(spans[1][0]["status"], {"code": 2, "message": "bad json"})
+        self.assertNotEqual(spans[1][0]["traceId"], parent.trace_id)
+
+        # The same requests, one per line
+        with open(path) as f:
+            self.assertEqual([json.loads(line) for line in f], json.loads(json.dumps(docs)))
+
+
+if __name__ == '__main__':
+    unittest.main()
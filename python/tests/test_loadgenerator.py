@@ -0,0 +1,93 @@
+# coding=utf-8
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+import unittest
+
+from pygremlin import ConstantProfile, LoadGenerator, OpenLoopGenerator
+
+
+class _SlowHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.ids.append(self.headers.get("X-Gremlin-ID"))
+        time.sleep(self.server.delay)
+        # In one write: header and body written apart wait on delayed ACKs
+        self.wfile.write("HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _SlowServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, delay):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), _SlowHandler)
+        self.delay = delay
+        self.ids = []
+
+
+class LoadGeneratorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _SlowServer(0.01)
+        threading.Thread(target=self.server.serve_forever).start()
+        self.url = "http://127.0.0.1:%d/" % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_rate(self):
+        report = LoadGenerator(self.url, headerpattern="testUser-*", rate=100, concurrency=4, duration=0.5).run()
+        self.assertEqual(report.requests, 50)
+        self.assertEqual(report.errors, 0)
+        self.assertEqual(dict(report.statuses), {200: 50})
+        self.assertEqual(sorted(self.server.ids), sorted("testUser-%d" % n for n in range(50)))
+        self.assertEqual(report.histogram.count, 50)
+        self.assertTrue(report.histogram.min >= 0.01e9, report.histogram.min)
+        self.assertEqual(len(report.sent), 50)
+        self.assertTrue(80 < report.achieved_rate < 120, report.achieved_rate)
+
+    def test_closed_loop_is_bound_by_the_workers(self):
+        # Each of two workers waits for its reply before sending again: at most 200 requests/s
+        report = LoadGenerator(self.url, concurrency=2, duration=10, max_requests=20).run()
+        self.assertEqual(report.requests, 20)
+        self.assertEqual(dict(report.statuses), {200: 20})
+        self.assertEqual(report.histogram.count, 20)
+        self.assertTrue(report.elapsed >= 0.1, report.elapsed)
+        self.assertTrue(report.achieved_rate < 210, report.achieved_rate)
+
+
+class OpenLoopGeneratorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _SlowServer(0.05)
+        threading.Thread(target=self.server.serve_forever).start()
+        self.url = "http://127.0.0.1:%d/" % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_achieved_rate_counts_actual_sends(self):
+        # Two workers on a 50ms service send at most 40 requests/s of the 100/s offered
+        report = OpenLoopGenerator(self.url, ConstantProfile(100), duration=0.5, max_concurrency=2).run()
+        self.assertEqual(report.requests, 50)
+        self.assertEqual(report.errors, 0)
+        self.assertEqual(len(report.sent), 50)
+        self.assertTrue(20 < report.achieved_rate < 45, report.achieved_rate)
+        # Requests waiting for a worker count that wait in their latency
+        self.assertTrue(report.histogram.percentile(100) > 0.5e9, report.histogram.percentile(100))
+
+    def test_achieved_rate_follows_the_profile(self):
+        report = OpenLoopGenerator(self.url, ConstantProfile(50), duration=0.5, max_concurrency=8).run()
+        self.assertEqual(report.requests, 25)
+        self.assertTrue(40 < report.achieved_rate < 60, report.achieved_rate)
+
+
+if __name__ == '__main__':
+    unittest.main()
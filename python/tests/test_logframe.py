@@ -0,0 +1,93 @@
+# coding=utf-8
+import random
+import unittest
+
+from pygremlin import logframe
+from pygremlin.logframe import LogFrame
+
+
+def random_hits(n, seed=0):
+    """Hits of a few request ids, with ties in ts, and some entries missing ts, status or duration"""
+    rnd = random.Random(seed)
+    hits = []
+    for i in range(n):
+        log = {"source": "A", "dest": rnd.choice(["B", "C"]), "msg": rnd.choice(["Request", "Response"]),
+               "reqID": "req-%d" % rnd.randrange(5)}
+        if rnd.random() < 0.9:
+            log["ts"] = "2016-01-01T00:00:%02d.%06dZ" % (rnd.randrange(3), rnd.randrange(4) * 250000)
+        if rnd.random() < 0.5:
+            log["status"] = rnd.choice([200, 503])
+        if rnd.random() < 0.7:
+            log["duration"] = rnd.choice(["1.5ms", "20ms", "1s", "250us"])
+        hits.append({"_source": log})
+    return hits
+
+
+def ints(values):
+    return [int(v) for v in values]
+
+
+class BackendParityTest(unittest.TestCase):
+    """The numpy and list backends of LogFrame give the same answers"""
+
+    def without_numpy(self, f, *args, **kwargs):
+        self.assertIsNotNone(logframe.np, "numpy is needed to compare the backends")
+        np = logframe.np
+        try:
+            logframe.np = None
+            return f(*args, **kwargs)
+        finally:
+            logframe.np = np
+
+    def answers(self, hits, **kwargs):
+        """Everything a LogFrame over hits computes, as lists of ints"""
+        frame = LogFrame(hits, **kwargs)
+        found = {"len": len(frame), "categories": frame.categories}
+        for column in ("ts", "status", "duration"):
+            found[column] = ints(getattr(frame, column))
+            for threshold in (-1, 0, 10**6, 10**9):
+                found[column, threshold] = frame.exceeding(column, threshold)
+        found["spacing"] = ints(frame.spacing())
+        for key in frame.categories:
+            found["codes", key] = ints(frame.codes[key])
+            found["counts", key] = ints(frame.counts(key))
+            found["values", key] = [frame.value(key, row) for row in range(len(frame))]
+            found["group_spacing", key] = [ints(v) for v in frame.group_spacing(key)]
+        return found
+
+    def check(self, hits, **kwargs):
+        self.assertIsInstance(self.without_numpy(LogFrame, hits, **kwargs).ts, list)
+        plain = self.without_numpy(self.answers, hits, **kwargs)
+        vectorized = self.answers(hits, **kwargs)
+        self.assertEqual(sorted(vectorized), sorted(plain))
+        for k in plain:
+            self.assertEqual(vectorized[k], plain[k], "{}: {} != {}".format(k, vectorized[k], plain[k]))
+        return plain
+
+    def test_random_hits(self):
+        for seed in range(20):
+            self.check(random_hits(50, seed), durations=True)
+        self.check(random_hits(50), keys=("reqID",))
+
+    def test_single_hit(self):
+        self.check(random_hits(1), durations=True)
+
+    def test_no_hits(self):
+        self.check([], durations=True)
+
+    def test_missing_fields(self):
+        found = self.check([{"_source": {}}, {"_source": {"ts": "2016-01-01T00:00:00Z"}}], durations=True)
+        self.assertEqual(found["ts"], [-1, 1451606400000000000])
+        self.assertEqual(found["status"], [-1, -1])
+        self.assertEqual(found["duration"], [-1, -1])
+        self.assertEqual(found["values", "reqID"], [None, None])
+
+    def test_batches(self):
+        hits = random_hits(25)
+        frames = list(LogFrame.batches(hits, 10, keys=("reqID",)))
+        self.assertEqual([len(f) for f in frames], [10, 10, 5])
+        self.assertEqual(list(LogFrame.batches([], 10)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
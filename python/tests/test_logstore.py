@@ -0,0 +1,147 @@
+# coding=utf-8
+import json
+import os
+import sqlite3
+import threading
+import unittest
+
+from pygremlin import ElasticsearchStore, FileLogStore
+
+from .fake_elasticsearch import FakeElasticsearch
+from .test_assertionchecker import LogsTestCase, request_logs
+
+
+class ElasticsearchStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        # 25 requests from A to B, 5 from A to C, listed out of ts order
+        logs = request_logs("A", "B", dict(("req-%d" % i, 1) for i in range(25))) + \
+            request_logs("A", "C", dict(("req-%d" % i, 1) for i in range(5)))
+        self.es = FakeElasticsearch(reversed(logs))
+        self.store = ElasticsearchStore(self.es, page_size=10)
+        self.edge = {"bool": {"must": [{"term": {"source": "A"}}, {"term": {"dest": "B"}}]}}
+
+    def test_scroll_pages(self):
+        hits = list(self.store.scan(self.edge, sort="ts"))
+        self.assertEqual([hit["_source"]["reqID"] for hit in hits], ["req-%d" % i for i in sorted(range(25), key=str)])
+        # One search and three scroll pages, the last one empty, then the scroll is cleared
+        self.assertEqual(self.es.methods(), ["search", "scroll", "scroll", "clear_scroll"])
+        self.assertEqual(self.es.calls[0][1]["size"], 10)
+        self.assertEqual(self.es.scrolls, {})
+
+    def test_early_exit_clears_the_scroll(self):
+        scan = self.store.scan(self.edge)
+        first = [next(scan) for i in range(12)]
+        self.assertEqual(len(first), 12)
+        self.assertEqual(self.es.methods(), ["search", "scroll"])
+        scan.close()
+        self.assertEqual(self.es.methods(), ["search", "scroll", "clear_scroll"])
+        self.assertEqual(self.es.scrolls, {})
+
+    def test_fetch_slices_in_one_msearch(self):
+        small = {"bool": {"must": [{"term": {"source": "A"}}, {"term": {"dest": "C"}}]}}
+        slices = self.store.fetch_slices([small, {"term": {"reqID": "req-1"}}])
+        self.assertEqual(self.es.methods(), ["msearch"])
+        self.assertEqual([len(s) for s in slices], [5, 2])
+
+    def test_large_slice_is_completed_by_scrolling(self):
+        small = {"bool": {"must": [{"term": {"source": "A"}}, {"term": {"dest": "C"}}]}}
+        slices = self.store.fetch_slices([self.edge, small])
+        self.assertEqual([len(s) for s in slices], [25, 5])
+        self.assertEqual(slices[0], list(self.store.scan(self.edge, sort="ts")))
+        self.assertEqual(self.es.methods()[:5], ["msearch", "search", "scroll", "scroll", "clear_scroll"])
+
+    def test_msearch_error_falls_back_to_scan(self):
+        small = {"bool": {"must": [{"term": {"source": "A"}}, {"term": {"dest": "C"}}]}}
+        self.es.msearch_errors.add(0)
+        slices = self.store.fetch_slices([small, {"term": {"reqID": "req-1"}}])
+        self.assertEqual([len(s) for s in slices], [5, 2])
+        self.assertEqual([h["_source"]["ts"] for h in slices[0]], sorted(h["_source"]["ts"] for h in slices[0]))
+        self.assertEqual(self.es.methods(), ["msearch", "search", "clear_scroll"])
+
+    def test_count(self):
+        self.assertEqual(self.store.count(self.edge), 25)
+
+
+class FileLogStoreTest(LogsTestCase):
+
+    def setUp(self):
+        LogsTestCase.setUp(self)
+        self.logs = request_logs("A", "B", dict(("req-%d" % i, 1) for i in range(5)))
+        self.path = os.path.join(self.dir, "proxy.log")
+        self.write(self.logs)
+        self.edge = {"bool": {"must": [{"term": {"source": "A"}}, {"term": {"dest": "B"}}]}}
+
+    def write(self, logs, mode="w", end="\n"):
+        with open(self.path, mode) as f:
+            f.write("".join(json.dumps(log) + end for log in logs))
+
+    def count(self):
+        store = FileLogStore(self.path)
+        try:
+            return len(list(store.scan(self.edge)))
+        finally:
+            store.close()
+
+    def empty_index(self):
+        # Leave the stamp, drop the offsets: a reused index finds nothing
+        with open(self.path + ".idx") as f:
+            index = json.load(f)
+        with open(self.path + ".idx", "w") as f:
+            json.dump({"stamp": index["stamp"], "edges": []}, f)
+
+    def test_index_is_reused_while_the_file_is_unchanged(self):
+        self.assertEqual(self.count(), 5)
+        self.assertTrue(os.path.exists(self.path + ".idx"))
+        self.empty_index()
+        self.assertEqual(self.count(), 0)
+
+    def test_index_is_rebuilt_when_the_file_changes(self):
+        self.assertEqual(self.count(), 5)
+        self.empty_index()
+        self.write(request_logs("A", "B", {"req-5": 1}), mode="a")
+        self.assertEqual(self.count(), 6)
+        # Same size, another modification time
+        self.empty_index()
+        stat = os.stat(self.path)
+        os.utime(self.path, (stat.st_atime, stat.st_mtime + 10))
+        self.assertEqual(self.count(), 6)
+
+    def test_unterminated_last_line_is_skipped(self):
+        self.write(self.logs[:4])
+        # Half of the last entry, as written so far
+        with open(self.path, "a") as f:
+            f.write(json.dumps(self.logs[4])[:20])
+        self.assertEqual(self.count(), 4)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(self.logs[4])[20:] + "\n")
+        self.assertEqual(self.count(), 5)
+
+
+class SQLiteLogStoreTest(LogsTestCase):
+
+    def test_close_closes_the_connections_of_all_threads(self):
+        store = self.sqlite_store(request_logs("A", "B", dict(("req-%d" % i, 1) for i in range(5))))
+        edge = {"bool": {"must": [{"term": {"source": "A"}}, {"term": {"dest": "B"}}]}}
+        connections = []
+
+        def query():
+            self.assertEqual(store.count(edge), 5)
+            connections.append(store._connection())
+        threads = [threading.Thread(target=query) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        query()
+        self.assertEqual(len(set(connections)), 4)
+        store.close()
+        for conn in connections:
+            self.assertRaises(sqlite3.ProgrammingError, conn.execute, "SELECT 1")
+        # Usable again afterwards, on a new connection
+        self.assertEqual(store.count(edge), 5)
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+# coding=utf-8
+import json
+import os
+import threading
+
+from pygremlin import ElasticsearchStore, FileLogStore, StreamingAssertionChecker
+
+from .fake_elasticsearch import FakeElasticsearch
+from .test_assertionchecker import LogsTestCase, _ts, request_logs
+
+
+class WatchAssertionsTest(LogsTestCase):
+    """watch_assertions gives the same verdicts as the batch checks, on the same logs"""
+
+    checks = [
+        {"name": "no_proxy_errors"},
+        {"name": "bounded_response_time", "source": "A", "dest": "B", "max_latency": "10ms"},
+        {"name": "bounded_response_time", "source": "A", "dest": "S", "max_latency": "10ms"},
+        {"name": "bounded_response_time", "source": "A", "dest": "C", "max_latency": "10ms"},
+        {"name": "http_success_status"},
+        {"name": "at_most_requests", "source": "A", "dest": "B", "num_requests": 1},
+        {"name": "bounded_retries", "source": "A", "dest": "B", "retries": 1},
+        {"name": "bounded_retries", "source": "A", "dest": "B", "retries": 2},
+        {"name": "circuit_breaker", "source": "A", "dest": "F", "headerprefix": "req",
+         "closed_attempts": 1, "reset_time": "1s", "remove_retries": True},
+        {"name": "circuit_breaker", "source": "A", "dest": "F", "headerprefix": "req",
+         "closed_attempts": 10, "reset_time": "1s", "remove_retries": True},
+    ]
+
+    def setUp(self):
+        LogsTestCase.setUp(self)
+        # B answers in time, with req-4 retried twice; S is slow; nothing calls C. F fails twice,
+        # then A calls it again right away: that last request is only checked once the stream ends
+        failing = request_logs("A", "F", {"req-0": 1, "req-1": 1}, responses=True, status=503)
+        self.logs = (request_logs("A", "B", {"req-0": 1, "req-1": 1, "req-2": 1, "req-4": 3}, responses=True) +
+                     request_logs("A", "S", {"req-0": 1}, responses=True, duration=50) +
+                     failing + [dict(failing[0], reqID="req-2", ts=_ts(30))])
+
+    def verdicts(self, logs):
+        store = self.file_store(logs)
+        checker = StreamingAssertionChecker(None, "T", backend=store)
+        streamed = checker.watch_assertions({"checks": self.checks}, duration=0.2, poll_interval=0.02,
+                                            raise_on_violation=False)
+        batch = [checker.check_assertion(**dict(check)) for check in self.checks]
+        store.close()
+        return streamed, batch
+
+    def test_same_verdicts_as_the_batch_checks(self):
+        streamed, batch = self.verdicts(self.logs)
+        self.assertEqual([r.success for r in streamed], [r.success for r in batch])
+        self.assertEqual([r.errormsg for r in streamed], [r.errormsg for r in batch])
+        self.assertEqual([r.success for r in streamed], [True, True, False, False, False, False, False, True, False, True])
+        self.assertEqual(streamed[3].errormsg, "No log entries found")
+
+    def test_proxy_errors(self):
+        error = {"level": "error", "msg": "Failed to connect", "ts": _ts(0)}
+        streamed, batch = self.verdicts(self.logs + [error])
+        self.assertFalse(streamed[0].success)
+        self.assertEqual(streamed[0].errormsg, batch[0].errormsg)
+
+    def test_no_log_entries(self):
+        streamed, batch = self.verdicts([])
+        self.assertEqual([r.success for r in streamed], [r.success for r in batch])
+        # No errors is a success, no requests is not
+        self.assertTrue(streamed[0].success)
+        self.assertEqual(set(r.errormsg for r in streamed[1:]), set(["No log entries found"]))
+
+
+class TailTest(LogsTestCase):
+
+    def setUp(self):
+        LogsTestCase.setUp(self)
+        self.logs = request_logs("A", "B", dict(("req-%d" % i, 1) for i in range(6)))
+        self.filter = {"term": {"dest": "B"}}
+        self.stop = threading.Event()
+        # Ends a tail left waiting for entries that never come in
+        self.timer = threading.Timer(5, self.stop.set)
+        self.timer.start()
+
+    def tearDown(self):
+        self.timer.cancel()
+        LogsTestCase.tearDown(self)
+
+    def req_ids(self, tail, n):
+        return [next(tail)["_source"]["reqID"] for i in range(n)]
+
+    def test_file_tail(self):
+        path = os.path.join(self.dir, "proxy.log")
+        lines = [json.dumps(log) + "\n" for log in self.logs]
+        with open(path, "w") as f:
+            f.write(lines[0] + json.dumps({"dest": "C"}) + "\n" + lines[1] + lines[2][:10])
+        tail = FileLogStore(path).tail(self.filter, poll_interval=0.01, stop=self.stop)
+        self.assertEqual(self.req_ids(tail, 2), ["req-0", "req-1"])
+        # The partly written line comes out once it is complete
+        with open(path, "a") as f:
+            f.write(lines[2][10:] + "".join(lines[3:]))
+        self.assertEqual(self.req_ids(tail, 4), ["req-2", "req-3", "req-4", "req-5"])
+        self.stop.set()
+        self.assertEqual(list(tail), [])
+
+    def test_elasticsearch_tail(self):
+        es = FakeElasticsearch(self.logs[:3])
+        tail = ElasticsearchStore(es, page_size=2).tail(self.filter, poll_interval=0.01, stop=self.stop)
+        self.assertEqual(self.req_ids(tail, 3), ["req-0", "req-1", "req-2"])
+        # A new entry with the same ts as the last one seen is not skipped, the ones seen are not repeated
+        es.index(dict(self.logs[2], reqID="req-2b"))
+        for log in self.logs[3:]:
+            es.index(log)
+        self.assertEqual(self.req_ids(tail, 4), ["req-2b", "req-3", "req-4", "req-5"])
+        self.stop.set()
+        self.assertEqual(list(tail), [])
+        self.assertEqual(es.scrolls, {})
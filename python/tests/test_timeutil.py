@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import datetime
+import unittest
+
+import isodate
+
+from pygremlin import timeutil
+from pygremlin.timeutil import duration_ns, parse_duration, parse_timestamp, timedelta_ns, timestamp_ns
+
+_epoch = datetime.datetime(1970, 1, 1, tzinfo=isodate.UTC)
+
+
+class DurationTest(unittest.TestCase):
+
+    def test_units(self):
+        self.assertEqual(duration_ns("3h"), 3 * 3600 * 10**9)
+        self.assertEqual(duration_ns("2m"), 120 * 10**9)
+        self.assertEqual(duration_ns("10s"), 10 * 10**9)
+        self.assertEqual(duration_ns("10ms"), 10 * 10**6)
+        self.assertEqual(duration_ns("250us"), 250 * 10**3)
+        self.assertEqual(duration_ns("100ns"), 100)
+
+    def test_micro_signs(self):
+        # Micro sign and Greek mu, as unicode and as utf-8 bytes
+        for s in (u"250µs", u"250μs", "250\xc2\xb5s"):
+            self.assertEqual(duration_ns(s), 250 * 10**3, repr(s))
+
+    def test_compound_and_fractions(self):
+        self.assertEqual(duration_ns("1s500ms"), 1500 * 10**6)
+        self.assertEqual(duration_ns("1m30s"), 90 * 10**9)
+        self.assertEqual(duration_ns("1.5h"), 5400 * 10**9)
+        self.assertEqual(duration_ns(".5s"), 500 * 10**6)
+        self.assertEqual(duration_ns("12.5ms"), 12500 * 10**3)
+        self.assertEqual(duration_ns("0.001ms"), 1000)
+
+    def test_empty(self):
+        self.assertEqual(duration_ns(""), 0)
+        self.assertEqual(duration_ns("ms"), 0)
+        self.assertEqual(duration_ns("0s"), 0)
+
+    def test_unknown_units(self):
+        for s in ("10xs", "5 ms", "-1s", "1d", "10MS"):
+            self.assertRaises(ValueError, duration_ns, s)
+
+    def test_cache(self):
+        timeutil._durations.clear()
+        self.assertEqual(duration_ns("7ms"), duration_ns("7ms"))
+        self.assertIn("7ms", timeutil._durations)
+        # Emptied when full, and still right afterwards
+        for i in range(timeutil._max_durations + 1):
+            duration_ns("%dns" % i)
+        self.assertTrue(len(timeutil._durations) <= timeutil._max_durations)
+        self.assertEqual(duration_ns("7ms"), 7 * 10**6)
+        # Failed parses are not cached
+        self.assertRaises(ValueError, duration_ns, "7xs")
+        self.assertNotIn("7xs", timeutil._durations)
+
+    def test_parse_duration(self):
+        self.assertEqual(parse_duration("1s500ms"), datetime.timedelta(seconds=1.5))
+        self.assertEqual(parse_duration("26h"), datetime.timedelta(days=1, hours=2))
+        # timedelta stops at microseconds
+        self.assertEqual(parse_duration("1500ns"), datetime.timedelta(microseconds=1))
+
+    def test_timedelta_ns(self):
+        self.assertEqual(timedelta_ns(datetime.timedelta(days=1, seconds=1, microseconds=1)),
+                         (86401 * 10**6 + 1) * 1000)
+        self.assertEqual(timedelta_ns(datetime.timedelta(microseconds=-1)), -1000)
+        self.assertEqual(timedelta_ns(parse_duration("2m3s")), duration_ns("2m3s"))
+
+
+class TimestampTest(unittest.TestCase):
+
+    def assertLikeIsodate(self, ts):
+        expected = timedelta_ns(isodate.parse_datetime(ts) - _epoch)
+        self.assertEqual(timestamp_ns(ts), expected, ts)
+        self.assertEqual(parse_timestamp(ts), isodate.parse_datetime(ts), ts)
+
+    def test_proxy_format(self):
+        self.assertEqual(timestamp_ns("1970-01-01T00:00:00Z"), 0)
+        self.assertEqual(timestamp_ns("2016-01-01T00:00:00Z"), 1451606400 * 10**9)
+        self.assertEqual(timestamp_ns("2016-01-01T00:00:00.5Z"), 1451606400 * 10**9 + 5 * 10**8)
+        self.assertEqual(timestamp_ns("2016-01-01T00:00:00.000001Z"), 1451606400 * 10**9 + 1000)
+        self.assertEqual(timestamp_ns("2016-01-01T00:00:00.123456789Z"), 1451606400 * 10**9 + 123456789)
+        for ts in ("2016-03-07T17:29:01Z", "2016-03-07T17:29:01.1Z", "2016-03-07T17:29:01.123456Z"):
+            self.assertLikeIsodate(ts)
+
+    def test_calendar(self):
+        self.assertEqual(timestamp_ns("2016-02-29T12:00:00Z") - timestamp_ns("2016-02-28T12:00:00Z"),
+                         86400 * 10**9)
+        self.assertEqual(timestamp_ns("2016-03-01T00:00:00Z") - timestamp_ns("2016-02-28T00:00:00Z"),
+                         2 * 86400 * 10**9)
+        self.assertEqual(timestamp_ns("1969-12-31T23:59:59Z"), -10**9)
+        self.assertLikeIsodate("2000-12-31T23:59:59.999999Z")
+
+    def test_offsets(self):
+        utc = timestamp_ns("2016-01-01T00:00:00Z")
+        self.assertEqual(timestamp_ns("2016-01-01T05:30:00+05:30"), utc)
+        self.assertEqual(timestamp_ns("2015-12-31T16:00:00-08:00"), utc)
+        self.assertEqual(timestamp_ns("2015-12-31T16:00:00-0800"), utc)
+        self.assertEqual(timestamp_ns("2016-01-01T00:00:00+00:00"), utc)
+        for ts in ("2016-01-01T05:30:00.25+05:30", "2015-12-31T16:00:00-08:00", "2016-01-01T00:00:00+00:00"):
+            self.assertLikeIsodate(ts)
+
+    def test_rfc3339_variants(self):
+        utc = timestamp_ns("2016-01-01T00:00:00Z")
+        self.assertEqual(timestamp_ns("2016-01-01t00:00:00z"), utc)
+        self.assertEqual(timestamp_ns("2016-01-01 00:00:00Z"), utc)
+        self.assertEqual(parse_timestamp("2016-01-01 00:00:00Z"), isodate.parse_datetime("2016-01-01T00:00:00Z"))
+
+    def test_other_formats(self):
+        # Without a time zone: UTC
+        self.assertEqual(timestamp_ns("2016-01-01T00:00:00"), 1451606400 * 10**9)
+        self.assertEqual(timestamp_ns("2016-01-01T00:00:00.5"), 1451606400 * 10**9 + 5 * 10**8)
+        # Basic ISO 8601 format
+        self.assertEqual(timestamp_ns("20160101T000000Z"), 1451606400 * 10**9)
+
+    def test_invalid(self):
+        for ts in ("2016-02-30T00:00:00Z", "2016-13-01T00:00:00Z", "2016-01-01T24:00:01Z", "yesterday"):
+            self.assertRaises(ValueError, timestamp_ns, ts)
+        self.assertRaises(ValueError, parse_timestamp, "2016-02-30T00:00:00Z")
+
+
+if __name__ == '__main__':
+    unittest.main()
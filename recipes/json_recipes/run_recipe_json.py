@@ -51,7 +51,7 @@ print ('Use `postman` to inject test requests,\n\twith HTTP header X-Gremlin-ID:
 a = sys.stdin.read(1)
 sys.exit(0)
 
-ac = AssertionChecker(checklist['log_server'], testID, debug=debugMode)
+ac = AssertionChecker(checklist['log_server'], testID, debug=debugMode, profile=debugMode)
 results = ac.check_assertions(checklist)
 exit_status = 0
 
@@ -60,4 +60,7 @@ for check in results:
     if not check.success:
         exit_status = 1
 
+if debugMode:
+    print cost_report(results)
+
 sys.exit(exit_status)